@@ -1,8 +1,9 @@
 from datetime import timedelta
 
-from lxml.cssselect import CSSSelector
-
 from itsy import Itsy, Task, configure_logging
+from itsy.worker import patch
+from itsy.css import compile_selector
+from itsy.sinks import JSONLinesSink
 
 
 def explore_handler(task, doc):
@@ -22,6 +23,8 @@ def user_handler(task, doc):
 
 
 def repo_handler(task, doc):
+    yield {'url': task.url,
+           'description': doc.x('.repository-meta-content')}
     yield Task(url=task.url + '/stargazers', document_type='stargazers')
 
 
@@ -29,7 +32,7 @@ def stargazers_handler(task, doc):
     for url in doc.extract_links('#watchers li > a'):
         yield Task(url=url, document_type='user')
 
-    page_links = CSSSelector('.pagination a')(doc.lxml)
+    page_links = compile_selector('.pagination a')(doc.lxml)
     if page_links:
         next_url = page_links[-1].attrib['href']
         yield Task(url=next_url, document_type='stargazers')
@@ -37,11 +40,16 @@ def stargazers_handler(task, doc):
 
 def main():
     itsy = Itsy('example')
+    itsy.add_sink(JSONLinesSink('repos.jsonl'), document_types=['repo'])
+    itsy.obey_robots('itsy-example')
 
     itsy.add_handler('repo', repo_handler)
-    itsy.add_handler('user', user_handler)
-    itsy.add_handler('explore', explore_handler)
-    itsy.add_handler('stargazers', stargazers_handler)
+    itsy.add_handler('user', user_handler,
+                     selectors=['.popular-repos .public a'])
+    itsy.add_handler('explore', explore_handler,
+                     selectors=['.ranked-repositories h3 a'])
+    itsy.add_handler('stargazers', stargazers_handler,
+                     selectors=['#watchers li > a', '.pagination a'])
 
     # Check these once at the beginning.
     itsy.add_seed('https://github.com/explore/month', 'explore')
@@ -55,5 +63,7 @@ def main():
 
 
 if __name__ == '__main__':
+    # Patch for gevent before obey_robots and add_seed import requests.
+    patch()
     configure_logging()
     main()
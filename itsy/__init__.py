@@ -1,99 +1,312 @@
-from gevent import monkey
-monkey.patch_all(thread=False)
-
 import logging
-import logging.config
 import sys
+import time
 
-import gevent
-from gevent import Greenlet
-
-import requests
-
+from . import metrics
 from .client import Client
+from .css import compile_selector
 from .document import Document
 from .queue import Task, Queue, Empty
+from .scheduler import DomainScheduler
 
 log = logging.getLogger(__name__)
 
 
-class Worker(Greenlet):
-    """
-    An itsy worker. You should never have to use this directly.
+class Itsy(object):
     """
-    def __init__(self, id, itsy):
-        Greenlet.__init__(self)
-        self.id = id
-        self.itsy = itsy
-        self.client = Client(proxies=itsy.proxies)
-
-    def one(self):
-        task = self.itsy.pop()
-        log.info("%d: Handling task: [%s] %s",
-                 self.id, task.document_type, task.url)
-        r = self.client.get(url=task.url, referer=task.referer)
-
-        handler = self.itsy.handlers[task.document_type]
-        doc = Document(task, r)
-        result = handler(task, doc)
-        if result:
-            for new_task in result:
-                log.info("%d    -> [%s] %s%s",
-                         self.id, new_task.document_type, new_task.url,
-                         " HP" if new_task.high_priority else "")
-                new_task.set_originating_task(task)
-                self.itsy.push(new_task)
+    The ringleader of the Itsy web scraping framework.
 
-    def _run(self):
-        while True:
-            self.one()
-            gevent.sleep(2)
+    Each worker pops up to ``prefetch`` due tasks at a time into a local
+    buffer, so larger values trade scheduling precision for fewer round trips
+    to the queue.
 
+    Fetches are spaced out per domain by ``scheduler``, a ``DomainScheduler``
+    which is created with default settings if not supplied. When there is no
+    work, workers and ``pop`` back off exponentially from ``min_idle_delay``
+    to ``max_idle_delay`` seconds between polls of the queue.
 
-class Itsy(object):
-    """
-    The ringleader of the Itsy web scraping framework.
+    If a ``ResponseCache`` is given as ``cache``, it is shared by all workers
+    to make conditional requests. Handlers are skipped for pages which come
+    back 304 Not Modified, unless the cache holds their body, in which case
+    the handler gets the cached page.
+
+    ``client_options`` are passed on as keyword arguments to each worker's
+    ``Client``, e.g. to set pool sizes, timeouts or a maximum body size.
+
+    A preconfigured queue may be supplied as ``queue``, e.g. a ``Queue``
+    sharded across several Redis nodes, or an embedded
+    ``itsy.localqueue.LocalQueue`` for a single process crawl without Redis;
+    otherwise a Redis ``Queue`` is created for ``name``.
+
+    Handlers may yield items, such as dicts of scraped data, alongside new
+    ``Task`` instances. Items are sent to the sinks added with ``add_sink``.
+
+    A gevent crawl needs the process patched by ``itsy.worker.patch()``
+    before requests is imported, which happens when the first ``Client`` is
+    created, e.g. to fetch robots.txt while adding seeds. ``crawl`` patches
+    if that hasn't happened yet, and raises if it's too late, so a script
+    which does anything else first should call ``patch()`` before that.
     """
-    def __init__(self, name, proxies=None):
+    min_idle_delay = 0.1
+    max_idle_delay = 5
+
+    def __init__(self, name, proxies=None, prefetch=1, scheduler=None,
+                 cache=None, client_options=None, queue=None):
         self.handlers = {}
-        self.queue = Queue(name)
+        self.queue = queue or Queue(name)
         self.proxies = proxies
+        self.cache = cache
+        self.client_options = client_options or {}
+        self.prefetch = prefetch
+        self.scheduler = scheduler or DomainScheduler()
+        self.sinks = []
+        self.stopping = False
 
-    def add_handler(self, document_type, func):
+    def add_handler(self, document_type, func, selectors=()):
+        """
+        Register ``func`` as the handler for ``document_type``. Any CSS
+        ``selectors`` the handler uses may be listed up front, so they are
+        compiled once at startup.
+        """
         assert document_type not in self.handlers
         self.handlers[document_type] = func
+        for css in selectors:
+            compile_selector(css)
+
+    def add_sink(self, sink, document_types=None):
+        """
+        Send items yielded by handlers to ``sink``, an ``itsy.sinks.Sink``.
+        If ``document_types`` is given, only items from handlers for those
+        document types are sent to it.
+        """
+        self.sinks.append((sink, document_types))
+
+    def store(self, task, item):
+        """
+        Route an item yielded by the handler for ``task`` to the sinks.
+        """
+        for sink, document_types in self.sinks:
+            if document_types is None or task.document_type in document_types:
+                sink.put(item)
+
+    def close_sinks(self):
+        for sink, document_types in self.sinks:
+            sink.close()
+
+    def obey_robots(self, agent='itsy', ttl=None):
+        """
+        Drop tasks for URLs which robots.txt disallows for the user agent
+        token ``agent`` as they are pushed, and space out tasks for domains
+        with a Crawl-delay. Each domain's robots.txt is fetched once per
+        ``ttl`` seconds and shared through the queue. See
+        ``itsy.robots.Robots``.
+        """
+        from .robots import Robots
+        options = dict(self.client_options, proxies=self.proxies,
+                       max_body_size=Robots.max_size)
+        self.queue.robots = Robots(self.queue, agent, client_options=options,
+                                   ttl=ttl)
 
     def add_seed(self, url, document_type, referer=None, repeat_after=None):
         self.push(Task(url=url, document_type=document_type,
                        referer=referer, repeat_after=repeat_after))
 
+    def add_seeds(self, urls, document_type, referer=None, repeat_after=None,
+                  batch_size=1000):
+        """
+        Add many seeds, pushing them to the queue in pipelined batches of
+        ``batch_size``. ``urls`` may be any iterable, including a generator
+        such as ``itsy.seeds.read_urls(path)``, and is consumed lazily.
+        Returns the number of seeds which were enqueued.
+        """
+        added = 0
+        batch = []
+        for url in urls:
+            batch.append(Task(url=url, document_type=document_type,
+                              referer=referer, repeat_after=repeat_after))
+            if len(batch) >= batch_size:
+                added += sum(self.queue.push_many(batch))
+                batch = []
+        if batch:
+            added += sum(self.queue.push_many(batch))
+        return added
+
+    def handle(self, task, resp, worker_id=0):
+        """
+        Run the handler for ``task`` on a response, returning the list of new
+        tasks it yields. Any other items it yields are passed to ``store``.
+        Returns None without running the handler if the host asked us to back
+        off, so that the task is retried later.
+        """
+        if self.scheduler.feedback(task.url, resp):
+            log.warn("%d: Skipping handler for %s (HTTP %d)",
+                     worker_id, task.url, resp.status_code)
+            return None
+
+        if resp.status_code == 304:
+            log.info("%d: Not modified, skipping handler for %s",
+                     worker_id, task.url)
+            return []
+
+        start = time.time()
+        handler = self.handlers[task.document_type]
+        doc = Document(task, resp)
+        result = handler(task, doc)
+        new_tasks = []
+        if result:
+            for new_task in result:
+                if not isinstance(new_task, Task):
+                    self.store(task, new_task)
+                    continue
+                log.info("%d    -> [%s] %s%s",
+                         worker_id, new_task.document_type, new_task.url,
+                         " HP" if new_task.high_priority else "")
+                new_task.set_originating_task(task)
+                new_tasks.append(new_task)
+        metrics.registry.observe('itsy_handler_seconds', time.time() - start,
+                                 document_type=task.document_type)
+        metrics.registry.inc('itsy_tasks_total',
+                             document_type=task.document_type)
+        return new_tasks
+
     def fetch(self, url, referer):
+        import requests
         r = requests.get(url)
         return r.text
 
     def pop(self):
+        return self.pop_many(1)[0]
+
+    def pop_many(self, n):
+        idle_delay = self.min_idle_delay
         while True:
-            try:
-                return self.queue.pop()
-            except Empty:
-                log.warn("TIMEOUT")
+            tasks = self.queue.pop_many(n)
+            if tasks:
+                return tasks
+            log.debug("Queue empty, sleeping %0.1fs", idle_delay)
+            time.sleep(idle_delay)
+            idle_delay = min(idle_delay * 2, self.max_idle_delay)
 
     def push(self, task):
         self.queue.push(task)
 
-    def crawl(self, num_workers=5):
-        workers = []
-        for ii in range(num_workers):
+    def push_many(self, tasks):
+        self.queue.push_many(tasks)
+
+    def release_tasks(self, tasks):
+        """
+        Hand tasks which were popped but not fetched back to the queue, so
+        that they don't wait for their leases to expire.
+        """
+        for task in list(tasks):
+            try:
+                self.queue.release(task)
+            except Exception:
+                log.exception("Failed releasing tasks, they will be retried "
+                              "once their leases expire")
+                return
+
+    def crawl(self, num_workers=5, processes=1, shutdown_timeout=30):
+        """
+        Crawl with ``num_workers`` gevent worker greenlets. This monkey-patches
+        the process for gevent, if it hasn't been already.
+
+        Workers which die are restarted. Their tasks in progress are retried
+        once the queue leases on them expire.
+
+        If ``processes`` is greater than one, a supervisor forks that many
+        child processes which each run ``num_workers`` workers against the
+        shared queue, so that parsing and handlers can use multiple cores.
+        Crashed children are restarted.
+
+        On SIGTERM or SIGINT, workers stop taking new tasks and are given
+        ``shutdown_timeout`` seconds to finish the ones in progress. Tasks
+        which were popped but not started are handed back to the queue.
+        """
+        if processes > 1:
+            if not self.queue.shared:
+                raise ValueError('%s cannot be shared by several processes' %
+                                 type(self.queue).__name__)
+            from .supervisor import Supervisor
+            Supervisor(lambda: self.crawl(num_workers,
+                                          shutdown_timeout=shutdown_timeout),
+                       processes,
+                       shutdown_timeout=shutdown_timeout).run()
+            return
+
+        # Patch before anything here imports requests.
+        from .worker import patch, Worker
+        patch()
+        from .client import connection_limits
+        import gevent
+        import signal
+        # Drop any connections and locks made before patching, which would
+        # block.
+        self.queue.disconnect()
+        connection_limits.clear()
+        self.stopping = False
+        workers = {}
+
+        def start_worker(ii):
             worker = Worker(ii, self)
+            worker.link_exception(restart_worker)
             worker.start()
-            workers.append(worker)
-        gevent.joinall(workers)
+            workers[ii] = worker
+
+        def restart_worker(worker):
+            if not self.stopping:
+                log.error("%d: Worker died, restarting: %r",
+                          worker.id, worker.exception)
+                start_worker(worker.id)
+
+        for ii in range(num_workers):
+            start_worker(ii)
+
+        def shutdown():
+            log.info("Stopping %d workers", len(workers))
+            self.stop()
+            gevent.spawn_later(shutdown_timeout,
+                               lambda: gevent.killall(list(workers.values())))
+
+        handlers = [gevent.signal_handler(signum, shutdown)
+                    for signum in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            while not all(worker.dead for worker in workers.values()):
+                gevent.joinall(list(workers.values()))
+        finally:
+            for handler in handlers:
+                handler.cancel()
+            self.release_tasks(self.scheduler.drain())
+            self.close_sinks()
+
+    def stop(self):
+        """
+        Ask workers to stop once they finish their current task.
+        """
+        self.stopping = True
+
+    def crawl_async(self, concurrency=1000, **kwargs):
+        """
+        Crawl with the asyncio engine, running up to ``concurrency`` fetches
+        at once in a single event loop, until ``stop()`` is called. Requires
+        Python 3 and ``aiohttp``. Extra keyword arguments are passed on to
+        ``AsyncEngine``.
+        """
+        import asyncio
+        from .aio import AsyncEngine
+        self.stopping = False
+        engine = AsyncEngine(self, concurrency=concurrency, **kwargs)
+        try:
+            asyncio.run(engine.run())
+        finally:
+            self.close_sinks()
 
 
 def configure_logging(package_name=None):
     """
     Helper to configure logging for a command-line script which uses Itsy.
     """
+    import logging.config
     config = {
         'formatters': {
             'generic': {
@@ -0,0 +1,470 @@
+"""
+The asyncio crawl engine, used by ``Itsy.crawl_async``. Requires Python 3.7+,
+``aiohttp``, and redis-py 4.2+ for ``redis.asyncio``.
+"""
+import logging
+
+import asyncio
+import time
+from collections import deque
+
+import aiohttp
+from redis import asyncio as aioredis
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from . import dnscache, metrics
+from .client import Client, FetchError, ResponseTooLarge, check_content_type
+from .queue import Queue, Empty
+
+log = logging.getLogger(__name__)
+
+
+async def load_robots(robots, tasks):
+    """
+    Load the robots.txt rules for the domains of ``tasks`` which aren't in
+    memory yet, fetching robots.txt files concurrently in the default
+    executor, so that checking the tasks with ``robots`` doesn't block the
+    event loop.
+    """
+    if robots is None:
+        return
+    urls = {}
+    for task in tasks:
+        domain = robots.queue.domain_for_url(task.url)
+        if domain not in urls and not robots.is_loaded(domain):
+            urls[domain] = task.url
+    now = time.time()
+    fetches = []
+    for domain, url in urls.items():
+        stored = robots.load_stored(domain, now)
+        if stored:
+            robots.rules.set(domain, stored)
+        else:
+            fetches.append((domain, robots.robots_url(url, domain)))
+    if not fetches:
+        return
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(None, robots.fetch, robots_url)
+        for domain, robots_url in fetches])
+    for (domain, robots_url), (text, ttl) in zip(fetches, results):
+        robots.rules.set(domain,
+                         robots.store(domain, robots_url, text, ttl, now))
+
+
+class AsyncClient(object):
+    """
+    Asynchronous counterpart to ``Client``, built on a single pooled
+    ``aiohttp`` session. ``limit`` caps the total number of open connections
+    and ``limit_per_host`` the number per host (0 for no limit).
+
+    Responses are returned as ``requests.Response`` objects with the body
+    already read, so handlers see the same ``Document`` either way. An
+    optional ``ResponseCache`` is used for conditional requests, and
+    ``max_body_size``, ``content_types`` and ``timeout`` behave as in
+    ``Client``.
+    """
+    def __init__(self, user_agent=Client.default_user_agent, dnt=True,
+                 proxies=None, limit=100, limit_per_host=0, cache=None,
+                 max_body_size=None, content_types=None, timeout=(10, 30)):
+        self.user_agent = user_agent
+        self.dnt = dnt
+        self.proxies = proxies or {}
+        self.cache = cache
+        self.max_body_size = max_body_size
+        self.content_types = content_types
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect,
+                                             sock_read=read)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+
+    def make_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit,
+                                         limit_per_host=self.limit_per_host,
+                                         ttl_dns_cache=dnscache.cache.ttl)
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=self.timeout)
+
+    async def get(self, url, referer, headers=None):
+        if self.session is None:
+            self.session = self.make_session()
+
+        headers = headers or {}
+        headers.setdefault('User-Agent', self.user_agent)
+
+        if self.dnt:
+            headers.setdefault('DNT', '1')
+
+        if referer:
+            headers['Referer'] = referer
+
+        if self.cache is not None:
+            for k, v in self.cache.conditional_headers(url).items():
+                headers.setdefault(k, v)
+
+        proxy = self.proxies.get(url.split(':', 1)[0])
+        if proxy and '://' not in proxy:
+            proxy = 'http://' + proxy
+
+        registry = metrics.registry
+        start = time.time()
+        async with self.session.get(url, headers=headers,
+                                    proxy=proxy) as r:
+            headers_at = time.time()
+            registry.observe('itsy_fetch_ttfb_seconds', headers_at - start)
+            registry.inc('itsy_responses_total', status=r.status)
+            resp = Response()
+            resp.status_code = r.status
+            resp.reason = r.reason
+            resp.url = str(r.url)
+            resp.headers = CaseInsensitiveDict(r.headers)
+            resp.encoding = get_encoding_from_headers(resp.headers)
+            check_content_type(resp.headers.get('Content-Type'),
+                               self.content_types)
+            resp._content = await self.read_body(url, r)
+            registry.observe('itsy_fetch_download_seconds',
+                             time.time() - headers_at)
+            registry.inc('itsy_fetch_bytes_total', len(resp._content))
+
+        if self.cache is not None:
+            if resp.status_code == 304:
+                return self.cache.cached_response(url) or resp
+            self.cache.store(url, resp)
+        return resp
+
+    async def read_body(self, url, r):
+        limit = self.max_body_size
+        if not limit:
+            return await r.read()
+        if r.content_length and r.content_length > limit:
+            raise ResponseTooLarge(url)
+
+        chunks = []
+        size = 0
+        async for chunk in r.content.iter_chunked(Client.chunk_size):
+            size += len(chunk)
+            if size > limit:
+                raise ResponseTooLarge(url)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncQueue(Queue):
+    """
+    ``Queue`` backed by an asyncio Redis client. Uses the same scripts and
+    key layout, so it can share a queue with gevent workers.
+    """
+    def make_redis(self, node):
+        if isinstance(node, dict):
+            return aioredis.StrictRedis(**node)
+        return aioredis.StrictRedis.from_url(node)
+
+    async def record_crawl_timestamp(self, url, now):
+        key, field = self.index_location('urlts', self.hash_url(url))
+        await self.shard_for_url(url).hset(key, field, '%d' % now)
+
+    async def get_crawl_timestamp(self, url):
+        return (await self.get_crawl_timestamps([url]))[0]
+
+    async def get_crawl_timestamps(self, urls):
+        return [int(s) if s else None
+                for s in await self.lookup_index('urlts', urls)]
+
+    async def get_existing_task_id(self, url):
+        return (await self.get_existing_task_ids([url]))[0]
+
+    async def get_existing_task_ids(self, urls):
+        return [(s[:-1].decode('ascii'), s[-1:] == b'1') if s
+                else (None, None)
+                for s in await self.lookup_index('taskbyurl', urls)]
+
+    async def lookup_index(self, prefix, urls):
+        results = [None] * len(urls)
+        for index, entries in self.group_by_shard(urls).items():
+            buckets = self.index_buckets(prefix, entries)
+            async with self.shards[index].pipeline(transaction=False) as pipe:
+                for key, fields in buckets.items():
+                    pipe.hmget(key, [field for ii, field in fields])
+                for fields, values in zip(buckets.values(),
+                                          await pipe.execute()):
+                    for (ii, field), value in zip(fields, values):
+                        results[ii] = value
+        return results
+
+    async def get_task(self, task_id):
+        key = self.prefix_redis_key('task', task_id)
+        for shard in self.shards:
+            s = await shard.hget(key, 'data')
+            if s:
+                return self.deserialize(s)
+
+    async def push(self, task):
+        await load_robots(self.robots, [task])
+        if not self.is_allowed(task):
+            return False
+        keys, args = self.push_script_params(task)
+        return bool(await self.push_script(
+            keys=keys, args=args, client=self.shard_for_url(task.url)))
+
+    async def push_many(self, tasks):
+        await load_robots(self.robots, tasks)
+        start = time.time()
+        results = [False] * len(tasks)
+        groups = self.group_by_shard(tasks, lambda task: task.url)
+        for index, entries in groups.items():
+            entries = [(ii, task) for ii, task in entries
+                       if self.is_allowed(task)]
+            async with self.shards[index].pipeline(transaction=False) as pipe:
+                for ii, task in entries:
+                    keys, args = self.push_script_params(task)
+                    await self.push_script(keys=keys, args=args, client=pipe)
+                for (ii, task), r in zip(entries, await pipe.execute()):
+                    results[ii] = bool(r)
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='push_many')
+        metrics.registry.inc('itsy_queue_pushed_total', sum(results))
+        return results
+
+    async def pop_many(self, n):
+        start = time.time()
+        tasks = []
+        for shard in self.shard_order():
+            keys, args = self.pop_script_params(n - len(tasks))
+            blobs = await self.pop_script(keys=keys, args=args, client=shard)
+            tasks.extend(self.deserialize(s) for s in blobs)
+            if len(tasks) >= n:
+                break
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='pop_many')
+        metrics.registry.inc('itsy_queue_popped_total', len(tasks))
+        return tasks
+
+    async def ack(self, task):
+        return bool(await self.ack_script(
+            args=[task.task_id, time.time(), self.name,
+                  self.index_bucket_bytes],
+            client=self.shard_for_url(task.url)))
+
+    async def fail(self, task):
+        metrics.registry.inc('itsy_queue_failed_total')
+        return bool(await self.fail_script(
+            args=[task.task_id, time.time(), self.name,
+                  self.index_bucket_bytes, self.max_retries,
+                  self.retry_delay, self.max_retry_delay],
+            client=self.shard_for_url(task.url)))
+
+    async def release(self, task, delay=0):
+        return bool(await self.release_script(
+            args=[task.task_id, time.time(), self.name,
+                  self.index_bucket_bytes, delay],
+            client=self.shard_for_url(task.url)))
+
+    async def pop(self):
+        tasks = await self.pop_many(1)
+        if not tasks:
+            raise Empty()
+        return tasks[0]
+
+    async def set_domain_weight(self, domain, weight):
+        for shard in self.shards:
+            await shard.hset(self.domain_state_key(domain), 'weight', weight)
+
+    async def set_domain_delay(self, domain, delay):
+        for shard in self.shards:
+            await shard.hset(self.domain_state_key(domain), 'delay', delay)
+
+    async def count(self):
+        high = normal = 0
+        for shard in self.shards:
+            high += await shard.zcard(self.pick_queue_key(True))
+            domains = []
+            for state in ('ready', 'waiting'):
+                key = self.prefix_redis_key('domains', state)
+                domains.extend(d.decode('utf-8')
+                               for d in await shard.zrange(key, 0, -1))
+            async with shard.pipeline(transaction=False) as pipe:
+                for domain in domains:
+                    pipe.zcard(self.pick_queue_key(False, domain))
+                normal += sum(await pipe.execute())
+
+        return {'high': high,
+                'normal': normal}
+
+
+class LocalAsyncQueue(object):
+    """
+    Wraps a queue which is local to this process, such as a ``LocalQueue``,
+    for the ``AsyncEngine``. Its operations don't do any I/O worth waiting
+    on, so they are simply run inline, apart from fetching robots.txt.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def push_many(self, tasks):
+        await load_robots(self.queue.robots, tasks)
+        return self.queue.push_many(tasks)
+
+    async def pop_many(self, n):
+        return self.queue.pop_many(n)
+
+    async def ack(self, task):
+        return self.queue.ack(task)
+
+    async def fail(self, task):
+        return self.queue.fail(task)
+
+    async def release(self, task, delay=0):
+        return self.queue.release(task, delay)
+
+
+class AsyncEngine(object):
+    """
+    Runs a crawl for an ``Itsy`` instance in one asyncio event loop, with up
+    to ``concurrency`` tasks in flight at once. Due tasks are popped from the
+    queue ``prefetch`` at a time, and ``limit_per_host`` optionally caps the
+    concurrent connections to any one host, defaulting to the ``Client``
+    option ``max_per_host``.
+
+    Of the ``Itsy`` instance's ``client_options``, those listed in
+    ``client_option_names`` are passed on to the ``AsyncClient``.
+    """
+    client_option_names = ('user_agent', 'dnt', 'max_body_size',
+                           'content_types', 'timeout')
+
+    def __init__(self, itsy, concurrency=1000, prefetch=100,
+                 limit_per_host=0):
+        self.itsy = itsy
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        if isinstance(itsy.queue, Queue):
+            self.queue = AsyncQueue(
+                itsy.queue.name,
+                url_canonicalizer=itsy.queue.canonicalize_url,
+                index_bucket_bytes=itsy.queue.index_bucket_bytes,
+                nodes=itsy.queue.nodes,
+                domain_weight=itsy.queue.domain_weight,
+                domain_delay=itsy.queue.domain_delay)
+            for name in ('lease_timeout', 'max_retries', 'retry_delay',
+                         'max_retry_delay', 'robots'):
+                setattr(self.queue, name, getattr(itsy.queue, name))
+        else:
+            self.queue = LocalAsyncQueue(itsy.queue)
+        options = dict((k, v) for k, v in itsy.client_options.items()
+                       if k in self.client_option_names)
+        limit_per_host = (limit_per_host or
+                          itsy.client_options.get('max_per_host') or 0)
+        self.client = AsyncClient(proxies=itsy.proxies, limit=concurrency,
+                                  limit_per_host=limit_per_host,
+                                  cache=itsy.cache, **options)
+        self.buffer = deque()
+
+    async def next_task(self):
+        """
+        Return the next task which is allowed to be fetched now, parking
+        tasks for rate limited domains just like the gevent ``Worker``.
+        Returns None if the crawl is stopping.
+        """
+        scheduler = self.itsy.scheduler
+        idle_delay = self.itsy.min_idle_delay
+        while not self.itsy.stopping:
+            now = time.time()
+            task = scheduler.pop_parked(now)
+            if task is None and not scheduler.is_full():
+                if not self.buffer:
+                    self.buffer.extend(
+                        await self.queue.pop_many(self.prefetch))
+                if self.buffer:
+                    task = self.buffer.popleft()
+
+            if task is not None:
+                wait = scheduler.reserve(task.url, now)
+                if not wait:
+                    return task
+                if wait > scheduler.max_park_time:
+                    await self.queue.release(task, wait)
+                else:
+                    crowded = scheduler.has_parked(task.url)
+                    scheduler.park(task, now + wait)
+                    if not crowded:
+                        continue
+
+            ready_at = scheduler.next_ready_time()
+            if ready_at:
+                await asyncio.sleep(min(max(ready_at - now, 0), idle_delay))
+            else:
+                await asyncio.sleep(idle_delay)
+            idle_delay = min(idle_delay * 2, self.itsy.max_idle_delay)
+
+    async def one(self, task):
+        try:
+            log.info("Handling task: [%s] %s", task.document_type, task.url)
+            try:
+                r = await self.client.get(url=task.url, referer=task.referer)
+            except FetchError as e:
+                log.warn("Skipping %s: %r", task.url, e)
+                await self.queue.ack(task)
+                return
+            new_tasks = self.itsy.handle(task, r)
+            if new_tasks is None:
+                await self.queue.release(
+                    task, self.itsy.scheduler.wait_time(task.url))
+                return
+            if new_tasks:
+                await self.queue.push_many(new_tasks)
+            await self.queue.ack(task)
+        except Exception:
+            log.exception("Failed handling task: %r", task)
+            try:
+                await self.queue.fail(task)
+            except Exception:
+                log.exception("Failed marking task as failed: %r", task)
+        finally:
+            self.slots.release()
+
+    async def run(self):
+        """
+        Crawl until ``Itsy.stop()`` is called, then wait for the tasks in
+        flight to finish and hand those which were popped but not started
+        back to the queue.
+        """
+        self.slots = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+        try:
+            while True:
+                await self.slots.acquire()
+                task = await self.next_task()
+                if task is None:
+                    break
+                future = asyncio.ensure_future(self.one(task))
+                in_flight.add(future)
+                future.add_done_callback(in_flight.discard)
+            if in_flight:
+                await asyncio.wait(list(in_flight))
+        finally:
+            for future in list(in_flight):
+                future.cancel()
+            await self.client.close()
+            await self.release_tasks(list(self.buffer) +
+                                     self.itsy.scheduler.drain())
+            self.buffer.clear()
+
+    async def release_tasks(self, tasks):
+        for task in tasks:
+            try:
+                await self.queue.release(task)
+            except Exception:
+                log.exception("Failed releasing tasks, they will be retried "
+                              "once their leases expire")
+                return
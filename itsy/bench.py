@@ -0,0 +1,444 @@
+"""
+Benchmarks for the crawl hot paths. Run with::
+
+    $ python -m itsy.bench [--redis-url URL | --fakeredis | --local]
+                           [benchmark ...]
+
+Full crawls are run against a mock site: a synthetic link graph served by a
+local HTTP server in a child process, with configurable latency and page
+size. Queue and crawl benchmarks need a Redis server, and use keys under the
+``itsybench:`` prefix of the given database. With ``--fakeredis`` they run
+against an in-process fakeredis server instead, which requires the
+``fakeredis`` and ``lupa`` packages, and with ``--local`` they use an
+in-memory ``LocalQueue``.
+
+Each benchmark reports operations per second, p50 and p99 latency per
+operation and, on Python 3, peak memory allocated while it ran. The import
+benchmark times ``import itsy`` and creating an ``Itsy`` instance in fresh
+interpreters, and the startup of those interpreters as a whole.
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import multiprocessing
+import random
+import ssl
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from . import parsers
+from .document import Document
+from .queue import Task, Queue
+
+QUEUE_NAME = 'itsybench'
+
+IMPORT_SCRIPT = """
+import time
+start = time.time()
+import itsy
+imported = time.time()
+itsy.Itsy('itsybench')
+print('%r %r' % (imported - start, time.time() - imported))
+"""
+
+
+def page_links(page, pages, links):
+    """
+    Return the page numbers linked from ``page`` in the synthetic link graph.
+    The graph is deterministic, and every page is reachable from page 0.
+    """
+    rand = random.Random(page)
+    targets = [(page + 1) % pages]
+    targets.extend(rand.randrange(pages) for ii in range(links - 1))
+    return targets
+
+
+def render_page(page, pages=1000, links=10, size=20000):
+    """
+    Render a synthetic page of roughly ``size`` bytes, with ``links`` links
+    and a product-like block for the extraction benchmarks.
+    """
+    parts = ['<html><head><title>Page %d</title></head><body>' % page,
+             render_product(page),
+             '<ul class="links">']
+    for target in page_links(page, pages, links):
+        parts.append('<li><a href="/page/%d">Page %d</a></li>' %
+                     (target, target))
+    parts.append('</ul>')
+    length = sum(len(part) for part in parts)
+    filler = '<p class="filler">%s</p>' % ('lorem ipsum ' * 8)
+    while length < size:
+        parts.append(filler)
+        length += len(filler)
+    parts.append('</body></html>')
+    return ''.join(parts).encode('utf-8')
+
+
+def render_product(page):
+    return ('<div class="product"><h1 class="name">Product %d</h1>'
+            '<span class="price">$1,%03d.99</span>'
+            '<span class="stock">%d in stock</span>'
+            '<span class="date">Jan %02d, 2014</span></div>' %
+            (page, page % 1000, page * 7 % 100, page % 28 + 1))
+
+
+def render_listing(rows):
+    """
+    Render a list page with ``rows`` product blocks.
+    """
+    return ('<html><body>%s</body></html>' %
+            ''.join(render_product(ii) for ii in range(rows))).encode('utf-8')
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        site = self.server.site
+        if site['latency']:
+            time.sleep(site['latency'])
+        try:
+            page = int(self.path.rsplit('/', 1)[-1])
+        except ValueError:
+            page = -1
+        if not 0 <= page < site['pages']:
+            self.send_error(404)
+            return
+        body = render_page(page, site['pages'], site['links'], site['size'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_site(conn, site, certfile=None):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockSiteHandler)
+    server.site = site
+    if certfile:
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER',
+                                         ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(certfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+class MockSite(object):
+    """
+    Serves the synthetic link graph from a child process, so that it is
+    unaffected by gevent patching or load in the crawling process. Use as a
+    context manager. If a PEM ``certfile`` with the certificate and key for
+    127.0.0.1 is given, the site is served over HTTPS.
+    """
+    def __init__(self, pages=1000, links=10, size=20000, latency=0,
+                 certfile=None):
+        self.site = dict(pages=pages, links=links, size=size, latency=latency)
+        self.certfile = certfile
+
+    def __enter__(self):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_site, args=(child, self.site, self.certfile))
+        self.process.daemon = True
+        self.process.start()
+        scheme = 'https' if self.certfile else 'http'
+        self.base_url = '%s://127.0.0.1:%d' % (scheme, parent.recv())
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+    def url(self, page):
+        return '%s/page/%d' % (self.base_url, page)
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Result(object):
+
+    def __init__(self, name, ops, elapsed, latencies, peak_memory=None):
+        self.name = name
+        self.ops = ops
+        self.elapsed = elapsed
+        self.latencies = latencies
+        self.peak_memory = peak_memory
+
+    def __str__(self):
+        s = '%-24s %10.1f ops/sec  p50 %8.3fms  p99 %8.3fms' % (
+            self.name, self.ops / self.elapsed if self.elapsed else 0,
+            percentile(self.latencies, 0.5) * 1000,
+            percentile(self.latencies, 0.99) * 1000)
+        if self.peak_memory is not None:
+            s += '  peak %7.1fKiB' % (self.peak_memory / 1024.0)
+        return s
+
+
+def measure(name, func, args_list):
+    """
+    Call ``func`` with each argument tuple in ``args_list``, timing every
+    call. Returns a ``Result``.
+    """
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    latencies = []
+    start = time.time()
+    for args in args_list:
+        t = time.time()
+        func(*args)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return Result(name, len(args_list), elapsed, latencies, peak)
+
+
+def make_queue(options):
+    """
+    Return an empty benchmark queue for the command line ``options``.
+    """
+    if options.local:
+        from .localqueue import LocalQueue
+        return LocalQueue(QUEUE_NAME)
+
+    if options.fakeredis:
+        import fakeredis
+        server = fakeredis.FakeServer()
+
+        class FakeQueue(Queue):
+            def make_redis(self, node):
+                return fakeredis.FakeStrictRedis(server=server)
+
+        return FakeQueue(QUEUE_NAME)
+
+    queue = Queue(QUEUE_NAME, nodes=[options.redis_url])
+    for shard in queue.shards:
+        keys = list(shard.scan_iter(QUEUE_NAME + ':*'))
+        if keys:
+            shard.delete(*keys)
+    return queue
+
+
+def fake_response(body):
+    from requests import Response
+    resp = Response()
+    resp.status_code = 200
+    resp.headers['Content-Type'] = 'text/html; charset=utf-8'
+    resp.encoding = 'utf-8'
+    resp._content = body
+    return resp
+
+
+def bench_queue(options):
+    queue = make_queue(options)
+    n = options.ops
+    urls = ['http://site%d.example.com/page/%d' % (ii % 50, ii)
+            for ii in range(n)]
+    yield measure('queue.push', queue.push,
+                  [(Task(url),) for url in urls])
+    yield measure('queue.pop', queue.pop, [()] * n)
+    yield measure('queue.ack', queue.ack, [(Task(url),) for url in urls])
+
+    batches = [[Task(url + '?batch') for url in urls[ii:ii + 100]]
+               for ii in range(0, n, 100)]
+    result = measure('queue.push_many(100)', queue.push_many,
+                     [(batch,) for batch in batches])
+    result.ops = n
+    yield result
+    result = measure('queue.pop_many(100)', queue.pop_many,
+                     [(100,)] * len(batches))
+    result.ops = n
+    yield result
+
+
+def bench_document(options):
+    n = options.ops // 10
+    bodies = [render_page(ii, size=options.page_size) for ii in range(n)]
+
+    def parse_and_extract(body):
+        doc = Document(Task('http://www.example.com/'), fake_response(body))
+        doc.x('h1.name')
+        doc.x('.price', 'currency')
+        doc.x('ul.links a', 'hrefs')
+
+    yield measure('document.parse+x', parse_and_extract,
+                  [(body,) for body in bodies])
+
+    doc = Document(Task('http://www.example.com/'), fake_response(bodies[0]))
+    doc.lxml
+    yield measure('document.x', doc.x, [('.price', 'currency')] * n)
+
+    fields = {'name': ('h1.name', 'string'),
+              'price': ('.price', 'currency'),
+              'stock': ('.stock', 'integer'),
+              'date': ('.date', 'calendar_date')}
+    doc = Document(Task('http://www.example.com/'),
+                   fake_response(render_listing(100)))
+    doc.lxml
+    yield measure('document.extract(100)', doc.extract,
+                  [('.product', fields)] * (n // 10 or 1))
+
+
+def bench_parsers(options):
+    n = options.ops
+    doc = Document(Task('http://www.example.com/'),
+                   fake_response(render_page(1, size=options.page_size)))
+    cases = [
+        ('string', doc.lxml.cssselect('h1.name')),
+        ('integer', doc.lxml.cssselect('.stock')),
+        ('currency', doc.lxml.cssselect('.price')),
+        ('calendar_date', doc.lxml.cssselect('.date')),
+        ('hrefs', doc.lxml.cssselect('ul.links a')),
+    ]
+    for name, els in cases:
+        yield measure('parsers.%s' % name, getattr(parsers, name),
+                      [(els,)] * n)
+
+
+def run_crawl(conn, options, base_url):
+    """
+    Run a gevent crawl of the mock site until ``options.pages`` pages have
+    been handled, and send a ``Result`` back through ``conn``. Runs in a
+    child process, since ``Itsy.crawl`` patches the process for gevent.
+    """
+    from . import Itsy
+    from .scheduler import DomainScheduler
+
+    class BenchItsy(Itsy):
+
+        def handle(self, task, resp, worker_id=0):
+            # Task latency is from sending the request to finishing with the
+            # response, less the body download, which requests doesn't time.
+            start = time.time()
+            new_tasks = Itsy.handle(self, task, resp, worker_id)
+            latencies.append(resp.elapsed.total_seconds() +
+                             time.time() - start)
+            if len(latencies) >= options.pages:
+                self.stop()
+            return new_tasks
+
+    def handle_page(task, doc):
+        for href in doc.x('ul.links a', 'hrefs'):
+            yield Task(href, document_type='page')
+
+    latencies = []
+    itsy = BenchItsy('bench', scheduler=DomainScheduler(default_delay=0),
+                     queue=make_queue(options), prefetch=options.prefetch)
+    itsy.add_handler('page', handle_page)
+    itsy.add_seed(base_url + '/page/0', 'page')
+
+    start = time.time()
+    itsy.crawl(num_workers=options.workers)
+    conn.send(Result('itsy.crawl', len(latencies), time.time() - start,
+                     latencies))
+
+
+def bench_crawl(options):
+    with MockSite(pages=options.site_pages, size=options.page_size,
+                  latency=options.latency) as site:
+        # Crawl from a fresh interpreter where possible, since the other
+        # benchmarks import requests, which has to happen after patching.
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('spawn')
+        parent, child = context.Pipe()
+        process = context.Process(
+            target=run_crawl, args=(child, options, site.base_url))
+        process.start()
+        result = parent.recv()
+        process.join()
+    yield result
+
+
+def bench_import(options):
+    imports = []
+    creates = []
+    startups = []
+    for ii in range(options.import_runs):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT])
+        startups.append(time.time() - start)
+        imported, created = out.split()
+        imports.append(float(imported))
+        creates.append(float(created))
+    for name, latencies in (('import itsy', imports),
+                            ('itsy.Itsy()', creates),
+                            ('interpreter+import', startups)):
+        yield Result(name, len(latencies), sum(latencies), latencies)
+
+
+benchmarks = {
+    'import': bench_import,
+    'queue': bench_queue,
+    'document': bench_document,
+    'parsers': bench_parsers,
+    'crawl': bench_crawl,
+}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark itsy.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of %s (default: all)' %
+                        ', '.join(sorted(benchmarks)))
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--fakeredis', action='store_true',
+                        help='use an in-process fakeredis server')
+    parser.add_argument('--local', action='store_true',
+                        help='use an embedded LocalQueue instead of Redis')
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='operations per micro-benchmark')
+    parser.add_argument('--pages', type=int, default=500,
+                        help='pages to handle in the crawl benchmark')
+    parser.add_argument('--site-pages', type=int, default=10000,
+                        help='pages in the mock site link graph')
+    parser.add_argument('--page-size', type=int, default=20000,
+                        help='approximate mock page size in bytes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mock site response latency in seconds')
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--prefetch', type=int, default=10)
+    parser.add_argument('--import-runs', type=int, default=20,
+                        help='fresh interpreters to time importing itsy in')
+    options = parser.parse_args(args)
+    for name in options.benchmarks:
+        if name not in benchmarks:
+            parser.error('unknown benchmark: %s' % name)
+
+    for name in options.benchmarks or sorted(benchmarks):
+        for result in benchmarks[name](options):
+            print(result)
+
+
+if __name__ == '__main__':
+    main()
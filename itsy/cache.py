@@ -0,0 +1,91 @@
+from collections import OrderedDict
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache(object):
+    """
+    In-process cache of response validators (ETag and Last-Modified) by URL,
+    used by ``Client`` to make conditional requests.
+
+    If ``max_body_bytes`` is set, response bodies are cached too, evicting the
+    least recently used bodies to stay under that total size, so that a 304
+    can be turned back into the full cached response. Validators for at most
+    ``max_entries`` URLs are kept.
+    """
+    def __init__(self, max_entries=100000, max_body_bytes=0):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.validators = OrderedDict()
+        self.bodies = OrderedDict()
+        self.body_bytes = 0
+
+    def conditional_headers(self, url):
+        """
+        Return the request headers to revalidate a cached response for
+        ``url``, if there is one.
+        """
+        headers = {}
+        validators = self.validators.get(url)
+        if validators:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def store(self, url, resp):
+        """
+        Remember the validators, and possibly the body, of a successful
+        response.
+        """
+        if resp.status_code != 200:
+            return
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+
+        self.validators.pop(url, None)
+        self.validators[url] = (etag, last_modified)
+        if len(self.validators) > self.max_entries:
+            evicted, _ = self.validators.popitem(last=False)
+            self.drop_body(evicted)
+
+        if self.max_body_bytes:
+            self.drop_body(url)
+            content = resp.content
+            if len(content) <= self.max_body_bytes:
+                self.bodies[url] = (content, dict(resp.headers),
+                                    resp.encoding)
+                self.body_bytes += len(content)
+                while self.body_bytes > self.max_body_bytes:
+                    self.drop_body(next(iter(self.bodies)))
+
+    def drop_body(self, url):
+        entry = self.bodies.pop(url, None)
+        if entry:
+            self.body_bytes -= len(entry[0])
+
+    def cached_response(self, url):
+        """
+        Return the cached response for ``url`` as a new ``Response`` with
+        ``from_cache`` set, or None if the body isn't cached.
+        """
+        entry = self.bodies.pop(url, None)
+        if entry is None:
+            return
+        # Re-insert to mark as recently used.
+        self.bodies[url] = entry
+        content, headers, encoding = entry
+
+        resp = Response()
+        resp.status_code = 200
+        resp.url = url
+        resp.headers = CaseInsensitiveDict(headers)
+        resp.encoding = encoding
+        resp._content = content
+        resp.from_cache = True
+        return resp
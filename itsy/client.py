@@ -1,18 +1,138 @@
-import requests
+import time
+from contextlib import contextmanager
+
+from . import dnscache, metrics
+from .compat import urlsplit
+from .lru import KeyedLocks
+
+
+class FetchError(Exception):
+    """
+    Raised when a response is abandoned before its body is read.
+    """
+    pass
+
+
+class ResponseTooLarge(FetchError):
+    """
+    Raised when a response body exceeds the client's ``max_body_size``.
+    """
+    pass
+
+
+class ContentTypeRejected(FetchError):
+    """
+    Raised when a response has a content type the client doesn't accept.
+    """
+    pass
+
+
+def check_content_type(content_type, content_types):
+    if content_types and content_type:
+        mime_type = content_type.split(';', 1)[0].strip().lower()
+        if not mime_type.startswith(tuple(content_types)):
+            raise ContentTypeRejected(content_type)
+
+
+class ConnectionLimiter(object):
+    """
+    Caps the number of concurrent fetches per host, across every ``Client``
+    in the process. Fetches to a host which is at its limit wait for a slot,
+    while fetches to other hosts go ahead. Hosts are forgotten while no
+    fetches to them are running.
+    """
+    def __init__(self):
+        self.slots = KeyedLocks()
+
+    @contextmanager
+    def slot(self, key, limit):
+        """
+        Hold one of the ``limit`` slots for ``key``, usually a ``(host,
+        proxy)`` tuple, for the duration of the block.
+        """
+        start = time.time()
+        with self.slots.hold(key, limit):
+            metrics.registry.observe('itsy_connection_wait_seconds',
+                                     time.time() - start)
+            yield
+
+    def __len__(self):
+        return len(self.slots)
+
+    def clear(self):
+        """
+        Forget all hosts. Only call this while no fetches are running, e.g.
+        after patching for gevent, so that new semaphores are cooperative.
+        """
+        self.slots = KeyedLocks()
+
+
+connection_limits = ConnectionLimiter()
 
 
 class Client(object):
     """
     HTTP client interface owned by an Itsy worker. May be customized with user
     agent and proxy configuration.
+
+    Requests are made through a persistent session, so connections are kept
+    alive and reused for consecutive fetches to the same host.
+    ``pool_connections`` is the number of hosts to keep connection pools for,
+    and ``pool_maxsize`` is the maximum number of connections kept per host.
+
+    If a ``ResponseCache`` is given as ``cache``, requests for previously
+    fetched URLs are made conditional. A 304 Not Modified response is replaced
+    by the cached response if its body is cached, and otherwise returned
+    as-is.
+
+    Response bodies are streamed. If ``content_types`` is given, responses
+    whose Content-Type doesn't start with one of them are abandoned before
+    the body is read, raising ``ContentTypeRejected``. If ``max_body_size``
+    is given, larger responses are abandoned as soon as that many bytes have
+    been seen, raising ``ResponseTooLarge``. ``timeout`` is passed on to
+    requests, and may be a ``(connect, read)`` tuple.
+
+    If ``max_per_host`` is given, at most that many fetches run at once to
+    each host (through each proxy), counting fetches by all clients in the
+    process. Clients fetching from the same host should use the same limit.
+
+    If ``dns_cache`` is set, ``itsy.dnscache.cache`` is installed in place
+    of ``socket.getaddrinfo``, so that host names are resolved through a
+    process-wide cache. This affects everything in the process which
+    resolves names, not just the client.
     """
     default_user_agent = ('Mozilla/5.0 (compatible; Googlebot/2.1; '
                           '+http://www.google.com/bot.html)')
 
-    def __init__(self, user_agent=default_user_agent, dnt=True, proxies=None):
+    chunk_size = 64 * 1024
+
+    def __init__(self, user_agent=default_user_agent, dnt=True, proxies=None,
+                 pool_connections=10, pool_maxsize=10, cache=None,
+                 max_body_size=None, content_types=None, timeout=(10, 30),
+                 max_per_host=None, dns_cache=False):
         self.user_agent = user_agent
         self.dnt = dnt
         self.proxies = proxies
+        self.cache = cache
+        self.max_body_size = max_body_size
+        self.content_types = content_types
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        if dns_cache:
+            dnscache.cache.install()
+        self.session = self.make_session(pool_connections, pool_maxsize)
+
+    def make_session(self, pool_connections, pool_maxsize):
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.proxies:
+            session.proxies.update(self.proxies)
+        return session
 
     def get(self, url, referer, headers=None):
         headers = headers or {}
@@ -23,4 +143,64 @@ class Client(object):
 
         if referer:
             headers['Referer'] = referer
-        return requests.get(url, headers=headers, proxies=self.proxies)
+
+        if self.cache is None:
+            return self.fetch(url, headers)
+
+        for k, v in self.cache.conditional_headers(url).items():
+            headers.setdefault(k, v)
+        resp = self.fetch(url, headers)
+        if resp.status_code == 304:
+            return self.cache.cached_response(url) or resp
+        self.cache.store(url, resp)
+        return resp
+
+    def fetch(self, url, headers):
+        """
+        Fetch ``url``, streaming the body. Reports time to first byte (the
+        time until the response headers were parsed, including DNS and
+        connect), body download time, body size and status to ``metrics``.
+        """
+        if not self.max_per_host:
+            return self.fetch_body(url, headers)
+        scheme, host = urlsplit(url)[:2]
+        proxy = self.proxies and self.proxies.get(scheme)
+        with connection_limits.slot((host.lower(), proxy),
+                                    self.max_per_host):
+            return self.fetch_body(url, headers)
+
+    def fetch_body(self, url, headers):
+        resp = self.session.get(url, headers=headers, proxies=self.proxies,
+                                timeout=self.timeout, stream=True)
+        registry = metrics.registry
+        registry.observe('itsy_fetch_ttfb_seconds',
+                         resp.elapsed.total_seconds())
+        registry.inc('itsy_responses_total', status=resp.status_code)
+        try:
+            check_content_type(resp.headers.get('Content-Type'),
+                               self.content_types)
+            limit = self.max_body_size
+            if limit:
+                length = resp.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > limit:
+                    raise ResponseTooLarge(url)
+
+            start = time.time()
+            chunks = []
+            size = 0
+            for chunk in resp.iter_content(self.chunk_size):
+                size += len(chunk)
+                if limit and size > limit:
+                    raise ResponseTooLarge(url)
+                chunks.append(chunk)
+            resp._content = b''.join(chunks)
+            registry.observe('itsy_fetch_download_seconds',
+                             time.time() - start)
+            registry.inc('itsy_fetch_bytes_total', size)
+            resp._content_consumed = True
+            return resp
+        finally:
+            resp.close()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,51 @@
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    string_types = basestring
+    text_type = unicode
+
+    from urlparse import (urlparse, urlunparse, urlsplit, urlunsplit,
+                          parse_qs)
+    from urllib import urlencode
+else:
+    string_types = str
+    text_type = str
+
+    from urllib.parse import (urlparse, urlunparse, urlsplit, urlunsplit,
+                              parse_qs, urlencode)
+
+
+def to_bytes(s, encoding='utf-8'):
+    if isinstance(s, text_type):
+        return s.encode(encoding)
+    return s
+
+
+def to_text(s, encoding='utf-8'):
+    if isinstance(s, bytes):
+        return s.decode(encoding)
+    return s
+
+
+def gevent_patched():
+    """
+    Return whether the process has been monkey-patched for gevent, without
+    importing gevent if it hasn't been.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def make_semaphore(value=1):
+    """
+    Return a semaphore which only blocks the current greenlet if the process
+    has been patched for gevent, since workers share one thread, and
+    otherwise blocks the current thread.
+    """
+    if gevent_patched():
+        from gevent.lock import BoundedSemaphore
+        return BoundedSemaphore(value)
+    import threading
+    return threading.BoundedSemaphore(value)
@@ -0,0 +1,35 @@
+from .lru import LRUCache
+
+
+def make_selector(css):
+    from lxml.cssselect import CSSSelector
+    return CSSSelector(css, translator='html')
+
+
+class SelectorCache(object):
+    """
+    LRU cache of compiled CSS selectors. Compiling a selector translates it to
+    XPath, which is far more expensive than evaluating it, and handlers reuse
+    the same few selectors on every page.
+    """
+    def __init__(self, maxsize=1024):
+        self.selectors = LRUCache(maxsize)
+
+    def get(self, css):
+        return self.selectors.lookup(css, make_selector)
+
+    def stats(self):
+        return self.selectors.stats()
+
+    def clear(self):
+        self.selectors.clear()
+
+
+cache = SelectorCache()
+
+
+def compile_selector(css):
+    """
+    Return a compiled ``CSSSelector`` for ``css`` from the process-wide cache.
+    """
+    return cache.get(css)
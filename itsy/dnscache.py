@@ -0,0 +1,73 @@
+"""
+Process-wide DNS cache. Call ``cache.install()``, or create a ``Client``
+with ``dns_cache=True``, to replace ``socket.getaddrinfo`` with ``cache``,
+so that every worker's requests share resolved addresses instead of hitting
+the resolver on every fetch.
+"""
+import logging
+
+import socket
+import time
+
+from .lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+class DNSCache(object):
+    """
+    Caching wrapper for ``socket.getaddrinfo``. Results are kept for ``ttl``
+    seconds, and failed lookups for ``negative_ttl`` seconds, in an LRU cache
+    of ``maxsize`` entries. Concurrent lookups of the same name are made
+    once.
+
+    ``getaddrinfo`` doesn't report record TTLs, so ``ttl`` is a fixed upper
+    bound on how long a changed DNS record may be ignored.
+    """
+    def __init__(self, ttl=300, negative_ttl=30, maxsize=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = LRUCache(maxsize, expires=self.expiry, coalesce=True)
+        self.resolve = None
+
+    def install(self):
+        """
+        Replace ``socket.getaddrinfo`` with this cache. May be called again,
+        e.g. after gevent has patched the socket module, to wrap the current
+        ``getaddrinfo``.
+        """
+        if socket.getaddrinfo != self.getaddrinfo:
+            self.resolve = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if socket.getaddrinfo == self.getaddrinfo:
+            socket.getaddrinfo = self.resolve
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        result, error = self.entries.lookup(key, self.fetch)
+        if error is not None:
+            raise socket.gaierror(*error)
+        return list(result)
+
+    def fetch(self, key):
+        try:
+            return self.resolve(*key), None
+        except socket.gaierror as e:
+            log.debug("Failed resolving %s: %r", key[0], e)
+            return None, e.args
+
+    def expiry(self, entry):
+        result, error = entry
+        return time.time() + (self.ttl if error is None
+                              else self.negative_ttl)
+
+    def stats(self):
+        return self.entries.stats()
+
+    def clear(self):
+        self.entries.clear()
+
+
+cache = DNSCache()
@@ -1,11 +1,15 @@
-from . import parsers
+import time
+
+from . import metrics, parsers
+from .compat import string_types
+from .css import compile_selector
 
 
 class ExtractorMixin(object):
 
     def x(self, selector, parser='string'):
         if selector:
-            elements = self.lxml.cssselect(selector)
+            elements = compile_selector(selector)(self.lxml)
         else:
             elements = [self.lxml]
 
@@ -14,11 +18,46 @@ class ExtractorMixin(object):
         elif parser == 'element':
             assert len(elements) == 1
             return Fragment(elements[0])
-        elif isinstance(parser, basestring):
+        elif isinstance(parser, string_types):
             return getattr(parsers, parser)(elements)
         else:
             return parser(elements)
 
+    def extract(self, rows, fields):
+        """
+        Extract a table of values from a list page in one pass. For each
+        element matching the ``rows`` selector, each of ``fields``, a dict
+        mapping field names to ``(selector, parser)`` pairs, is extracted
+        from the elements matching ``selector`` within the row (or the row
+        itself if ``selector`` is None) using ``parser``, which is the name
+        of a function in ``itsy.parsers`` or a callable.
+
+        Returns a dict mapping field names to lists of values, one per row.
+        Values are None where the selector matches nothing or the parser
+        fails, so one malformed row doesn't lose the whole page.
+        """
+        columns = []
+        for name, (selector, parser) in fields.items():
+            if isinstance(parser, string_types):
+                parser = getattr(parsers, parser)
+            columns.append((name,
+                            compile_selector(selector) if selector else None,
+                            parser, []))
+
+        for row in compile_selector(rows)(self.lxml):
+            for name, selector, parser, values in columns:
+                elements = selector(row) if selector else [row]
+                value = None
+                if elements:
+                    try:
+                        value = parser(elements)
+                    except (ValueError, ArithmeticError, KeyError):
+                        pass
+                values.append(value)
+
+        return dict((name, values) for name, selector, parser, values
+                    in columns)
+
 
 class Fragment(ExtractorMixin):
 
@@ -27,25 +66,99 @@ class Fragment(ExtractorMixin):
 
 
 class Document(ExtractorMixin):
+    """
+    A fetched page handed to handlers. The decoded text, parsed HTML tree and
+    parsed JSON are each built lazily on first access and then cached, so
+    handlers can use ``x()``, ``lxml`` and ``json`` repeatedly for free.
+    """
+    missing = object()
 
     def __init__(self, task, resp):
         self.task = task
         self.resp = resp
-        self.raw = resp.text
+        self._raw = None
+        self._lxml = None
+        self._json = self.missing
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = self.resp.text
+        return self._raw
 
     @property
     def json(self):
-        import simplejson
-        return simplejson.loads(self.raw)
+        if self._json is self.missing:
+            import simplejson
+            self._json = simplejson.loads(self.raw)
+        return self._json
 
     @property
     def lxml(self):
-        from lxml.html import fromstring
-        doc = fromstring(self.raw)
+        if self._lxml is None:
+            self._lxml = self.parse()
+        return self._lxml
+
+    def parse(self):
+        """
+        Parse the response into an HTML tree with absolute links. Parses from
+        the raw response bytes unless the body has already been decoded, so
+        that the text decode can be skipped: a charset declared in the
+        Content-Type header is passed on to the parser, otherwise or if it is
+        unknown lxml detects the encoding itself.
+        """
+        from lxml.html import fromstring, HTMLParser
+        start = time.time()
+        if self._raw is not None:
+            doc = fromstring(self._raw)
+        else:
+            content_type = self.resp.headers.get('Content-Type', '')
+            parser = None
+            if 'charset=' in content_type.lower() and self.resp.encoding:
+                try:
+                    parser = HTMLParser(encoding=self.resp.encoding)
+                except LookupError:
+                    # An unknown charset, which resp.text also ignores.
+                    pass
+            doc = fromstring(self.resp.content, parser=parser)
         doc.make_links_absolute(self.task.url)
+        metrics.registry.observe('itsy_parse_seconds', time.time() - start)
         return doc
 
+    def iterparse(self, tag=None, html=False, chunk_size=64 * 1024):
+        """
+        Incrementally parse the response, yielding a ``Fragment`` for each
+        completed element matching ``tag`` (which may use ``{*}`` as a
+        namespace wildcard, e.g. ``'{*}loc'`` for sitemaps). The body is fed
+        to the parser ``chunk_size`` bytes at a time, and each element is
+        cleared once the caller moves on, so very large documents can be
+        processed without building the whole tree.
+
+        This bounds the memory used by the tree, not by the body: ``Client``
+        reads the raw body into memory in full, up to its ``max_body_size``,
+        before the handler runs, so set that to cap it.
+        """
+        from lxml import etree
+        if html:
+            parser = etree.HTMLPullParser(tag=tag, huge_tree=True)
+        else:
+            parser = etree.XMLPullParser(tag=tag, huge_tree=True)
+        content = self.resp.content
+        for offset in range(0, len(content), chunk_size):
+            parser.feed(content[offset:offset + chunk_size])
+            for fragment in self.read_events(parser):
+                yield fragment
+        parser.close()
+        for fragment in self.read_events(parser):
+            yield fragment
+
+    def read_events(self, parser):
+        for event, el in parser.read_events():
+            yield Fragment(el)
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
     def extract_links(self, cls):
-        from lxml.cssselect import CSSSelector
-        sel = CSSSelector(cls)
+        sel = compile_selector(cls)
         return [el.attrib['href'] for el in sel(self.lxml)]
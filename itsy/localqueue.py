@@ -0,0 +1,508 @@
+"""
+An embedded queue backend for single process crawls, which needs no Redis.
+"""
+import os
+import time
+import hashlib
+from heapq import heappush, heappop
+
+import msgpack
+
+from . import metrics
+from .compat import to_bytes
+from .queue import BaseQueue
+from .scheduler import domain_for_url
+
+LOG_HEADER = ['itsy-local-queue', 1]
+
+# Fields of a queued task record.
+DATA, SCORE, HIGH_PRIORITY, DIGEST, REPEAT, MIN_AGE, DOMAIN = range(7)
+
+
+class LocalQueue(BaseQueue):
+    """
+    Queue kept in memory in this process, with the same deduplication,
+    high priority, deferral, ``min_age``, ``repeat_after`` and per-domain
+    fairness semantics as the Redis ``Queue``. Queued tasks are held in
+    heaps, so push and pop are cheap local operations rather than network
+    round trips.
+
+    If ``path`` is given, every change is appended to a log file there, which
+    is replayed on startup so that the crawl survives restarts. The log is
+    compacted into a snapshot of the live state once it has grown to
+    ``compact_ratio`` times the size of that state. Writes are flushed to the
+    OS after each operation; set ``fsync`` to also sync them to disk.
+
+    Per-domain virtual time, next-allowed-fetch times, leases and robots.txt
+    files aren't logged, so they start afresh after a restart, and tasks
+    which were leased are handed out again. A ``LocalQueue`` can't be shared
+    by several processes.
+    """
+    compact_ratio = 4
+    compact_min = 10000
+
+    def __init__(self, name, path=None, url_canonicalizer=None,
+                 domain_weight=1, domain_delay=0, fsync=False):
+        BaseQueue.__init__(self, name, url_canonicalizer, domain_weight,
+                           domain_delay)
+        self.path = path
+        self.fsync = fsync
+        # task_id -> task record, see the field indexes above
+        self.tasks = {}
+        # URL digest -> (task_id, high_priority) of the queued task
+        self.taskbyurl = {}
+        # URL digest -> last crawl timestamp
+        self.urlts = {}
+        # domain -> {'weight': ..., 'delay': ...}
+        self.settings = {}
+        # task_id -> number of failed attempts
+        self.attempts = {}
+        # domain -> (expires, robots.txt text)
+        self.robots_files = {}
+        self.reset_schedule()
+        self.log = None
+        self.log_records = 0
+        if path:
+            self.open_log()
+
+    def reset_schedule(self):
+        # Heaps of (score, task_id), which may contain stale entries for
+        # tasks that have since been moved or removed.
+        self.hp = []
+        self.todo = {}
+        # Domain scheduling, as in the Redis queue: where maps each
+        # scheduled domain to ('ready', vtime) or ('waiting', eligible), and
+        # the heaps may contain stale entries which don't match it.
+        self.where = {}
+        self.ready = []
+        self.waiting = []
+        self.vtime = {}
+        self.next_allowed = {}
+        self.vclock = 0
+        # task_id -> lease expiry time, and a heap of (expiry, task_id)
+        # which may contain stale entries.
+        self.leases = {}
+        self.expiries = []
+
+    # Persistence
+
+    def open_log(self):
+        self.packer = msgpack.Packer(use_bin_type=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.replay(f)
+        for task_id, record in self.tasks.items():
+            self.enqueue(task_id, record)
+        for domain in list(self.todo):
+            self.reschedule_domain(domain, None, 0)
+        # Start from a fresh snapshot, which also drops any partial record
+        # left at the end of the log by a crash mid-write.
+        self.compact()
+
+    def replay(self, f):
+        unpacker = msgpack.Unpacker(f, raw=False)
+        if next(unpacker, None) != LOG_HEADER:
+            raise ValueError('%s is not a queue log' % self.path)
+        tasks = self.tasks
+        for record in unpacker:
+            op = record[0]
+            if op == 'add':
+                task_id = record[1]
+                tasks[task_id] = record[2:]
+                self.taskbyurl[record[2 + DIGEST]] = \
+                    (task_id, record[2 + HIGH_PRIORITY])
+            elif op == 'del':
+                self.drop_task(record[1])
+            elif op == 'move':
+                self.requeue(record[1], record[2])
+                self.attempts.pop(record[1], None)
+            elif op == 'retry':
+                self.requeue(record[1], record[2])
+                self.attempts[record[1]] = record[3]
+            elif op == 'ts':
+                self.urlts[record[1]] = record[2]
+            elif op == 'set':
+                self.settings.setdefault(record[1], {})[record[2]] = \
+                    record[3]
+
+    def compact_threshold(self):
+        live = len(self.tasks) + len(self.urlts) + len(self.settings)
+        return max(self.compact_ratio * live, self.compact_min)
+
+    def compact(self):
+        """
+        Rewrite the log as a snapshot of the current state.
+        """
+        if self.log is not None:
+            self.log.close()
+        tmp_path = self.path + '.tmp'
+        packer = msgpack.Packer(use_bin_type=True)
+        records = 0
+        with open(tmp_path, 'wb') as f:
+            f.write(packer.pack(LOG_HEADER))
+            for task_id, record in self.tasks.items():
+                f.write(packer.pack(['add', task_id] + record))
+                records += 1
+            for task_id, attempts in self.attempts.items():
+                f.write(packer.pack(['retry', task_id,
+                                     self.tasks[task_id][SCORE], attempts]))
+                records += 1
+            for digest, ts in self.urlts.items():
+                f.write(packer.pack(['ts', digest, ts]))
+                records += 1
+            for domain, settings in self.settings.items():
+                for key, value in settings.items():
+                    f.write(packer.pack(['set', domain, key, value]))
+                    records += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.log = open(self.path, 'ab')
+        self.log_records = records
+
+    def write(self, *records):
+        if self.log is None:
+            return
+        for record in records:
+            self.log.write(self.packer.pack(record))
+        self.log_records += len(records)
+
+    def commit(self):
+        if self.log is None:
+            return
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+        if self.log_records > self.compact_threshold():
+            self.compact()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    # Task storage
+
+    def enqueue(self, task_id, record):
+        if record[HIGH_PRIORITY]:
+            heappush(self.hp, (record[SCORE], task_id))
+        else:
+            heappush(self.todo.setdefault(record[DOMAIN], []),
+                     (record[SCORE], task_id))
+
+    def requeue(self, task_id, score):
+        """
+        Move a task to its domain's queue, due at ``score``. The caller must
+        ``enqueue`` it, unless replaying the log.
+        """
+        record = self.tasks[task_id]
+        record[SCORE] = score
+        record[HIGH_PRIORITY] = False
+        self.taskbyurl[record[DIGEST]] = (task_id, False)
+        return record
+
+    def is_current(self, entry, high_priority):
+        record = self.tasks.get(entry[1])
+        return (record is not None and record[SCORE] == entry[0] and
+                record[HIGH_PRIORITY] == high_priority and
+                entry[1] not in self.leases)
+
+    def first_due(self, heap, high_priority):
+        """
+        Return the first current ``(score, task_id)`` entry in ``heap``,
+        discarding stale entries, or None if it's empty.
+        """
+        while heap:
+            if self.is_current(heap[0], high_priority):
+                return heap[0]
+            heappop(heap)
+
+    def drop_task(self, task_id):
+        record = self.tasks.pop(task_id)
+        self.attempts.pop(task_id, None)
+        self.leases.pop(task_id, None)
+        if self.taskbyurl.get(record[DIGEST], (None,))[0] == task_id:
+            del self.taskbyurl[record[DIGEST]]
+
+    # Domain scheduling
+
+    def reschedule_domain(self, domain, vtime, now):
+        """
+        Move ``domain`` to the ready or waiting set according to its earliest
+        queued task and next allowed fetch time, or drop it from the schedule
+        if it has no tasks.
+        """
+        heap = self.todo.get(domain)
+        first = heap and self.first_due(heap, False)
+        if not first:
+            self.where.pop(domain, None)
+            self.todo.pop(domain, None)
+            return
+        eligible = max(self.next_allowed.get(domain, 0), first[0])
+        if vtime is not None and eligible <= now:
+            self.where[domain] = ('ready', vtime)
+            heappush(self.ready, (vtime, domain))
+        else:
+            self.where[domain] = ('waiting', eligible)
+            heappush(self.waiting, (eligible, domain))
+
+    def is_ready(self, domain):
+        place = self.where.get(domain)
+        return place is not None and place[0] == 'ready'
+
+    def top(self, heap, state):
+        while heap:
+            score, domain = heap[0]
+            if self.where.get(domain) == (state, score):
+                return heap[0]
+            heappop(heap)
+
+    def setting(self, domain, key, default):
+        return self.settings.get(domain, {}).get(key, default)
+
+    # Queue interface
+
+    def push_many(self, tasks):
+        start = time.time()
+        results = [self.is_allowed(task) and self.push_one(task)
+                   for task in tasks]
+        self.commit()
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='push_many')
+        metrics.registry.inc('itsy_queue_pushed_total', sum(results))
+        return results
+
+    def push_one(self, task):
+        task_id = task.task_id
+        high_priority = bool(task.high_priority)
+        scheduled = float(task.scheduled_timestamp)
+        canonical = self.canonicalize_url(task.url)
+        digest = hashlib.md5(to_bytes(canonical)).digest()
+        domain = domain_for_url(canonical)
+
+        existing_id, existing_hp = self.taskbyurl.get(digest, (None, None))
+        existing = existing_id and self.tasks.get(existing_id)
+        if existing and existing_id in self.leases:
+            # The task is being fetched right now.
+            return False
+
+        if not high_priority:
+            if existing and existing_hp:
+                return False
+            if task.min_age:
+                last = self.urlts.get(digest)
+                if last is not None:
+                    scheduled = max(last + task.min_age, scheduled)
+            if existing and existing[SCORE] <= scheduled:
+                return False
+
+        records = []
+        if existing:
+            self.drop_task(existing_id)
+            records.append(['del', existing_id])
+
+        record = [self.serialize(task), scheduled, high_priority, digest,
+                  task.repeat_after or 0, task.min_age or 0, domain]
+        self.tasks[task_id] = record
+        self.taskbyurl[digest] = (task_id, high_priority)
+        self.enqueue(task_id, record)
+        records.append(['add', task_id] + record)
+        self.write(*records)
+
+        # Update the domain's place in the schedule, unless it's already
+        # ready.
+        if (existing and not existing_hp) or not high_priority:
+            if not self.is_ready(domain):
+                self.reschedule_domain(domain, None, 0)
+        return True
+
+    def pop_task(self, task_id, now):
+        expiry = now + self.lease_timeout
+        self.leases[task_id] = expiry
+        heappush(self.expiries, (expiry, task_id))
+        return self.tasks[task_id][DATA]
+
+    def retry_task(self, task_id, now):
+        """
+        Put a leased task back in its domain's queue after a backoff, or drop
+        it if it has failed too many times. Returns True if it will be
+        retried.
+        """
+        del self.leases[task_id]
+        attempts = self.attempts.get(task_id, 0) + 1
+        if attempts > self.max_retries:
+            self.drop_task(task_id)
+            self.write(['del', task_id])
+            return False
+        record = self.requeue(task_id, now + self.backoff(attempts))
+        self.enqueue(task_id, record)
+        self.attempts[task_id] = attempts
+        self.write(['retry', task_id, record[SCORE], attempts])
+        if not self.is_ready(record[DOMAIN]):
+            self.reschedule_domain(record[DOMAIN], None, now)
+        return True
+
+    def expire_leases(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, task_id = heappop(self.expiries)
+            if self.leases.get(task_id) == expiry:
+                self.retry_task(task_id, now)
+
+    def pop_many(self, n):
+        start = time.time()
+        now = start
+        popped = []
+        self.expire_leases(now)
+
+        while len(popped) < n:
+            entry = self.first_due(self.hp, True)
+            if not entry or entry[0] > now:
+                break
+            heappop(self.hp)
+            popped.append(self.pop_task(entry[1], now))
+
+        # Domains which have become eligible join the ready set, no earlier
+        # than the current virtual time so that they can't starve the others.
+        while True:
+            entry = self.top(self.waiting, 'waiting')
+            if not entry or entry[0] > now:
+                break
+            heappop(self.waiting)
+            domain = entry[1]
+            vtime = max(self.vtime.get(domain, 0), self.vclock)
+            self.where[domain] = ('ready', vtime)
+            heappush(self.ready, (vtime, domain))
+
+        while len(popped) < n:
+            entry = self.top(self.ready, 'ready')
+            if not entry:
+                break
+            vtime, domain = entry
+            heap = self.todo.get(domain)
+            first = heap and self.first_due(heap, False)
+            if first and first[0] <= now:
+                heappop(heap)
+                popped.append(self.pop_task(first[1], now))
+                self.vclock = vtime
+                vtime += 1.0 / self.setting(domain, 'weight',
+                                            self.domain_weight)
+                self.vtime[domain] = vtime
+                self.next_allowed[domain] = now + self.setting(
+                    domain, 'delay', self.domain_delay)
+            self.reschedule_domain(domain, vtime, now)
+
+        self.commit()
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='pop_many')
+        metrics.registry.inc('itsy_queue_popped_total', len(popped))
+        return [self.deserialize(s) for s in popped]
+
+    def ack(self, task):
+        now = time.time()
+        task_id = task.task_id
+        record = self.tasks.get(task_id)
+        if record is None:
+            return False
+        if self.leases.pop(task_id, None) is None and record[HIGH_PRIORITY]:
+            return False
+        digest = record[DIGEST]
+        self.urlts[digest] = int(now)
+        records = [['ts', digest, int(now)]]
+        if record[REPEAT] > 0:
+            self.requeue(task_id, now + max(record[REPEAT], record[MIN_AGE]))
+            self.enqueue(task_id, record)
+            self.attempts.pop(task_id, None)
+            records.append(['move', task_id, record[SCORE]])
+        else:
+            self.drop_task(task_id)
+            records.append(['del', task_id])
+        self.write(*records)
+        if not self.is_ready(record[DOMAIN]):
+            self.reschedule_domain(record[DOMAIN], None, now)
+        self.commit()
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - now, op='ack')
+        return True
+
+    def fail(self, task):
+        task_id = task.task_id
+        if task_id not in self.leases:
+            return False
+        retried = self.retry_task(task_id, time.time())
+        self.commit()
+        metrics.registry.inc('itsy_queue_failed_total')
+        return retried
+
+    def release(self, task, delay=0):
+        task_id = task.task_id
+        if self.leases.pop(task_id, None) is None:
+            return False
+        now = time.time()
+        record = self.tasks[task_id]
+        if delay > 0:
+            self.requeue(task_id, now + delay)
+            attempts = self.attempts.get(task_id)
+            if attempts:
+                self.write(['retry', task_id, record[SCORE], attempts])
+            else:
+                self.write(['move', task_id, record[SCORE]])
+        self.enqueue(task_id, record)
+        if not record[HIGH_PRIORITY] and not self.is_ready(record[DOMAIN]):
+            self.reschedule_domain(record[DOMAIN], None, now)
+        self.commit()
+        return True
+
+    def count(self):
+        high = normal = 0
+        for task_id, record in self.tasks.items():
+            if task_id in self.leases:
+                continue
+            if record[HIGH_PRIORITY]:
+                high += 1
+            else:
+                normal += 1
+        return {'high': high,
+                'normal': normal}
+
+    def get_task(self, task_id):
+        record = self.tasks.get(task_id)
+        if record is not None:
+            return self.deserialize(record[DATA])
+
+    def record_crawl_timestamp(self, url, now):
+        digest = self.hash_url(url)
+        self.urlts[digest] = int(now)
+        self.write(['ts', digest, int(now)])
+        self.commit()
+
+    def get_crawl_timestamps(self, urls):
+        return [self.urlts.get(self.hash_url(url)) for url in urls]
+
+    def get_existing_task_ids(self, urls):
+        return [self.taskbyurl.get(self.hash_url(url), (None, None))
+                for url in urls]
+
+    def set_domain_weight(self, domain, weight):
+        """
+        Set the share of pops given to ``domain`` relative to other domains
+        with due tasks, which have a weight of ``domain_weight`` by default.
+        """
+        self.set_domain_setting(domain, 'weight', weight)
+
+    def set_domain_delay(self, domain, delay):
+        """
+        Set the minimum number of seconds between tasks for ``domain`` being
+        handed out.
+        """
+        self.set_domain_setting(domain, 'delay', delay)
+
+    def get_robots(self, domain):
+        return self.robots_files.get(domain)
+
+    def set_robots(self, domain, expires, text):
+        self.robots_files[domain] = (expires, text)
+
+    def set_domain_setting(self, domain, key, value):
+        self.settings.setdefault(domain, {})[key] = value
+        self.write(['set', domain, key, value])
+        self.commit()
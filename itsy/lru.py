@@ -0,0 +1,122 @@
+"""
+The LRU cache behind itsy's process-wide caches of compiled selectors,
+canonical URLs, DNS lookups and robots.txt rules.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .compat import make_semaphore
+
+
+class KeyedLocks(object):
+    """
+    A lock per key, so that work for one key doesn't hold up other keys.
+    Locks are created on demand and dropped once nobody holds or waits for
+    them.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key, value=1):
+        """
+        Hold the lock for ``key``, or one of ``value`` slots if it is
+        created as a semaphore by this call.
+        """
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [make_semaphore(value), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of up to ``maxsize`` values, made on demand by
+    ``lookup()``, which counts hits and misses for ``stats()``.
+
+    If ``expires`` is given, it's called with each new value to get the time
+    at which it goes stale. If ``coalesce`` is set, concurrent misses for the
+    same key wait for one call to make the value, which is worth it when
+    making values does I/O.
+    """
+    missing = object()
+
+    def __init__(self, maxsize, expires=None, coalesce=False):
+        self.maxsize = maxsize
+        self.expires = expires
+        self.locks = KeyedLocks() if coalesce else None
+        # key -> (expiry time or None, value)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value for ``key`` if it's cached and fresh, marking it as
+        recently used, or ``default``.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        if entry[0] is not None and entry[0] <= time.time():
+            return default
+        self.entries[key] = entry
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.maxsize:
+            self.entries.popitem(last=False)
+        expires = self.expires(value) if self.expires else None
+        self.entries[key] = (expires, value)
+
+    def lookup(self, key, create):
+        """
+        Return the value for ``key``, calling ``create(key)`` to make and
+        cache it if it isn't cached or has gone stale.
+        """
+        value = self.get(key, self.missing)
+        if value is not self.missing:
+            self.hits += 1
+            return value
+        if self.locks is None:
+            return self.create(key, create)
+        with self.locks.hold(key):
+            value = self.get(key, self.missing)
+            if value is not self.missing:
+                self.hits += 1
+                return value
+            return self.create(key, create)
+
+    def create(self, key, create):
+        self.misses += 1
+        value = create(key)
+        self.set(key, value)
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
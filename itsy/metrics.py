@@ -0,0 +1,256 @@
+"""
+Counters, gauges and latency histograms for the crawl hot paths.
+
+Metrics are disabled by default: instrumented code reports to
+``metrics.registry``, which is a ``NullRegistry`` that discards everything
+until ``enable()`` is called. Enabled metrics can be exposed in Prometheus
+text format with ``serve()``, or summarized periodically to the log with
+``log_summary()``.
+"""
+import logging
+
+import time
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+
+
+class NullRegistry(object):
+    """
+    Registry used while metrics are disabled. Every method is a no-op.
+    """
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for ii, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            ii = len(self.buckets)
+        self.counts[ii] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(NullRegistry):
+    """
+    Registry which records metrics in memory. Series are identified by name
+    and keyword labels.
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(key,
+                                                  Histogram(self.buckets))
+        hist.observe(value)
+
+    def total(self, name):
+        """
+        Return the sum of a counter over all of its label values.
+        """
+        return sum(v for (n, key), v in list(self.counters.items())
+                   if n == name)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, key), value in sorted(self.counters.items()):
+            add_type(name, 'counter')
+            lines.append('%s%s %s' % (name, format_labels(key),
+                                      format_value(value)))
+        for (name, key), value in sorted(self.gauges.items()):
+            add_type(name, 'gauge')
+            lines.append('%s%s %s' % (name, format_labels(key),
+                                      format_value(value)))
+        for (name, key), hist in sorted(self.histograms.items()):
+            add_type(name, 'histogram')
+            cumulative = 0
+            bounds = list(hist.buckets) + [float('inf')]
+            for bound, n in zip(bounds, hist.counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(key, [('le', format_value(bound))]),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(key),
+                                          format_value(hist.sum)))
+            lines.append('%s_count%s %d' % (name, format_labels(key),
+                                            hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = NullRegistry()
+
+
+def start_background(target, name):
+    """
+    Run ``target`` in a greenlet if the process has been patched for gevent,
+    otherwise in a daemon thread.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        pass
+    else:
+        if monkey.is_module_patched('socket'):
+            import gevent
+            return gevent.spawn(target)
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def enable(buckets=DEFAULT_BUCKETS):
+    """
+    Start recording metrics, returning the new ``Registry``.
+    """
+    global registry
+    registry = Registry(buckets)
+    return registry
+
+
+def disable():
+    global registry
+    registry = NullRegistry()
+
+
+def serve(port=9100, host=''):
+    """
+    Serve the current registry in Prometheus text format over HTTP in the
+    background. Returns the server.
+    """
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    start_background(server.serve_forever, 'itsy-metrics')
+    return server
+
+
+def log_summary(interval=60, queue=None):
+    """
+    Log a summary of throughput, latencies and (if ``queue`` is given) queue
+    depth every ``interval`` seconds in the background. When crawling with
+    gevent, call this after ``itsy.worker.patch()`` so the queue is polled
+    from a greenlet rather than a thread.
+    """
+    def run():
+        last_tasks = registry.total('itsy_tasks_total')
+        last_time = time.time()
+        while True:
+            time.sleep(interval)
+            if not registry.enabled:
+                continue
+            now = time.time()
+            tasks = registry.total('itsy_tasks_total')
+            rate = (tasks - last_tasks) / (now - last_time)
+            last_tasks, last_time = tasks, now
+            if queue is not None:
+                for level, depth in queue.count().items():
+                    registry.set('itsy_queue_depth', depth, priority=level)
+            log.info("%0.1f tasks/sec, %d tasks total", rate, tasks)
+            for (name, key), hist in sorted(registry.histograms.items()):
+                log.info("  %s%s: n=%d mean=%0.4fs p50<=%s p99<=%s",
+                         name, format_labels(key), hist.count,
+                         hist.sum / hist.count if hist.count else 0,
+                         hist.quantile(0.5), hist.quantile(0.99))
+            for (name, key), value in sorted(registry.gauges.items()):
+                log.info("  %s%s: %s", name, format_labels(key), value)
+
+    return start_background(run, 'itsy-metrics-log')
@@ -1,13 +1,37 @@
+import re
 from decimal import Decimal, InvalidOperation
 from datetime import datetime
 
-import iso8601
+from .compat import string_types
+
+# Whitespace separated tokens which are a number, optionally with thousands
+# separators, or a currency amount, e.g. "$1,200", "$.99", "$12." or "$-5".
+# Tokens in other forms which int() or Decimal() accept, such as "$1e3", are
+# found by falling back to trying each token in turn.
+INTEGER_RE = re.compile(r'(?<!\S)[-+]?[\d,]*\d[\d,]*(?!\S)')
+CURRENCY_RE = re.compile(u'(?<!\\S)([$\xa3])'
+                         r'([-+]?(?=[\d,.]*\d)[\d,]*(?:\.[\d,]*)?)(?!\S)',
+                         re.UNICODE)
+CURRENCY_UNITS = {u'$': 'usd', u'\xa3': 'gbp'}
+
+# Cache of parsed dates by (string, format), since strptime is slow and list
+# pages tend to repeat the same few dates.
+date_cache = {}
+date_cache_size = 10000
+
+
+def text_content(el):
+    try:
+        return el.text_content()
+    except AttributeError:
+        # Plain XML elements, e.g. from Document.iterparse().
+        return ''.join(el.itertext())
 
 
 def string(els):
-    if isinstance(els, basestring):
+    if isinstance(els, string_types):
         return els.strip()
-    return ''.join(el.text_content().strip() for el in els)
+    return ''.join(text_content(el).strip() for el in els)
 
 
 def integer_single(s):
@@ -17,6 +41,9 @@ def integer_single(s):
 
 def integer(els):
     s = string(els)
+    m = INTEGER_RE.search(s)
+    if m is not None:
+        return int(m.group().replace(',', ''))
     for chunk in s.split():
         try:
             return integer_single(chunk)
@@ -25,12 +52,23 @@ def integer(els):
     raise ValueError("couldn't find an integer in: %r" % s)
 
 
-def calendar_date(els):
-    s = string(els)
-    return datetime.strptime(s, '%b %d, %Y')
+def strptime(s, format):
+    key = (s, format)
+    try:
+        return date_cache[key]
+    except KeyError:
+        if len(date_cache) >= date_cache_size:
+            date_cache.clear()
+        value = date_cache[key] = datetime.strptime(s, format)
+        return value
+
+
+def calendar_date(els, format='%b %d, %Y'):
+    return strptime(string(els), format)
 
 
 def isodate(els):
+    import iso8601
     s = string(els)
     return iso8601.parse_date(s)
 
@@ -54,6 +92,10 @@ def currency_single(s):
 
 def currency(els):
     s = string(els)
+    m = CURRENCY_RE.search(s)
+    if m is not None:
+        symbol, amount = m.groups()
+        return CURRENCY_UNITS[symbol], Decimal(amount.replace(',', ''))
     for chunk in s.split():
         try:
             return currency_single(chunk)
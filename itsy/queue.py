@@ -1,11 +1,18 @@
 import logging
 
 from datetime import timedelta
+import re
 import time
 import hashlib
-import pickle
+import binascii
+import zlib
 
-from redis import StrictRedis, WatchError
+import msgpack
+
+from . import metrics
+from .compat import to_bytes, to_text
+from .scheduler import domain_for_url
+from .urls import canonicalize_url
 
 log = logging.getLogger(__name__)
 
@@ -16,9 +23,20 @@ class Task(object):
     particular URL, with some additional properties governing request
     parameters and the scheduling of that crawl.
     """
+    __slots__ = ('url', 'method', 'data', 'document_type', 'referer',
+                 'high_priority', 'scheduled_timestamp', 'repeat_after',
+                 'min_age')
+
     DEFAULT_REFERER = object()
     DEFAULT_DOCUMENT_TYPE = object()
 
+    # Version byte prefixed to the packed representation.
+    PACK_VERSION = b'\x01'
+
+    FLAG_HIGH_PRIORITY = 1
+    FLAG_DEFAULT_REFERER = 2
+    FLAG_DEFAULT_DOCUMENT_TYPE = 4
+
     @staticmethod
     def to_integer_seconds(val):
         if isinstance(val, timedelta):
@@ -35,6 +53,8 @@ class Task(object):
             raise ValueError('task cannot be high priority and also deferred')
 
         self.url = url
+        self.method = method
+        self.data = data
         self.document_type = document_type
         self.referer = referer
         self.high_priority = high_priority
@@ -42,10 +62,78 @@ class Task(object):
         self.repeat_after = Task.to_integer_seconds(repeat_after)
         self.min_age = Task.to_integer_seconds(min_age)
 
+    @property
+    def task_id(self):
+        """
+        Identifier derived from the fields which determine the request, so
+        that it doesn't depend on scheduling parameters. Strings are packed
+        as text, so that on Python 2 ``str`` and ``unicode`` give the same
+        ID, as do tasks which have been through ``unpack()``.
+        """
+        data = self.data
+        if isinstance(data, dict):
+            data = sorted(data.items())
+        document_type = self.document_type
+        if document_type is self.DEFAULT_DOCUMENT_TYPE:
+            document_type = None
+        s = msgpack.packb([to_text(self.url), to_text(self.method), data,
+                           to_text(document_type)],
+                          use_bin_type=True)
+        return hashlib.md5(s).hexdigest()
+
+    def pack(self):
+        """
+        Serialize to a compact, versioned binary representation. Strings
+        are packed as text, so that Python 2 and 3 write the same encoding.
+        """
+        flags = 0
+        referer = self.referer
+        document_type = self.document_type
+        if self.high_priority:
+            flags |= self.FLAG_HIGH_PRIORITY
+        if referer is self.DEFAULT_REFERER:
+            flags |= self.FLAG_DEFAULT_REFERER
+            referer = None
+        if document_type is self.DEFAULT_DOCUMENT_TYPE:
+            flags |= self.FLAG_DEFAULT_DOCUMENT_TYPE
+            document_type = None
+        return self.PACK_VERSION + msgpack.packb(
+            [to_text(self.url), to_text(self.method), self.data,
+             to_text(document_type), to_text(referer), flags,
+             self.scheduled_timestamp, self.repeat_after, self.min_age],
+            use_bin_type=True)
+
+    @classmethod
+    def unpack(cls, s):
+        """
+        Deserialize a task from the output of ``pack()``.
+        """
+        if s[:1] != cls.PACK_VERSION:
+            raise ValueError('unknown task encoding: %r' % s[:1])
+        (url, method, data, document_type, referer, flags,
+         scheduled_timestamp, repeat_after, min_age) = \
+            msgpack.unpackb(s[1:], raw=False)
+
+        task = cls.__new__(cls)
+        task.url = url
+        task.method = method
+        task.data = data
+        task.document_type = document_type
+        task.referer = referer
+        task.high_priority = bool(flags & cls.FLAG_HIGH_PRIORITY)
+        task.scheduled_timestamp = scheduled_timestamp
+        task.repeat_after = repeat_after
+        task.min_age = min_age
+        if flags & cls.FLAG_DEFAULT_REFERER:
+            task.referer = cls.DEFAULT_REFERER
+        if flags & cls.FLAG_DEFAULT_DOCUMENT_TYPE:
+            task.document_type = cls.DEFAULT_DOCUMENT_TYPE
+        return task
+
     def set_originating_task(self, task):
-        if self.referer == self.DEFAULT_REFERER:
+        if self.referer is self.DEFAULT_REFERER:
             self.referer = task.referer
-        if self.document_type == self.DEFAULT_DOCUMENT_TYPE:
+        if self.document_type is self.DEFAULT_DOCUMENT_TYPE:
             self.document_type = task.document_type
 
     def __repr__(self):
@@ -60,61 +148,764 @@ class Empty(Exception):
     pass
 
 
-class Queue(object):
+# Per-URL state lives in an index of hash buckets rather than one key per URL:
+# the first ``index_bucket_bytes`` of the URL digest pick the bucket key and
+# the rest of the binary digest is the field. See ``Queue.index_location``.
+#
+# ``taskbyurl`` fields hold the queued task ID followed by '1' or '0' for
+# whether it's high priority. ``urlts`` fields hold the last crawl timestamp.
+#
+# High priority tasks share one sorted set. Other tasks are kept in a sorted
+# set per domain, and domains are scheduled by two more sorted sets:
+# ``domains:ready`` holds domains with a due task which may be fetched now,
+# scored by virtual time, and ``domains:waiting`` holds the rest, scored by
+# when they will become ready. Each pop from a domain advances its virtual
+# time by 1 / weight, so ready domains take turns in proportion to their
+# weights. Per-domain state (virtual time, next allowed fetch, and any
+# configured weight and delay) is kept in a ``domain:<domain>`` hash.
+#
+# Popped tasks are leased rather than removed: they move to the ``leases``
+# sorted set, scored by when the lease expires, until they are acknowledged
+# (see ``ACK_SCRIPT``), fail and are retried (see ``FAIL_SCRIPT``) or are
+# handed back unfetched (see ``RELEASE_SCRIPT``). Expired leases are retried
+# by the next pop. Each task hash counts its failed ``attempts``.
+
+# Moves a domain to ``domains:ready`` or ``domains:waiting`` according to its
+# earliest queued task and next allowed fetch time, or drops it from the
+# schedule if it has no tasks. Shared by the scripts below.
+RESCHEDULE_DOMAIN = """
+local function reschedule_domain(prefix, domain, vtime, now)
+    local queue = prefix .. 'todo:nn:' .. domain
+    local ready = prefix .. 'domains:ready'
+    local waiting = prefix .. 'domains:waiting'
+    redis.call('ZREM', ready, domain)
+    local first = redis.call('ZRANGE', queue, 0, 0, 'WITHSCORES')
+    if #first == 0 then
+        redis.call('ZREM', waiting, domain)
+        return
+    end
+    local next_allowed = tonumber(redis.call('HGET',
+                                             prefix .. 'domain:' .. domain,
+                                             'next')) or 0
+    local eligible = math.max(next_allowed, tonumber(first[2]))
+    if vtime and eligible <= now then
+        redis.call('ZREM', waiting, domain)
+        redis.call('ZADD', ready, vtime, domain)
+    else
+        redis.call('ZADD', waiting, eligible, domain)
+    end
+end
+
+local function index_location(digest, bucket_bytes)
+    local bucket = string.format(string.rep('%02x', bucket_bytes),
+                                 string.byte(digest, 1, bucket_bytes))
+    return bucket, string.sub(digest, bucket_bytes + 1)
+end
+
+-- Puts a leased task back in its domain's queue to be retried after an
+-- exponential backoff, or drops it if it has failed too many times. Returns
+-- 1 if the task will be retried.
+local function retry_task(prefix, task_id, now, bucket_bytes, max_retries,
+                          retry_delay, max_retry_delay)
+    local task_key = prefix .. 'task:' .. task_id
+    redis.call('ZREM', prefix .. 'leases', task_id)
+    local fields = redis.call('HMGET', task_key, 'url', 'domain')
+    if not fields[1] then
+        return 0
+    end
+    local bucket, field = index_location(fields[1], bucket_bytes)
+    local index_key = prefix .. 'taskbyurl:' .. bucket
+    local attempts = redis.call('HINCRBY', task_key, 'attempts', 1)
+    if attempts > max_retries then
+        redis.call('DEL', task_key)
+        redis.call('HDEL', index_key, field)
+        return 0
+    end
+    local domain = fields[2]
+    local delay = math.min(retry_delay * 2 ^ (attempts - 1), max_retry_delay)
+    redis.call('ZADD', prefix .. 'todo:nn:' .. domain, now + delay, task_id)
+    redis.call('HSET', index_key, field, task_id .. '0')
+    if not redis.call('ZSCORE', prefix .. 'domains:ready', domain) then
+        reschedule_domain(prefix, domain, nil, now)
+    end
+    return 1
+end
+"""
+
+# Server-side implementation of ``Queue.push``. Runs atomically, so the
+# existing-task checks below can't race with other workers.
+#
+# KEYS: taskbyurl bucket, urlts bucket, hp todo key, domain todo key,
+#       task key, domains ready key, leases key
+# ARGV: task id, high priority ('1' or '0'), scheduled timestamp, min age,
+#       serialized task, url digest, repeat after, task key prefix,
+#       index field, queue name, domain
+PUSH_SCRIPT = RESCHEDULE_DOMAIN + """
+local task_id = ARGV[1]
+local high_priority = ARGV[2] == '1'
+local scheduled = tonumber(ARGV[3])
+local min_age = tonumber(ARGV[4])
+local field = ARGV[9]
+local prefix = ARGV[10] .. ':'
+local domain = ARGV[11]
+
+local existing = redis.call('HGET', KEYS[1], field)
+local existing_id, existing_hp, existing_queue, existing_score
+if existing then
+    existing_id = string.sub(existing, 1, -2)
+    existing_hp = string.sub(existing, -1) == '1'
+    existing_queue = existing_hp and KEYS[3] or KEYS[4]
+    existing_score = redis.call('ZSCORE', existing_queue, existing_id)
+    if not existing_score then
+        if redis.call('ZSCORE', KEYS[7], existing_id) then
+            -- The task is being fetched right now.
+            return 0
+        end
+        -- Stale pointer, the task is gone.
+        existing_id = nil
+    end
+end
+
+if not high_priority then
+    if existing_id and existing_hp then
+        return 0
+    end
+    if min_age > 0 then
+        local last = redis.call('HGET', KEYS[2], field)
+        if last then
+            scheduled = math.max(tonumber(last) + min_age, scheduled)
+        end
+    end
+    if existing_id and tonumber(existing_score) <= scheduled then
+        return 0
+    end
+end
+
+if existing_id then
+    redis.call('ZREM', existing_queue, existing_id)
+    redis.call('DEL', ARGV[8] .. existing_id)
+end
+
+redis.call('HMSET', KEYS[5], 'data', ARGV[5], 'url', ARGV[6],
+           'repeat', ARGV[7], 'min_age', ARGV[4], 'domain', domain)
+redis.call('HSET', KEYS[1], field, task_id .. ARGV[2])
+if high_priority then
+    redis.call('ZADD', KEYS[3], scheduled, task_id)
+else
+    redis.call('ZADD', KEYS[4], scheduled, task_id)
+end
+
+-- Update the domain's place in the schedule, unless it's already ready.
+if (existing_id and not existing_hp) or not high_priority then
+    local vtime = redis.call('ZSCORE', KEYS[6], domain)
+    if not vtime then
+        reschedule_domain(prefix, domain, nil, 0)
+    end
+end
+return 1
+"""
+
+# Server-side implementation of ``Queue.pop_many``. Takes up to ``count`` due
+# tasks: high priority tasks first, then one at a time from the ready domain
+# with the lowest virtual time. Popped tasks are leased until ``now`` plus
+# the lease timeout. Expired leases are retried first.
+#
+# KEYS: hp todo key, domains ready key, domains waiting key, leases key
+# ARGV: now, queue name, count, index bucket bytes, default domain delay,
+#       default domain weight, lease timeout, max retries, retry delay,
+#       max retry delay
+POP_SCRIPT = RESCHEDULE_DOMAIN + """
+local now = tonumber(ARGV[1])
+local prefix = ARGV[2] .. ':'
+local count = tonumber(ARGV[3])
+local bucket_bytes = tonumber(ARGV[4])
+local default_delay = tonumber(ARGV[5])
+local default_weight = tonumber(ARGV[6])
+local lease_timeout = tonumber(ARGV[7])
+local vclock_key = prefix .. 'vclock'
+local popped = {}
+
+local function pop_task(task_id, queue)
+    redis.call('ZREM', queue, task_id)
+    redis.call('ZADD', KEYS[4], now + lease_timeout, task_id)
+    popped[#popped + 1] = redis.call('HGET', prefix .. 'task:' .. task_id,
+                                     'data')
+end
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now,
+                           'LIMIT', 0, 100)
+for _, task_id in ipairs(expired) do
+    retry_task(prefix, task_id, now, bucket_bytes, tonumber(ARGV[8]),
+               tonumber(ARGV[9]), tonumber(ARGV[10]))
+end
+
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], 0, now, 'LIMIT', 0, count)
+for _, task_id in ipairs(ids) do
+    pop_task(task_id, KEYS[1])
+end
+
+-- Domains which have become eligible join the ready set, no earlier than
+-- the current virtual time so that they can't starve the others.
+local vclock = tonumber(redis.call('GET', vclock_key)) or 0
+for _, domain in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do
+    local vtime = tonumber(redis.call('HGET', prefix .. 'domain:' .. domain,
+                                      'vtime')) or 0
+    redis.call('ZREM', KEYS[3], domain)
+    redis.call('ZADD', KEYS[2], math.max(vtime, vclock), domain)
+end
+
+while #popped < count do
+    local top = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+    if #top == 0 then
+        break
+    end
+    local domain = top[1]
+    local vtime = tonumber(top[2])
+    local state_key = prefix .. 'domain:' .. domain
+    local queue = prefix .. 'todo:nn:' .. domain
+    local ids = redis.call('ZRANGEBYSCORE', queue, 0, now, 'LIMIT', 0, 1)
+    if #ids > 0 then
+        local state = redis.call('HMGET', state_key, 'weight', 'delay')
+        local weight = tonumber(state[1]) or default_weight
+        local delay = tonumber(state[2]) or default_delay
+        pop_task(ids[1], queue)
+        redis.call('SET', vclock_key, vtime)
+        vtime = vtime + 1 / weight
+        redis.call('HMSET', state_key, 'vtime', vtime, 'next', now + delay)
+    end
+    reschedule_domain(prefix, domain, vtime, now)
+end
+return popped
+"""
+
+# Server-side implementation of ``Queue.ack``. Ends a task's lease, records
+# the crawl timestamp and either drops the task or, if it repeats, schedules
+# it again. If the lease had already expired and the task was queued to be
+# retried, the retry is cancelled.
+#
+# ARGV: task id, now, queue name, index bucket bytes
+ACK_SCRIPT = RESCHEDULE_DOMAIN + """
+local task_id = ARGV[1]
+local now = tonumber(ARGV[2])
+local prefix = ARGV[3] .. ':'
+local task_key = prefix .. 'task:' .. task_id
+local fields = redis.call('HMGET', task_key, 'url', 'repeat', 'min_age',
+                          'domain')
+if not fields[1] then
+    return 0
+end
+local domain = fields[4]
+local queue = prefix .. 'todo:nn:' .. domain
+if redis.call('ZREM', prefix .. 'leases', task_id) == 0 then
+    if redis.call('ZREM', queue, task_id) == 0 then
+        return 0
+    end
+end
+
+local bucket, field = index_location(fields[1], tonumber(ARGV[4]))
+redis.call('HSET', prefix .. 'urlts:' .. bucket, field,
+           string.format('%d', now))
+local repeat_after = tonumber(fields[2]) or 0
+if repeat_after > 0 then
+    local delay = math.max(repeat_after, tonumber(fields[3]) or 0)
+    redis.call('ZADD', queue, now + delay, task_id)
+    redis.call('HSET', prefix .. 'taskbyurl:' .. bucket, field,
+               task_id .. '0')
+    redis.call('HDEL', task_key, 'attempts')
+else
+    redis.call('DEL', task_key)
+    redis.call('HDEL', prefix .. 'taskbyurl:' .. bucket, field)
+end
+if not redis.call('ZSCORE', prefix .. 'domains:ready', domain) then
+    reschedule_domain(prefix, domain, nil, now)
+end
+return 1
+"""
+
+# Server-side implementation of ``Queue.fail``. Ends a task's lease and
+# retries it after a backoff, or drops it once it has failed too many times.
+#
+# ARGV: task id, now, queue name, index bucket bytes, max retries,
+#       retry delay, max retry delay
+FAIL_SCRIPT = RESCHEDULE_DOMAIN + """
+local prefix = ARGV[3] .. ':'
+if not redis.call('ZSCORE', prefix .. 'leases', ARGV[1]) then
+    return 0
+end
+return retry_task(prefix, ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[4]),
+                  tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7]))
+"""
+
+# Server-side implementation of ``Queue.release``. Ends a task's lease and
+# puts it back in its queue, due after ``delay`` seconds, without counting a
+# failed attempt. A high priority task stays high priority unless delayed.
+#
+# ARGV: task id, now, queue name, index bucket bytes, delay
+RELEASE_SCRIPT = RESCHEDULE_DOMAIN + """
+local task_id = ARGV[1]
+local now = tonumber(ARGV[2])
+local prefix = ARGV[3] .. ':'
+local delay = tonumber(ARGV[5])
+if redis.call('ZREM', prefix .. 'leases', task_id) == 0 then
+    return 0
+end
+local fields = redis.call('HMGET', prefix .. 'task:' .. task_id, 'url',
+                          'domain')
+if not fields[1] then
+    return 0
+end
+local bucket, field = index_location(fields[1], tonumber(ARGV[4]))
+local index_key = prefix .. 'taskbyurl:' .. bucket
+local pointer = redis.call('HGET', index_key, field)
+if delay <= 0 and pointer and string.sub(pointer, -1) == '1' then
+    redis.call('ZADD', prefix .. 'todo:hp', 0, task_id)
+    return 1
+end
+local domain = fields[2]
+redis.call('ZADD', prefix .. 'todo:nn:' .. domain, now + delay, task_id)
+redis.call('HSET', index_key, field, task_id .. '0')
+if not redis.call('ZSCORE', prefix .. 'domains:ready', domain) then
+    reschedule_domain(prefix, domain, nil, now)
+end
+return 1
+"""
+
+
+EXPORT_VERSION = 1
+
+# The keys of a queue, following its name and ':'. Exports match them exactly
+# so that they leave out other queues whose names start with the same prefix.
+# Domains are netlocs, which may have user info and a port.
+QUEUE_KEY_RE = re.compile(
+    br'(task|taskbyurl|urlts):[0-9a-f]+$|todo:hp$|domains:(ready|waiting)$|'
+    br'(todo:nn|domain):([^@/]*@)?(\[[^\]]*\]|[^:@/\[]+)(:[0-9]*)?$|'
+    br'leases$|robots$|vclock$')
+
+# Suffixes which look like one of the keys above, to warn about any which an
+# export would otherwise leave out without a word.
+QUEUE_KEY_TYPE_RE = re.compile(
+    br'(task|taskbyurl|urlts|todo|domains?|leases|robots|vclock)(:|$)')
+
+
+def escape_glob(s):
+    """
+    Escape the characters which are special in a Redis glob pattern.
+    """
+    return re.sub(br'([\\*?\[\]])', br'\\\1', s)
+
+
+class RedisScript(object):
+    """
+    A Lua script which is registered with its queue's Redis client on first
+    use, so that creating a queue doesn't create any clients.
+    """
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+
+    def __get__(self, queue, owner):
+        if queue is None:
+            return self
+        script = queue.redis.register_script(self.source)
+        queue.__dict__[self.name] = script
+        return script
+
+
+class BaseQueue(object):
     """
-    Implements a sort-of-queue of crawl tasks.
+    Interface shared by queue backends. A queue holds crawl tasks until they
+    are due, and hands them out fairly across domains, deduplicated by
+    canonical URL. See ``Queue`` for the full semantics of ``push`` and
+    ``pop``, which every backend implements.
+
+    Backends with ``shared`` set may be used by several crawl processes at
+    once.
+
+    Popped tasks are leased for ``lease_timeout`` seconds, and must then be
+    passed to ``ack`` once they are done, to ``fail`` to be retried, or to
+    ``release`` to be handed back without being fetched. A task whose lease
+    expires, e.g. because its worker died, is retried as if it had failed.
+    Retries are delayed by ``retry_delay`` seconds, doubling with each
+    attempt up to ``max_retry_delay``, and a task is dropped once it has
+    failed ``max_retries`` times.
+
+    If ``robots`` is set to an ``itsy.robots.Robots`` instance, tasks for
+    URLs which robots.txt disallows are dropped when they are pushed.
     """
-    def __init__(self, name, url_canonicalizer=None):
+    shared = False
+    robots = None
+    lease_timeout = 300
+    max_retries = 3
+    retry_delay = 30
+    max_retry_delay = 3600
+
+    def __init__(self, name, url_canonicalizer=None, domain_weight=1,
+                 domain_delay=0):
         self.name = name
-        self.canonicalize_url = url_canonicalizer or (lambda url: url)
-        self.redis = StrictRedis(host='localhost', port=6379, db=0)
-        # XXX Temporary
-        #self.redis.flushall()
+        self.canonicalize_url = url_canonicalizer or canonicalize_url
+        self.domain_weight = domain_weight
+        self.domain_delay = domain_delay
+
+    def backoff(self, attempts):
+        """
+        Return the number of seconds to wait before the retry which follows
+        ``attempts`` failures.
+        """
+        return min(self.retry_delay * 2 ** (attempts - 1),
+                   self.max_retry_delay)
 
     def serialize(self, task):
-        return pickle.dumps(task)
+        return task.pack()
 
     def deserialize(self, s):
-        return pickle.loads(s)
+        return Task.unpack(s)
 
-    def prefix_redis_key(self, prefix, key):
-        return ':'.join([self.name, prefix, key])
+    def hash_url(self, url):
+        return hashlib.md5(to_bytes(self.canonicalize_url(url))).digest()
 
-    def pick_queue_key(self, high_priority):
-        return self.prefix_redis_key('todo', 'hp' if high_priority else 'nn')
+    def domain_for_url(self, url):
+        return domain_for_url(self.canonicalize_url(url))
 
-    def hash_url(self, url):
-        return hashlib.md5(url).hexdigest()
+    def disconnect(self):
+        """
+        Drop any open connections, e.g. after forking or patching sockets.
+        """
+        pass
+
+    def is_allowed(self, task):
+        if self.robots is None or self.robots.allowed(task.url):
+            return True
+        log.info("Dropping %s, disallowed by robots.txt", task.url)
+        metrics.registry.inc('itsy_robots_disallowed_total')
+        return False
+
+    def push(self, task):
+        return self.push_many([task])[0]
+
+    def push_many(self, tasks):
+        raise NotImplementedError
+
+    def pop_many(self, n):
+        raise NotImplementedError
+
+    def pop(self):
+        """
+        Get the next scheduled crawl task, or raise Empty() if there is nothing
+        to do.
+        """
+        tasks = self.pop_many(1)
+
+        # Nothing to do?
+        if not tasks:
+            raise Empty()
+
+        return tasks[0]
+
+    def ack(self, task):
+        raise NotImplementedError
+
+    def fail(self, task):
+        raise NotImplementedError
+
+    def release(self, task, delay=0):
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def get_task(self, task_id):
+        raise NotImplementedError
 
     def record_crawl_timestamp(self, url, now):
-        self.redis.set(self.prefix_redis_key('urlts', self.hash_url(url)),
-                       '%d' % now)
+        raise NotImplementedError
 
     def get_crawl_timestamp(self, url):
-        s = self.redis.get(self.prefix_redis_key('urlts', self.hash_url(url)))
-        if s:
-            return int(s)
+        return self.get_crawl_timestamps([url])[0]
+
+    def get_crawl_timestamps(self, urls):
+        raise NotImplementedError
 
     def get_existing_task_id(self, url):
-        s = self.redis.get(self.prefix_redis_key('taskbyurl',
-                                                 self.hash_url(url)))
+        return self.get_existing_task_ids([url])[0]
+
+    def get_existing_task_ids(self, urls):
+        raise NotImplementedError
+
+    def set_domain_weight(self, domain, weight):
+        raise NotImplementedError
+
+    def set_domain_delay(self, domain, delay):
+        raise NotImplementedError
+
+    def get_robots(self, domain):
+        """
+        Return the ``(expires, text)`` of the robots.txt stored for
+        ``domain``, or None.
+        """
+        raise NotImplementedError
+
+    def set_robots(self, domain, expires, text):
+        raise NotImplementedError
+
+
+class Queue(BaseQueue):
+    """
+    Implements a sort-of-queue of crawl tasks in Redis.
+
+    Both ``push`` and ``pop`` are implemented as Lua scripts, so each is a
+    single atomic round trip to Redis.
+
+    URLs are deduplicated by their canonical form, as returned by
+    ``url_canonicalizer``. The default, ``itsy.urls.canonicalize_url``,
+    ignores case in the host, default ports, fragments, tracking parameters
+    and query parameter order. Pass ``lambda url: url`` to compare raw URLs.
+
+    Per-URL state (crawl timestamps and queued task pointers) is kept in hash
+    buckets keyed by the first ``index_bucket_bytes`` of each URL's binary
+    digest. Small hashes are stored very compactly by Redis, so this costs a
+    fraction of the memory of one key per URL; for very large crawls, raise
+    ``hash-max-ziplist-entries`` in the Redis config so that buckets stay
+    compact.
+
+    Redis clients are only created when the queue is first used, and the
+    ``redis`` package is imported then too.
+
+    The queue may be sharded across several Redis ``nodes``, each given as a
+    ``redis://`` URL or a dict of ``StrictRedis`` arguments. Tasks are placed
+    on a shard by a hash of their URL's domain, so all state for a URL lives
+    on one shard and deduplication works as with a single node. ``pop``
+    visits the shards round-robin.
+
+    Normal priority tasks are queued per domain, and ``pop`` hands them out
+    fairly across domains, so one huge site can't crowd out the rest. A
+    domain with a higher weight (see ``set_domain_weight``) is picked
+    proportionally more often. Each domain may also have a minimum delay
+    between tasks handed out (see ``set_domain_delay``). The defaults for
+    domains without their own settings are ``domain_weight`` and
+    ``domain_delay``.
+    """
+    default_nodes = [{'host': 'localhost', 'port': 6379, 'db': 0}]
+    shared = True
+
+    push_script = RedisScript('push_script', PUSH_SCRIPT)
+    pop_script = RedisScript('pop_script', POP_SCRIPT)
+    ack_script = RedisScript('ack_script', ACK_SCRIPT)
+    fail_script = RedisScript('fail_script', FAIL_SCRIPT)
+    release_script = RedisScript('release_script', RELEASE_SCRIPT)
+
+    def __init__(self, name, url_canonicalizer=None, index_bucket_bytes=2,
+                 nodes=None, domain_weight=1, domain_delay=0):
+        BaseQueue.__init__(self, name, url_canonicalizer, domain_weight,
+                           domain_delay)
+        self.index_bucket_bytes = index_bucket_bytes
+        self.nodes = nodes or self.default_nodes
+        self._shards = None
+        self.next_shard = 0
+
+    @property
+    def shards(self):
+        """
+        The Redis clients for each shard, which are created on first use.
+        """
+        if self._shards is None:
+            self._shards = [self.make_redis(node) for node in self.nodes]
+        return self._shards
+
+    @property
+    def redis(self):
+        return self.shards[0]
+
+    def make_redis(self, node):
+        from redis import StrictRedis
+        if isinstance(node, dict):
+            return StrictRedis(**node)
+        return StrictRedis.from_url(node)
+
+    def disconnect(self):
+        if self._shards is None:
+            return
+        for shard in self._shards:
+            shard.connection_pool.disconnect()
+
+    def shard_index(self, url):
+        if len(self.shards) == 1:
+            return 0
+        return self.domain_shard_index(self.domain_for_url(url))
+
+    def domain_shard_index(self, domain):
+        domain = to_bytes(domain)
+        return (zlib.crc32(domain) & 0xffffffff) % len(self.shards)
+
+    def shard_for_url(self, url):
+        return self.shards[self.shard_index(url)]
+
+    def group_by_shard(self, items, url_for_item=lambda item: item):
+        """
+        Split ``items`` by the shard of their URL. Returns a dict mapping
+        shard index to a list of ``(position, item)`` tuples, with items in
+        their original order.
+        """
+        groups = {}
+        for ii, item in enumerate(items):
+            index = self.shard_index(url_for_item(item))
+            groups.setdefault(index, []).append((ii, item))
+        return groups
+
+    def shard_order(self):
+        """
+        Return the shards in the order to visit them for the next pop,
+        starting at a different shard each time.
+        """
+        start = self.next_shard
+        self.next_shard = (start + 1) % len(self.shards)
+        return self.shards[start:] + self.shards[:start]
+
+    def prefix_redis_key(self, prefix, key):
+        return ':'.join([self.name, prefix, key])
+
+    def pick_queue_key(self, high_priority, domain=None):
+        if high_priority:
+            return self.prefix_redis_key('todo', 'hp')
+        return self.prefix_redis_key('todo', 'nn:' + domain)
+
+    def leases_key(self):
+        return ':'.join([self.name, 'leases'])
+
+    def robots_key(self):
+        return ':'.join([self.name, 'robots'])
+
+    def domain_state_key(self, domain):
+        return self.prefix_redis_key('domain', domain)
+
+    def set_domain_weight(self, domain, weight):
+        """
+        Set the share of pops given to ``domain`` relative to other domains
+        with due tasks, which have a weight of ``domain_weight`` by default.
+        """
+        for shard in self.shards:
+            shard.hset(self.domain_state_key(domain), 'weight', weight)
+
+    def set_domain_delay(self, domain, delay):
+        """
+        Set the minimum number of seconds between tasks for ``domain`` being
+        handed out, across all workers which share this queue.
+        """
+        for shard in self.shards:
+            shard.hset(self.domain_state_key(domain), 'delay', delay)
+
+    def get_robots(self, domain):
+        shard = self.shards[self.domain_shard_index(domain)]
+        s = shard.hget(self.robots_key(), domain)
         if s:
-            task_id, high_priority_bool = s.split(',')
-            return task_id, high_priority_bool == '1'
-        else:
-            return None, None
+            return tuple(msgpack.unpackb(s, raw=False))
+
+    def set_robots(self, domain, expires, text):
+        shard = self.shards[self.domain_shard_index(domain)]
+        shard.hset(self.robots_key(), domain,
+                   msgpack.packb([expires, text], use_bin_type=True))
+
+    def index_location(self, prefix, digest):
+        """
+        Return the bucket key and field for a URL digest in the index named by
+        ``prefix``.
+        """
+        n = self.index_bucket_bytes
+        bucket = binascii.hexlify(digest[:n]).decode('ascii')
+        return self.prefix_redis_key(prefix, bucket), digest[n:]
+
+    def record_crawl_timestamp(self, url, now):
+        key, field = self.index_location('urlts', self.hash_url(url))
+        self.shard_for_url(url).hset(key, field, '%d' % now)
+
+    def get_crawl_timestamps(self, urls):
+        """
+        Look up the last crawl timestamp for each of a batch of URLs in a
+        single round trip per shard. Returns a list with None for URLs which
+        have never been crawled.
+        """
+        return [int(s) if s else None
+                for s in self.lookup_index('urlts', urls)]
+
+    def get_existing_task_ids(self, urls):
+        """
+        Look up the queued task ID and high priority flag for each of a batch
+        of URLs in a single round trip per shard. Returns a list of ``(task_id,
+        high_priority)`` tuples, which are ``(None, None)`` for URLs with no
+        queued task.
+        """
+        return [(s[:-1].decode('ascii'), s[-1:] == b'1') if s
+                else (None, None)
+                for s in self.lookup_index('taskbyurl', urls)]
+
+    def index_buckets(self, prefix, entries):
+        buckets = {}
+        for ii, url in entries:
+            key, field = self.index_location(prefix, self.hash_url(url))
+            buckets.setdefault(key, []).append((ii, field))
+        return buckets
+
+    def lookup_index(self, prefix, urls):
+        results = [None] * len(urls)
+        for index, entries in self.group_by_shard(urls).items():
+            buckets = self.index_buckets(prefix, entries)
+            with self.shards[index].pipeline(transaction=False) as pipe:
+                for key, fields in buckets.items():
+                    pipe.hmget(key, [field for ii, field in fields])
+                for fields, values in zip(buckets.values(), pipe.execute()):
+                    for (ii, field), value in zip(fields, values):
+                        results[ii] = value
+        return results
 
     def get_task(self, task_id):
-        s = self.redis.get(task_id)
-        return self.deserialize(s)
+        key = self.prefix_redis_key('task', task_id)
+        for shard in self.shards:
+            s = shard.hget(key, 'data')
+            if s:
+                return self.deserialize(s)
+
+    def push_script_params(self, task):
+        s = self.serialize(task)
+        task_id = task.task_id
+        digest = self.hash_url(task.url)
+        domain = self.domain_for_url(task.url)
+        taskbyurl_key, field = self.index_location('taskbyurl', digest)
+        urlts_key = self.index_location('urlts', digest)[0]
 
-    def drop_task(self, task_id, high_priority):
-        self.redis.zrem(self.pick_queue_key(high_priority), task_id)
-        self.redis.delete(task_id)
+        keys = [taskbyurl_key,
+                urlts_key,
+                self.pick_queue_key(True),
+                self.pick_queue_key(False, domain),
+                self.prefix_redis_key('task', task_id),
+                self.prefix_redis_key('domains', 'ready'),
+                self.leases_key()]
+        args = [task_id,
+                '1' if task.high_priority else '0',
+                float(task.scheduled_timestamp),
+                task.min_age or 0,
+                s,
+                digest,
+                task.repeat_after or 0,
+                self.prefix_redis_key('task', ''),
+                field,
+                self.name,
+                domain]
+        return keys, args
+
+    def pop_script_params(self, n):
+        keys = [self.pick_queue_key(True),
+                self.prefix_redis_key('domains', 'ready'),
+                self.prefix_redis_key('domains', 'waiting'),
+                self.leases_key()]
+        args = [time.time(), self.name, n, self.index_bucket_bytes,
+                self.domain_delay, self.domain_weight, self.lease_timeout,
+                self.max_retries, self.retry_delay, self.max_retry_delay]
+        return keys, args
 
     def push(self, task):
         """
-        Schedule a new crawl task, which is an instance of ``Task``.
+        Schedule a new crawl task, which is an instance of ``Task``. Returns
+        True if the task was enqueued, or False if it was dropped in favor of
+        an existing task.
 
         If ``high_priority`` is set, drop all other tasks for the same
         canonicalized URL and enqueue to a separate high priority queue.
@@ -128,116 +919,214 @@ class Queue(object):
         scheduled time is *after* this task, drop it. Otherwise, drop this
         task. Either way, the earlier of the two tasks should be kept.
         """
-        # XXX FIXME
-        # We really should take a lock on this URL, to prevent race conditions
-        # in the conditional logic below.
-
-        existing_task_id, existing_is_hp = self.get_existing_task_id(task.url)
+        start = time.time()
+        if not self.is_allowed(task):
+            return False
+        keys, args = self.push_script_params(task)
+        pushed = bool(self.push_script(keys=keys, args=args,
+                                       client=self.shard_for_url(task.url)))
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='push')
+        metrics.registry.inc('itsy_queue_pushed_total', int(pushed))
+        return pushed
 
-        if task.high_priority:
-            # If this task is HP, drop any other task for this URL..
-            if existing_task_id:
-                self.drop_task(existing_task_id, existing_is_hp)
+    def push_many(self, tasks):
+        """
+        Schedule a batch of crawl tasks in a single pipelined round trip per
+        shard. Each task is deduplicated exactly as in ``push``, in order, so
+        a later task in the batch is compared against the earlier ones.
+        Returns a list of booleans indicating which tasks were enqueued.
+        """
+        start = time.time()
+        results = [False] * len(tasks)
+        groups = self.group_by_shard(tasks, lambda task: task.url)
+        for index, entries in groups.items():
+            entries = [(ii, task) for ii, task in entries
+                       if self.is_allowed(task)]
+            with self.shards[index].pipeline(transaction=False) as pipe:
+                for ii, task in entries:
+                    keys, args = self.push_script_params(task)
+                    self.push_script(keys=keys, args=args, client=pipe)
+                for (ii, task), r in zip(entries, pipe.execute()):
+                    results[ii] = bool(r)
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='push_many')
+        metrics.registry.inc('itsy_queue_pushed_total', sum(results))
+        return results
 
-        elif existing_is_hp:
-            # If there's an existing high priority task, drop this one.
-            return
+    def pop_many(self, n):
+        """
+        Get up to ``n`` scheduled crawl tasks in a single round trip, or one
+        per shard visited. Returns an empty list if there is nothing to do.
 
-        else:
-            # If min_age is set, check for previous crawls and further delay
-            # this task in order to ensure that min_age is not violated.
-            if task.min_age:
-                last_timestamp = self.get_crawl_timestamp(task.url)
-                if last_timestamp:
-                    task.scheduled_timestamp = max(last_timestamp +
-                                                   task.min_age,
-                                                   task.scheduled_timestamp)
-
-            # If there is an existing task, check if it's scheduled earlier.
-            if existing_task_id:
-                scheduled_ts = self.redis.zscore(
-                    self.pick_queue_key(existing_is_hp),
-                    existing_task_id)
-
-                if scheduled_ts > task.scheduled_timestamp:
-                    # If the existing task is later, drop it.
-                    self.drop_task(existing_task_id, existing_is_hp)
-                else:
-                    # If this task is later, drop it and keep the existing
-                    # task.
-                    return
+        Popped tasks are leased, and must be passed to ``ack`` or ``fail``
+        before the lease expires.
+        """
+        start = time.time()
+        tasks = []
+        for shard in self.shard_order():
+            keys, args = self.pop_script_params(n - len(tasks))
+            blobs = self.pop_script(keys=keys, args=args, client=shard)
+            tasks.extend(self.deserialize(s) for s in blobs)
+            if len(tasks) >= n:
+                break
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='pop_many')
+        metrics.registry.inc('itsy_queue_popped_total', len(tasks))
+        return tasks
 
-        # At this point we're ready to enqueue.
-        s = self.serialize(task)
-        task_id = hashlib.md5(s).hexdigest()
-
-        # Store the task by ID.
-        self.redis.set(task_id, s)
-
-        # Finally, enqueue the task ID to the appropriate sorted set.
-        self.redis.zadd(self.pick_queue_key(task.high_priority),
-                        float(task.scheduled_timestamp), task_id)
-
-    def pop_queue(self, high_priority, cutoff):
-        key = self.pick_queue_key(high_priority)
-        with self.redis.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(key)
-                    elements = pipe.zrangebyscore(key, min=0, max=cutoff,
-                                                  start=0, num=1)
-                    if elements:
-                        task_id = elements[0]
-                        pipe.multi()
-                        pipe.zrem(key, task_id)
-                        pipe.execute()
-                        return task_id
-                    else:
-                        return
-                except WatchError:
-                    continue
+    def ack(self, task):
+        """
+        Mark a popped task as done. Records a crawl timestamp for its URL,
+        and reschedules it if it has a repeat interval. Returns False if the
+        task was no longer leased or queued, e.g. because it has already been
+        acknowledged.
+        """
+        start = time.time()
+        done = bool(self.ack_script(args=[task.task_id, time.time(),
+                                          self.name, self.index_bucket_bytes],
+                                    client=self.shard_for_url(task.url)))
+        metrics.registry.observe('itsy_queue_op_seconds',
+                                 time.time() - start, op='ack')
+        return done
 
-    def pop(self):
+    def fail(self, task):
         """
-        Get the next scheduled crawl task, or raise Empty() if there is nothing
-        to do.
+        Mark a popped task as failed, so that it is retried after a backoff,
+        or dropped if it has failed too often. Returns True if the task will
+        be retried.
         """
-        now = time.time()
-        for high_priority in (True, False):
-            next_task_id = self.pop_queue(high_priority, now)
-            if next_task_id:
-                break
+        retried = bool(self.fail_script(
+            args=[task.task_id, time.time(), self.name,
+                  self.index_bucket_bytes, self.max_retries,
+                  self.retry_delay, self.max_retry_delay],
+            client=self.shard_for_url(task.url)))
+        metrics.registry.inc('itsy_queue_failed_total')
+        return retried
 
-        # Nothing to do?
-        if not next_task_id:
-            raise Empty()
+    def release(self, task, delay=0):
+        """
+        Hand a popped task back without counting a failed attempt, to be
+        popped again after ``delay`` seconds, e.g. because it was held too
+        long to fetch or the host asked us to back off. Returns False if the
+        task was no longer leased.
+        """
+        return bool(self.release_script(
+            args=[task.task_id, time.time(), self.name,
+                  self.index_bucket_bytes, delay],
+            client=self.shard_for_url(task.url)))
 
-        # Otherwise, fetch the task and deserialize it.
-        s = self.redis.get(next_task_id)
-        self.redis.delete(next_task_id)
-        task = self.deserialize(s)
+    def count(self):
+        """
+        Return the number of currently enqueued tasks, not counting leased
+        tasks.
+        """
+        high = normal = 0
+        for shard in self.shards:
+            high += shard.zcard(self.pick_queue_key(True))
+            domains = self.scheduled_domains(shard)
+            with shard.pipeline(transaction=False) as pipe:
+                for domain in domains:
+                    pipe.zcard(self.pick_queue_key(False, domain))
+                normal += sum(pipe.execute())
 
-        # Record a crawl timestamp for this URL.
-        self.record_crawl_timestamp(task.url, now)
+        return {'high': high,
+                'normal': normal}
 
-        # If the task has a repeat interval, reschedule it.
-        if task.repeat_after:
-            repeat_task = Task(url=task.url,
-                               document_type=task.document_type,
-                               repeat_after=task.repeat_after,
-                               scheduled_timestamp=now + task.repeat_after)
-            self.push(repeat_task)
+    def scheduled_domains(self, shard):
+        """
+        Return the domains with queued normal priority tasks on ``shard``.
+        """
+        domains = []
+        for state in ('ready', 'waiting'):
+            key = self.prefix_redis_key('domains', state)
+            domains.extend(d.decode('utf-8')
+                           for d in shard.zrange(key, 0, -1))
+        return domains
 
-        return task
+    def export(self, f, chunk_size=1000):
+        """
+        Write the whole state of the queue (queued tasks, per-domain state
+        and crawl timestamps) to the binary file ``f`` as a stream of msgpack
+        records, which can be loaded with ``restore``. Large keys are written
+        in chunks of ``chunk_size`` entries, so memory use stays flat. Stop
+        the crawl first to get a consistent snapshot.
+        """
+        packer = msgpack.Packer(use_bin_type=True)
+        f.write(packer.pack({'format': 'itsy-queue',
+                             'version': EXPORT_VERSION,
+                             'shards': len(self.shards)}))
+        prefix = to_bytes(self.name + ':')
+        for index, shard in enumerate(self.shards):
+            for key in shard.scan_iter(escape_glob(prefix) + b'*',
+                                       count=chunk_size):
+                suffix = key[len(prefix):]
+                if not QUEUE_KEY_RE.match(suffix):
+                    if QUEUE_KEY_TYPE_RE.match(suffix):
+                        log.warn("Not exporting unrecognized key %r", key)
+                    continue
+                kind = shard.type(key)
+                if kind == b'hash':
+                    kind = u'hash'
+                    entries = shard.hscan_iter(key, count=chunk_size)
+                elif kind == b'zset':
+                    kind = u'zset'
+                    entries = shard.zscan_iter(key, count=chunk_size)
+                elif kind == b'string':
+                    f.write(packer.pack([index, suffix, u'string',
+                                         shard.get(key)]))
+                    continue
+                else:
+                    log.warn("Not exporting %r of type %r", key, kind)
+                    continue
+                chunk = []
+                for entry in entries:
+                    chunk.extend(entry)
+                    if len(chunk) >= 2 * chunk_size:
+                        f.write(packer.pack([index, suffix, kind, chunk]))
+                        chunk = []
+                if chunk:
+                    f.write(packer.pack([index, suffix, kind, chunk]))
 
-    def count(self):
+    def restore(self, f, batch_size=100):
         """
-        Return the number of currently enqueued tasks.
+        Load queue state written by ``export`` from the binary file ``f``,
+        pipelining ``batch_size`` records at a time. The queue may have a
+        different name, but must have the same number of shards. Existing
+        state is merged with, and overwritten by, the restored state.
         """
-        counts = []
-        for high_priority in (True, False):
-            key = self.pick_queue_key(high_priority)
-            counts.append(self.redis.zcard(key))
+        unpacker = msgpack.Unpacker(f, raw=False)
+        header = next(unpacker, None)
+        if (not isinstance(header, dict) or
+                header.get('format') != 'itsy-queue'):
+            raise ValueError('not an exported queue')
+        if header['version'] != EXPORT_VERSION:
+            raise ValueError('unsupported export version: %r' %
+                             header['version'])
+        if header['shards'] != len(self.shards):
+            raise ValueError('export has %d shards, queue has %d' %
+                             (header['shards'], len(self.shards)))
 
-        return {'high': counts[0],
-                'normal': counts[1]}
+        prefix = to_bytes(self.name + ':')
+        pipes = [shard.pipeline(transaction=False) for shard in self.shards]
+        pending = 0
+        for index, suffix, kind, value in unpacker:
+            pipe = pipes[index]
+            key = prefix + suffix
+            if kind == 'string':
+                pipe.set(key, value)
+            elif kind == 'hash':
+                pipe.execute_command('HMSET', key, *value)
+            elif kind == 'zset':
+                # ZADD takes score, member pairs.
+                args = []
+                for ii in range(0, len(value), 2):
+                    args.extend((value[ii + 1], value[ii]))
+                pipe.execute_command('ZADD', key, *args)
+            pending += 1
+            if pending >= batch_size:
+                for pipe in pipes:
+                    pipe.execute()
+                pending = 0
+        for pipe in pipes:
+            pipe.execute()
@@ -0,0 +1,244 @@
+"""
+robots.txt support. A ``Robots`` instance set as a queue's ``robots`` drops
+tasks for disallowed URLs when they are pushed, so they never take up room
+in the queue.
+"""
+import logging
+
+import re
+import time
+
+from .compat import urlsplit
+from .lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+def compile_pattern(pattern):
+    """
+    Return a function which tests whether a URL path matches a robots.txt
+    path pattern, in which '*' matches any characters and a trailing '$'
+    anchors the end of the path.
+    """
+    if '*' not in pattern and not pattern.endswith('$'):
+        return lambda path: path.startswith(pattern)
+    anchored = pattern.endswith('$')
+    if anchored:
+        pattern = pattern[:-1]
+    regex = '.*'.join(re.escape(part) for part in pattern.split('*'))
+    if anchored:
+        regex += '$'
+    return re.compile(regex, re.DOTALL).match
+
+
+class RobotsRules(object):
+    """
+    The rules from a robots.txt file which apply to one user agent, compiled
+    for fast checks.
+
+    ``rules`` is a list of ``(allow, pattern)`` tuples. As specified by RFC
+    9309, the rule with the longest matching pattern wins, and an allow rule
+    wins a tie.
+    """
+    def __init__(self, rules=(), crawl_delay=None):
+        rules = [(allow, pattern) for allow, pattern in rules if pattern]
+        rules.sort(key=lambda rule: (-len(rule[1]), not rule[0]))
+        self.rules = [(allow, compile_pattern(pattern))
+                      for allow, pattern in rules]
+        self.crawl_delay = crawl_delay
+
+    @classmethod
+    def parse(cls, text, agent):
+        """
+        Parse robots.txt ``text``, keeping the rules for the groups which
+        name the product token ``agent``, or the '*' groups if none do.
+        """
+        agent = agent.split('/', 1)[0].lower()
+        groups = []
+        current = None
+        # Whether the current group has any directives yet, after which a
+        # User-agent line starts a new group.
+        started = False
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            key, colon, value = line.partition(':')
+            if not colon:
+                continue
+            key = key.strip().lower()
+            value = value.strip()
+            if key == 'user-agent':
+                if current is None or started:
+                    current = ([], [], [])
+                    groups.append(current)
+                    started = False
+                current[0].append(value.lower())
+            elif current is None:
+                continue
+            elif key in ('allow', 'disallow'):
+                current[1].append((key == 'allow', value))
+                started = True
+            elif key == 'crawl-delay':
+                current[2].append(value)
+                started = True
+
+        matching = [group for group in groups if agent in group[0]]
+        if not matching:
+            matching = [group for group in groups if '*' in group[0]]
+        rules = []
+        delays = []
+        for agents, group_rules, group_delays in matching:
+            rules.extend(group_rules)
+            delays.extend(group_delays)
+
+        crawl_delay = None
+        for value in delays:
+            try:
+                crawl_delay = float(value)
+                break
+            except ValueError:
+                pass
+        return cls(rules, crawl_delay)
+
+    def allowed(self, url):
+        """
+        Return whether ``url``, or a path with an optional query, may be
+        fetched.
+        """
+        if not self.rules:
+            return True
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        path = path or '/'
+        if query:
+            path += '?' + query
+        for allow, matches in self.rules:
+            if matches(path):
+                return allow
+        return True
+
+
+class Robots(object):
+    """
+    Checks URLs against the robots.txt rules of their domains for the user
+    agent token ``agent``.
+
+    Each domain's robots.txt is fetched once, stored in ``queue`` for
+    ``ttl`` seconds so that it is shared by all workers and processes using
+    the queue, and parsed into ``RobotsRules`` which are kept in memory for
+    up to ``maxsize`` domains. The queue's delay for a domain is set from its
+    Crawl-delay, up to ``max_crawl_delay``, replacing any delay set with
+    ``set_domain_delay``.
+
+    A missing robots.txt (any 4xx response) allows everything. So do server
+    and network errors, which are only cached for ``error_ttl`` seconds:
+    disallowed tasks are dropped for good, so we err towards keeping them.
+
+    ``client`` is the ``Client`` used to fetch robots.txt files. If it isn't
+    given, one is created with ``client_options`` on the first fetch, so
+    that requests isn't imported before a gevent crawl patches the process.
+    Fetches are synchronous, so the asyncio engine's queues fetch robots.txt
+    files in threads before checking URLs, with ``itsy.aio.load_robots``.
+    """
+    ttl = 86400
+    error_ttl = 600
+    max_crawl_delay = 60
+    max_size = 512 * 1024
+
+    def __init__(self, queue, agent='itsy', client=None, ttl=None,
+                 maxsize=10000, client_options=None):
+        self.queue = queue
+        self.agent = agent
+        self.client = client
+        self.client_options = client_options or {
+            'max_body_size': self.max_size}
+        if ttl:
+            self.ttl = ttl
+        # domain -> (RobotsRules, expiry time)
+        self.rules = LRUCache(maxsize, expires=lambda entry: entry[1],
+                              coalesce=True)
+
+    def fetch(self, url):
+        """
+        Fetch the robots.txt at ``url``. Returns the text, which is empty to
+        allow everything, and how many seconds to keep it.
+        """
+        import requests
+        from .client import Client, FetchError
+        if self.client is None:
+            self.client = Client(**self.client_options)
+        try:
+            resp = self.client.get(url, referer=None)
+        except FetchError as e:
+            log.warn("Ignoring %s: %r", url, e)
+            return u'', self.ttl
+        except requests.RequestException as e:
+            log.warn("Failed fetching %s: %r", url, e)
+            return u'', self.error_ttl
+        if 200 <= resp.status_code < 300:
+            return resp.text, self.ttl
+        if 400 <= resp.status_code < 500:
+            return u'', self.ttl
+        log.warn("Failed fetching %s (HTTP %d)", url, resp.status_code)
+        return u'', self.error_ttl
+
+    def robots_url(self, url, domain):
+        scheme = urlsplit(url).scheme or 'http'
+        return '%s://%s/robots.txt' % (scheme, domain)
+
+    def load_stored(self, domain, now):
+        """
+        Return the rules for ``domain`` and their expiry time if they are
+        stored in the queue and still fresh, or None.
+        """
+        stored = self.queue.get_robots(domain)
+        if stored and stored[0] > now:
+            expires, text = stored
+            return RobotsRules.parse(text, self.agent), expires
+
+    def load(self, url, domain):
+        now = time.time()
+        stored = self.load_stored(domain, now)
+        if stored:
+            return stored
+        robots_url = self.robots_url(url, domain)
+        text, ttl = self.fetch(robots_url)
+        return self.store(domain, robots_url, text, ttl, now)
+
+    def store(self, domain, robots_url, text, ttl, now):
+        """
+        Store a fetched robots.txt in the queue and return its rules and
+        their expiry time.
+        """
+        expires = now + ttl
+        self.queue.set_robots(domain, expires, text)
+        rules = RobotsRules.parse(text, self.agent)
+        if rules.crawl_delay:
+            self.queue.set_domain_delay(
+                domain, min(rules.crawl_delay, self.max_crawl_delay))
+        log.info("Loaded %s (%d rules)", robots_url, len(rules.rules))
+        return rules, expires
+
+    def is_loaded(self, domain):
+        """
+        Return whether the rules for ``domain`` are in memory, so that
+        checking its URLs won't do any I/O.
+        """
+        return self.rules.get(domain) is not None
+
+    def rules_for(self, url):
+        """
+        Return the ``RobotsRules`` for the domain of ``url``, loading them
+        from the queue or fetching robots.txt if needed.
+        """
+        domain = self.queue.domain_for_url(url)
+        # Only one worker in this process loads each domain's rules.
+        rules, expires = self.rules.lookup(
+            domain, lambda domain: self.load(url, domain))
+        return rules
+
+    def allowed(self, url):
+        """
+        Return whether ``url`` may be fetched.
+        """
+        if urlsplit(url).path == '/robots.txt':
+            return True
+        return self.rules_for(url).allowed(url)
@@ -0,0 +1,171 @@
+import logging
+
+import time
+import heapq
+
+from .compat import urlparse
+
+log = logging.getLogger(__name__)
+
+
+def domain_for_url(url):
+    return urlparse(url).netloc.lower()
+
+
+def parse_retry_after(value, now):
+    """
+    Parse a Retry-After header value, which is either a number of seconds or
+    an HTTP date, into a number of seconds from ``now``.
+    """
+    if not value:
+        return
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    from email.utils import parsedate_tz, mktime_tz
+    parsed = parsedate_tz(value)
+    if parsed:
+        return max(0, mktime_tz(parsed) - now)
+
+
+class DomainScheduler(object):
+    """
+    Politeness scheduler shared by the workers of an Itsy process. Tracks the
+    next time each domain may be fetched, and holds popped tasks for domains
+    which are not yet allowed so that workers can move on to other hosts.
+
+    ``default_delay`` is the minimum number of seconds between fetches to the
+    same domain, which may be overridden per domain with ``delays``. When a
+    host responds with one of ``backoff_statuses`` its delay is multiplied by
+    ``backoff_factor`` (or set from Retry-After, if longer), up to
+    ``max_delay``. Successful responses then decay it back towards the
+    configured delay by ``recovery_factor``.
+
+    Popped tasks stay leased while they are parked, so workers hand a task
+    back to the queue rather than park it for longer than ``max_park_time``
+    seconds, which should be well under the queue's ``lease_timeout``.
+    """
+    backoff_statuses = (429, 503)
+
+    def __init__(self, default_delay=2, delays=None, backoff_factor=2,
+                 recovery_factor=0.9, max_delay=300, max_parked=1000,
+                 max_park_time=60):
+        self.default_delay = default_delay
+        self.delays = dict(delays or {})
+        self.backoff_factor = backoff_factor
+        self.recovery_factor = recovery_factor
+        self.max_delay = max_delay
+        self.max_parked = max_parked
+        self.max_park_time = max_park_time
+        self.current_delays = {}
+        self.next_allowed = {}
+        self.parked = []
+        self.parked_domains = {}
+        self.park_counter = 0
+
+    def set_delay(self, domain, delay):
+        self.delays[domain] = delay
+        self.current_delays[domain] = max(delay,
+                                          self.current_delays.get(domain, 0))
+
+    def base_delay(self, domain):
+        return self.delays.get(domain, self.default_delay)
+
+    def delay(self, domain):
+        return self.current_delays.get(domain, self.base_delay(domain))
+
+    def reserve(self, url, now=None):
+        """
+        Try to claim a fetch slot for the domain of ``url``. Returns 0 if the
+        fetch may proceed now, otherwise the number of seconds until the
+        domain is allowed again.
+        """
+        now = now or time.time()
+        domain = domain_for_url(url)
+        allowed = self.next_allowed.get(domain, 0)
+        if allowed > now:
+            return allowed - now
+        self.next_allowed[domain] = now + self.delay(domain)
+        return 0
+
+    def wait_time(self, url, now=None):
+        """
+        Return the number of seconds until the domain of ``url`` is allowed
+        again, without claiming a fetch slot.
+        """
+        now = now or time.time()
+        return max(0, self.next_allowed.get(domain_for_url(url), 0) - now)
+
+    def feedback(self, url, resp, now=None):
+        """
+        Adapt the delay for the domain of ``url`` based on a response. Returns
+        True if the host asked us to back off.
+        """
+        now = now or time.time()
+        domain = domain_for_url(url)
+        base = self.base_delay(domain)
+        delay = self.delay(domain)
+
+        if resp.status_code in self.backoff_statuses:
+            delay = min(self.max_delay,
+                        max(delay, base, 1) * self.backoff_factor)
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'),
+                                            now)
+            if retry_after:
+                delay = max(delay, min(retry_after, self.max_delay))
+            log.warn("Backing off %s for %0.1fs (HTTP %d)",
+                     domain, delay, resp.status_code)
+            self.current_delays[domain] = delay
+            self.next_allowed[domain] = max(self.next_allowed.get(domain, 0),
+                                            now + delay)
+            return True
+
+        if delay > base:
+            delay = max(base, delay * self.recovery_factor)
+            self.current_delays[domain] = delay
+        return False
+
+    def park(self, task, ready_at):
+        """
+        Hold a task until its domain is allowed again.
+        """
+        self.park_counter += 1
+        heapq.heappush(self.parked, (ready_at, self.park_counter, task))
+        domain = domain_for_url(task.url)
+        self.parked_domains[domain] = self.parked_domains.get(domain, 0) + 1
+
+    def has_parked(self, url):
+        """
+        Return whether any tasks for the domain of ``url`` are parked.
+        """
+        return domain_for_url(url) in self.parked_domains
+
+    def is_full(self):
+        return len(self.parked) >= self.max_parked
+
+    def pop_parked(self, now=None):
+        """
+        Return a parked task which has become ready, or None.
+        """
+        now = now or time.time()
+        if self.parked and self.parked[0][0] <= now:
+            task = heapq.heappop(self.parked)[2]
+            domain = domain_for_url(task.url)
+            self.parked_domains[domain] -= 1
+            if not self.parked_domains[domain]:
+                del self.parked_domains[domain]
+            return task
+
+    def drain(self):
+        """
+        Remove and return all parked tasks, e.g. to hand them back to the
+        queue when the crawl stops.
+        """
+        tasks = [task for ready_at, counter, task in self.parked]
+        self.parked = []
+        self.parked_domains.clear()
+        return tasks
+
+    def next_ready_time(self):
+        if self.parked:
+            return self.parked[0][0]
@@ -0,0 +1,88 @@
+"""
+Reading seed URL lists for bulk loading with ``Itsy.add_seeds``.
+"""
+import gzip
+import io
+import sys
+import zlib
+
+from .compat import PY2, string_types
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class GzipStream(io.RawIOBase):
+    """
+    Decompresses gzip from a file object which can't seek, such as a pipe,
+    which Python 2's ``GzipFile`` doesn't support.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            chunk = self.f.read(io.DEFAULT_BUFFER_SIZE)
+            if not chunk:
+                self.pending = self.decompressor.flush()
+                break
+            self.pending = self.decompressor.decompress(chunk)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def open_input(source):
+    """
+    Open ``source`` for reading bytes, transparently decompressing gzip.
+    ``source`` may be a path, ``'-'`` for stdin, or a binary file object.
+    """
+    if source == '-':
+        f = getattr(sys.stdin, 'buffer', None)
+        if f is None:
+            # Python 2's stdin can't peek, nor seek if it's a pipe.
+            f = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    elif hasattr(source, 'read'):
+        f = source
+    else:
+        f = io.open(source, 'rb')
+        if f.peek(2)[:2] == GZIP_MAGIC:
+            f.close()
+            return gzip.open(source, 'rb')
+        return f
+
+    if hasattr(f, 'peek'):
+        magic = f.peek(2)[:2]
+    elif hasattr(f, 'seek'):
+        magic = f.read(2)
+        f.seek(0)
+    else:
+        magic = None
+    if magic == GZIP_MAGIC:
+        if PY2 and not getattr(f, 'seekable', lambda: True)():
+            return io.BufferedReader(GzipStream(f))
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+
+def read_urls(source):
+    """
+    Yield URLs from ``source``, one per line, skipping blank lines and
+    comments starting with ``#``. Reads lazily, so arbitrarily large lists
+    can be streamed. See ``open_input`` for the accepted sources, of which
+    a path is closed once it has been read.
+    """
+    f = open_input(source)
+    try:
+        for line in f:
+            url = line.strip()
+            if url and not url.startswith(b'#'):
+                yield url.decode('utf-8')
+    finally:
+        if isinstance(source, string_types) and source != '-':
+            f.close()
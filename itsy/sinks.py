@@ -0,0 +1,274 @@
+"""
+Output sinks for items yielded by handlers.
+
+Handlers may yield items (usually dicts) alongside ``Task`` instances. Items
+are routed to the sinks added with ``Itsy.add_sink``, which buffer them in
+memory and write them in batches from a background thread, so slow storage
+never blocks the fetch workers.
+"""
+import logging
+
+import csv
+import os
+import threading
+import time
+from collections import deque
+
+import simplejson
+
+from . import metrics
+from .compat import PY2, text_type
+
+log = logging.getLogger(__name__)
+
+
+def encode_json(value):
+    return simplejson.dumps(value, default=text_type, sort_keys=True)
+
+
+class Sink(object):
+    """
+    Base class for output sinks. Subclasses implement ``write(items)`` to
+    store one batch, and may override ``open()`` and ``close_storage()``,
+    which are called from the writer thread.
+
+    Items are written once ``batch_size`` are pending, or at least every
+    ``flush_interval`` seconds. Call ``close()`` to write any remaining items
+    and stop the writer; ``Itsy`` does this when a crawl finishes.
+
+    A batch which fails to be written is kept and retried after
+    ``retry_delay`` seconds, doubling up to ``max_retry_delay``, and is only
+    dropped after ``max_retries`` retries. Meanwhile at most ``max_pending``
+    items are held, and further items are dropped.
+    """
+    batch_size = 100
+    flush_interval = 1
+    max_retries = 5
+    retry_delay = 1
+    max_retry_delay = 60
+    max_pending = 100000
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        if batch_size:
+            self.batch_size = batch_size
+        if flush_interval:
+            self.flush_interval = flush_interval
+        self.pending = deque()
+        self.failures = 0
+        self.retry_at = 0
+        self.overflowing = False
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        """
+        Queue ``item`` to be written. Never blocks on storage.
+        """
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.start()
+        if len(self.pending) >= self.max_pending:
+            if not self.overflowing:
+                log.error("%s has %d items pending, dropping new items",
+                          type(self).__name__, len(self.pending))
+                self.overflowing = True
+            metrics.registry.inc('itsy_items_dropped_total',
+                                 sink=type(self).__name__)
+            return
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='itsy-sink-%s' %
+                                       type(self).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        self.open()
+        try:
+            while not self.closing:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                self.flush()
+            while not self.flush():
+                time.sleep(max(0, self.retry_at - time.time()))
+        finally:
+            self.close_storage()
+
+    def flush(self):
+        """
+        Write the pending items in batches. Returns False if a failed batch
+        is waiting to be retried.
+        """
+        name = type(self).__name__
+        while self.pending:
+            if self.retry_at > time.time():
+                return False
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                batch.append(self.pending.popleft())
+            start = time.time()
+            try:
+                self.write(batch)
+            except Exception:
+                self.failures += 1
+                if self.failures > self.max_retries:
+                    log.exception("%s failed writing %d items, dropping them",
+                                  name, len(batch))
+                    metrics.registry.inc('itsy_items_dropped_total',
+                                         len(batch), sink=name)
+                    self.failures = 0
+                    continue
+                delay = min(self.retry_delay * 2 ** (self.failures - 1),
+                            self.max_retry_delay)
+                log.warn("%s failed writing %d items, retrying in %0.1fs",
+                         name, len(batch), delay, exc_info=True)
+                self.pending.extendleft(reversed(batch))
+                self.retry_at = time.time() + delay
+                return False
+            self.failures = 0
+            self.overflowing = False
+            metrics.registry.observe('itsy_sink_write_seconds',
+                                     time.time() - start, sink=name)
+            metrics.registry.inc('itsy_items_total', len(batch), sink=name)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Write any pending items and stop the writer thread.
+        """
+        if self.thread is None:
+            if not self.pending:
+                return
+            self.start()
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.thread = None
+        self.closing = False
+
+    def open(self):
+        pass
+
+    def write(self, items):
+        raise NotImplementedError
+
+    def close_storage(self):
+        pass
+
+
+class CallableSink(Sink):
+    """
+    Sink which passes each batch of items to ``func``, e.g. to post them to
+    a service.
+    """
+    def __init__(self, func, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.func = func
+
+    def write(self, items):
+        self.func(items)
+
+
+class JSONLinesSink(Sink):
+    """
+    Sink which appends items to ``path`` as JSON, one per line.
+    """
+    def __init__(self, path, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.path = path
+        self.f = None
+
+    def open(self):
+        self.f = open(self.path, 'ab')
+
+    def write(self, items):
+        self.f.write(b''.join(encode_json(item).encode('utf-8') + b'\n'
+                              for item in items))
+        self.f.flush()
+
+    def close_storage(self):
+        self.f.close()
+
+
+class CSVSink(Sink):
+    """
+    Sink which appends the given ``fields`` of each item to the CSV file at
+    ``path``, writing a header row if the file is new.
+    """
+    def __init__(self, path, fields, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.path = path
+        self.fields = fields
+        self.f = None
+
+    def open(self):
+        new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+        if PY2:
+            self.f = open(self.path, 'ab')
+        else:
+            self.f = open(self.path, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.f)
+        if new:
+            self.writer.writerow(self.fields)
+
+    def encode(self, value):
+        if value is None:
+            return ''
+        if PY2 and isinstance(value, text_type):
+            return value.encode('utf-8')
+        return value
+
+    def write(self, items):
+        self.writer.writerows([self.encode(item.get(field))
+                               for field in self.fields]
+                              for item in items)
+        self.f.flush()
+
+    def close_storage(self):
+        self.f.close()
+
+
+class SQLiteSink(Sink):
+    """
+    Sink which inserts the given ``fields`` of each item as a row of
+    ``table`` in the SQLite database at ``path``, creating the table if
+    needed. Values which aren't strings or numbers are stored as JSON. Each
+    batch is committed in one transaction.
+    """
+    def __init__(self, path, table, fields, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.path = path
+        self.table = table
+        self.fields = fields
+        self.conn = None
+
+    def open(self):
+        import sqlite3
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
+                          (self.table, ', '.join(self.fields)))
+        self.insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            self.table, ', '.join(self.fields),
+            ', '.join('?' for field in self.fields))
+
+    def encode(self, value):
+        if value is None or isinstance(value, (text_type, bytes, int, float)):
+            return value
+        return encode_json(value)
+
+    def write(self, items):
+        with self.conn:
+            self.conn.executemany(self.insert,
+                                  [[self.encode(item.get(field))
+                                    for field in self.fields]
+                                   for item in items])
+
+    def close_storage(self):
+        self.conn.close()
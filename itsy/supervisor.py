@@ -0,0 +1,76 @@
+import logging
+
+import os
+import signal
+import time
+from multiprocessing import Process
+
+log = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    """
+    Runs ``target`` in ``processes`` child processes, restarting any child
+    which exits unexpectedly after ``restart_delay`` seconds.
+
+    SIGTERM or SIGINT shuts down gracefully: children are sent SIGTERM and
+    given ``shutdown_timeout`` seconds to finish before they are killed.
+    """
+    def __init__(self, target, processes, restart_delay=1,
+                 shutdown_timeout=30):
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.children = {}
+        self.stopping = False
+
+    def run_child(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        self.target()
+
+    def start_child(self, index):
+        child = Process(target=self.run_child, name='itsy-%d' % index)
+        child.start()
+        log.info("Started child %d (pid %d)", index, child.pid)
+        self.children[index] = child
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        previous = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous[signum] = signal.signal(signum, self.stop)
+        try:
+            for index in range(self.processes):
+                self.start_child(index)
+
+            while not self.stopping:
+                for index, child in list(self.children.items()):
+                    if not child.is_alive() and not self.stopping:
+                        log.warn("Child %d (pid %d) exited with code %s, "
+                                 "restarting", index, child.pid,
+                                 child.exitcode)
+                        time.sleep(self.restart_delay)
+                        self.start_child(index)
+                time.sleep(0.5)
+        finally:
+            self.shutdown()
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def shutdown(self):
+        log.info("Shutting down %d children", len(self.children))
+        for child in self.children.values():
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+        deadline = time.time() + self.shutdown_timeout
+        for child in self.children.values():
+            child.join(max(0, deadline - time.time()))
+            if child.is_alive():
+                log.warn("Killing child (pid %d)", child.pid)
+                os.kill(child.pid, signal.SIGKILL)
+                child.join()
@@ -0,0 +1,126 @@
+import threading
+import time
+from unittest import SkipTest, TestCase
+
+try:
+    import asyncio
+    from itsy.aio import AsyncClient, AsyncQueue, LocalAsyncQueue
+except (ImportError, SyntaxError):
+    raise SkipTest('the asyncio engine requires Python 3 and aiohttp')
+
+from itsy import Itsy, Task
+from itsy.bench import MockSite
+from itsy.localqueue import LocalQueue
+from itsy.scheduler import DomainScheduler
+from itsy.tests.test_robots import ROBOTS, FakeRobots
+
+URL = 'http://www.example.com/a'
+
+
+class AsyncTestCase(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class TestAsyncClient(AsyncTestCase):
+
+    def test_get(self):
+        client = AsyncClient()
+        with MockSite(pages=10, size=5000) as site:
+            resp = self.run_async(client.get(site.url(1), referer=None))
+            self.run_async(client.close())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.encoding, 'utf-8')
+        self.assertGreaterEqual(len(resp.content), 5000)
+        self.assertIn(u'/page/2', resp.text)
+
+
+class TestAsyncQueue(AsyncTestCase):
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.q = AsyncQueue('test')
+        keys = self.run_async(self.q.redis.keys('test:*'))
+        if keys:
+            self.run_async(self.q.redis.delete(*keys))
+
+    def tearDown(self):
+        # aclose() replaced close() in redis-py 5.
+        redis = self.q.redis
+        self.run_async(getattr(redis, 'aclose', redis.close)())
+        AsyncTestCase.tearDown(self)
+
+    def test_roundtrip(self):
+        task = Task(URL, document_type='plain')
+        self.assertEqual(self.run_async(self.q.push_many([task])), [True])
+        self.assertFalse(self.run_async(self.q.push(task)))
+        self.assertEqual(self.run_async(self.q.count()),
+                         {'high': 0, 'normal': 1})
+
+        task2 = self.run_async(self.q.pop())
+        self.assertEqual(task2.task_id, task.task_id)
+        self.assertTrue(self.run_async(self.q.ack(task2)))
+        self.assertTrue(self.run_async(self.q.get_crawl_timestamp(URL)))
+        self.assertEqual(self.run_async(self.q.pop_many(1)), [])
+
+
+class SlowRobots(FakeRobots):
+
+    def fetch(self, url):
+        self.threads.append(threading.current_thread())
+        time.sleep(0.3)
+        return FakeRobots.fetch(self, url)
+
+
+class TestLoadRobots(AsyncTestCase):
+
+    def test_fetch_in_executor(self):
+        q = LocalQueue('test')
+        q.robots = SlowRobots(q, {'http://a.com/robots.txt': ROBOTS})
+        q.robots.threads = []
+        aq = LocalAsyncQueue(q)
+        start = time.time()
+        results = self.run_async(aq.push_many([
+            Task('http://a.com/search'), Task('http://a.com/x'),
+            Task('http://b.com/search')]))
+        self.assertLess(time.time() - start, 0.55)
+        self.assertEqual(results, [False, True, True])
+        self.assertEqual(sorted(q.robots.fetched),
+                         ['http://a.com/robots.txt',
+                          'http://b.com/robots.txt'])
+        self.assertNotIn(threading.current_thread(), q.robots.threads)
+
+        # Rules are now in memory, so nothing more is fetched.
+        self.assertEqual(self.run_async(aq.push_many([
+            Task('http://a.com/y')])), [True])
+        self.assertEqual(len(q.robots.fetched), 2)
+
+
+class TestAsyncEngine(TestCase):
+
+    def test_crawl(self):
+        itsy = Itsy('test', queue=LocalQueue('test'),
+                    scheduler=DomainScheduler(default_delay=0))
+        handled = []
+
+        def handler(task, doc):
+            handled.append(task.url)
+            if len(handled) >= 5:
+                itsy.stop()
+            for url in doc.x('a', 'hrefs'):
+                yield Task(url, document_type='page')
+
+        itsy.add_handler('page', handler)
+        with MockSite(pages=20, links=3, size=1000) as site:
+            itsy.add_seed(site.url(0), 'page')
+            itsy.crawl_async(concurrency=2)
+        self.assertGreaterEqual(len(handled), 5)
+        self.assertLessEqual(len(handled), 6)
+        self.assertTrue(itsy.queue.count()['normal'])
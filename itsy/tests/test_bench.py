@@ -0,0 +1,44 @@
+import subprocess
+import sys
+from argparse import Namespace
+from unittest import TestCase
+
+import requests
+
+from itsy import bench
+
+
+class TestBench(TestCase):
+
+    def test_link_graph(self):
+        self.assertEqual(bench.page_links(3, 100, 5),
+                         bench.page_links(3, 100, 5))
+        self.assertEqual(len(bench.page_links(3, 100, 5)), 5)
+        self.assertEqual(bench.page_links(99, 100, 5)[0], 0)
+
+    def test_mock_site(self):
+        with bench.MockSite(pages=10, size=5000) as site:
+            resp = requests.get(site.url(1))
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreaterEqual(len(resp.content), 5000)
+            self.assertIn(b'/page/2', resp.content)
+            self.assertEqual(requests.get(site.url(10)).status_code, 404)
+
+    def test_measure(self):
+        result = bench.measure('noop', lambda x: x, [(1,)] * 10)
+        self.assertEqual(result.ops, 10)
+        self.assertEqual(len(result.latencies), 10)
+        self.assertIn('noop', str(result))
+
+    def test_import(self):
+        results = list(bench.bench_import(Namespace(import_runs=2)))
+        self.assertEqual([result.ops for result in results], [2, 2, 2])
+        self.assertTrue(all(result.elapsed > 0 for result in results))
+
+    def test_lazy_imports(self):
+        out = subprocess.check_output([sys.executable, '-c', (
+            "import sys, itsy; itsy.Itsy('test').obey_robots(); "
+            "print(' '.join(sorted(sys.modules)))")])
+        modules = out.decode('ascii').split()
+        for name in ('requests', 'redis', 'lxml', 'gevent', 'iso8601'):
+            self.assertNotIn(name, modules)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from requests import Response
+
+from itsy.cache import ResponseCache
+
+
+def make_response(url, content, headers):
+    resp = Response()
+    resp.status_code = 200
+    resp.url = url
+    resp._content = content
+    resp.headers.update(headers)
+    return resp
+
+
+class TestResponseCache(TestCase):
+
+    def test_conditional_headers(self):
+        cache = ResponseCache()
+        url = 'http://www.example.com/a'
+        self.assertEqual(cache.conditional_headers(url), {})
+        cache.store(url, make_response(url, b'hello', {
+            'ETag': '"abc"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }))
+        self.assertEqual(cache.conditional_headers(url), {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        })
+        self.assertIsNone(cache.cached_response(url))
+
+    def test_body_eviction(self):
+        cache = ResponseCache(max_body_bytes=10)
+        for path in ('a', 'b', 'c'):
+            url = 'http://www.example.com/' + path
+            cache.store(url, make_response(url, b'12345', {'ETag': path}))
+
+        self.assertIsNone(cache.cached_response('http://www.example.com/a'))
+        resp = cache.cached_response('http://www.example.com/c')
+        self.assertEqual(resp.content, b'12345')
+        self.assertTrue(resp.from_cache)
+        self.assertEqual(cache.body_bytes, 10)
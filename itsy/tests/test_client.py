@@ -1,10 +1,70 @@
+import socket
+import time
 from unittest import TestCase
+from threading import Lock, Thread
 
-from itsy.client import Client
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from itsy.client import (Client, ResponseTooLarge, ContentTypeRejected,
+                         connection_limits)
+
+
+class BodyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    lock = Lock()
+    active = 0
+    max_active = 0
+
+    def do_GET(self):
+        body = b'x' * 1000
+        if self.path == '/slow':
+            with self.lock:
+                BodyHandler.active += 1
+                BodyHandler.max_active = max(self.active, self.max_active)
+            time.sleep(0.05)
+            with self.lock:
+                BodyHandler.active -= 1
+        self.send_response(200)
+        if self.path == '/image':
+            self.send_header('Content-Type', 'image/png')
+        else:
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.path == '/unsized':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
 
 class TestClient(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), BodyHandler)
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_port
+        thread = Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
     def test_proxies(self):
         proxies = {
             'http': '192.155.83.138:8888'
@@ -15,3 +75,46 @@ class TestClient(TestCase):
         body = resp.text
         proxy_ip = proxies['http'].split(':', 1)[0]
         self.assertIn(proxy_ip, body)
+
+    def test_session_pool(self):
+        client = Client(pool_connections=2, pool_maxsize=4)
+        adapter = client.session.get_adapter('https://www.example.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertIs(adapter,
+                      client.session.get_adapter('http://www.example.com'))
+
+    def test_max_body_size(self):
+        client = Client(max_body_size=1000)
+        resp = client.get(self.base_url + '/page', None)
+        self.assertEqual(len(resp.content), 1000)
+
+        client = Client(max_body_size=999)
+        self.assertRaises(ResponseTooLarge,
+                          client.get, self.base_url + '/page', None)
+        self.assertRaises(ResponseTooLarge,
+                          client.get, self.base_url + '/unsized', None)
+
+    def test_content_types(self):
+        client = Client(content_types=('text/html',))
+        resp = client.get(self.base_url + '/page', None)
+        self.assertEqual(resp.status_code, 200)
+        self.assertRaises(ContentTypeRejected,
+                          client.get, self.base_url + '/image', None)
+
+    def test_max_per_host(self):
+        BodyHandler.max_active = 0
+        clients = [Client(max_per_host=2) for ii in range(6)]
+        threads = [Thread(target=client.get,
+                          args=(self.base_url + '/slow', None))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(BodyHandler.max_active, 2)
+        self.assertEqual(len(connection_limits), 0)
+
+    def test_no_dns_cache_by_default(self):
+        original = socket.getaddrinfo
+        Client()
+        self.assertIs(socket.getaddrinfo, original)
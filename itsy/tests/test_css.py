@@ -0,0 +1,15 @@
+from unittest import TestCase
+
+from itsy.css import SelectorCache
+
+
+class TestSelectorCache(TestCase):
+
+    def test_lru(self):
+        cache = SelectorCache(maxsize=2)
+        a = cache.get('a')
+        self.assertIs(cache.get('a'), a)
+        cache.get('p')
+        cache.get('div')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2})
+        self.assertIsNot(cache.get('a'), a)
@@ -0,0 +1,52 @@
+import socket
+from unittest import TestCase
+
+from itsy.dnscache import DNSCache
+
+
+class TestDNSCache(TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.cache = DNSCache(ttl=60, negative_ttl=60)
+        self.cache.resolve = self.resolve
+
+    def resolve(self, host, port, *args):
+        self.lookups.append(host)
+        if host == 'missing.example.com':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 ('192.0.2.1', port))]
+
+    def test_cached(self):
+        first = self.cache.getaddrinfo('www.example.com', 80)
+        self.assertEqual(self.cache.getaddrinfo('www.example.com', 80), first)
+        self.cache.getaddrinfo('www.example.com', 443)
+        self.assertEqual(self.lookups, ['www.example.com'] * 2)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 2, 'size': 2})
+
+    def test_negative(self):
+        for ii in range(2):
+            self.assertRaises(socket.gaierror, self.cache.getaddrinfo,
+                              'missing.example.com', 80)
+        self.assertEqual(self.lookups, ['missing.example.com'])
+
+    def test_expiry(self):
+        self.cache.ttl = -1
+        self.cache.getaddrinfo('www.example.com', 80)
+        self.cache.getaddrinfo('www.example.com', 80)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_install(self):
+        original = socket.getaddrinfo
+        cache = DNSCache()
+        cache.install()
+        try:
+            self.assertEqual(socket.getaddrinfo, cache.getaddrinfo)
+            cache.install()
+            self.assertIs(cache.resolve, original)
+            self.assertTrue(socket.getaddrinfo('127.0.0.1', 80))
+        finally:
+            cache.uninstall()
+        self.assertIs(socket.getaddrinfo, original)
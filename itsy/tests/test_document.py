@@ -0,0 +1,98 @@
+from datetime import datetime
+from decimal import Decimal
+from unittest import TestCase
+
+from requests import Response
+
+from itsy.document import Document
+from itsy.queue import Task
+
+
+def make_response(content, content_type='text/html'):
+    resp = Response()
+    resp.status_code = 200
+    resp._content = content
+    resp.headers['Content-Type'] = content_type
+    if 'charset=' in content_type:
+        resp.encoding = content_type.split('charset=', 1)[1]
+    return resp
+
+
+class TestDocument(TestCase):
+
+    def test_lxml_cached(self):
+        resp = make_response(
+            b'<html><body><a href="/b">B</a></body></html>')
+        doc = Document(Task('http://www.example.com/a'), resp)
+        self.assertIs(doc.lxml, doc.lxml)
+        self.assertEqual(doc.extract_links('a'), ['http://www.example.com/b'])
+        self.assertEqual(doc.x('a'), 'B')
+
+    def test_declared_encoding(self):
+        body = u'<html><body><p>caf\xe9</p></body></html>'
+        resp = make_response(body.encode('latin-1'),
+                             'text/html; charset=ISO-8859-1')
+        doc = Document(Task('http://www.example.com/a'), resp)
+        self.assertEqual(doc.x('p'), u'caf\xe9')
+
+    def test_unknown_encoding(self):
+        resp = make_response(b'<html><body><a href="/b">B</a></body></html>',
+                             'text/html; charset=bogus-enc')
+        doc = Document(Task('http://www.example.com/a'), resp)
+        self.assertEqual(doc.x('a', 'hrefs'), ['http://www.example.com/b'])
+
+    def test_json_cached(self):
+        resp = make_response(b'{"a": [1, 2]}', 'application/json')
+        doc = Document(Task('http://www.example.com/a'), resp)
+        self.assertEqual(doc.json, {'a': [1, 2]})
+        self.assertIs(doc.json, doc.json)
+
+    def test_iterparse(self):
+        resp = make_response(
+            b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            b'<url><loc>http://www.example.com/a</loc></url>'
+            b'<url><loc>http://www.example.com/b</loc></url>'
+            b'</urlset>', 'application/xml')
+        doc = Document(Task('http://www.example.com/sitemap.xml'), resp)
+        self.assertEqual([el.x(None) for el in doc.iterparse('{*}loc')],
+                         ['http://www.example.com/a',
+                          'http://www.example.com/b'])
+
+    def test_iterparse_chunks(self):
+        resp = make_response(b'<html><body><ul>' +
+                             b''.join(b'<li>%d</li>' % ii
+                                      for ii in range(100)) +
+                             b'</ul></body></html>')
+        doc = Document(Task('http://www.example.com/'), resp)
+        items = []
+        sizes = []
+        for el in doc.iterparse('li', html=True, chunk_size=16):
+            items.append(el.x(None))
+            sizes.append(len(el.lxml.getparent()))
+        self.assertEqual(items, [str(ii) for ii in range(100)])
+        # Earlier elements are dropped from the tree as we go.
+        self.assertLess(max(sizes), 10)
+
+    def test_extract(self):
+        resp = make_response(
+            b'<html><body><ul>'
+            b'<li><a href="/a">A</a> <b>$1,000.50</b> <i>Jan 2, 2014</i></li>'
+            b'<li><a href="/b">B</a> <b>call</b> <s>3 left</s></li>'
+            b'<li><a>C</a></li>'
+            b'</ul></body></html>')
+        doc = Document(Task('http://www.example.com/'), resp)
+        table = doc.extract('li', {
+            'name': ('a', 'string'),
+            'url': ('a', 'href'),
+            'price': ('b', 'currency'),
+            'date': ('i', 'calendar_date'),
+            'stock': ('s', 'integer'),
+        })
+        self.assertEqual(table['name'], ['A', 'B', 'C'])
+        self.assertEqual(table['url'], ['http://www.example.com/a',
+                                        'http://www.example.com/b', None])
+        self.assertEqual(table['price'], [('usd', Decimal('1000.50')),
+                                          None, None])
+        self.assertEqual(table['date'], [datetime(2014, 1, 2), None, None])
+        self.assertEqual(table['stock'], [None, 3, None])
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from itsy.localqueue import LocalQueue
+from itsy.queue import Task, Empty
+from itsy.tests.test_queue import QueueTests, URL
+
+
+class TestLocalQueue(QueueTests, TestCase):
+
+    def setUp(self):
+        self.q = LocalQueue('test')
+
+
+class TestLocalQueuePersistence(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.queue')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_survives_restart(self):
+        q = LocalQueue('test', path=self.path)
+        q.push_many([Task(URL + '/%d' % ii, document_type='plain')
+                     for ii in range(5)])
+        q.push(Task(URL, document_type='hp', high_priority=True))
+        q.push(Task(URL + '/r', document_type='plain', repeat_after=3600))
+        q.set_domain_weight('www.example.com', 2)
+        self.assertTrue(q.ack(q.pop()))
+        q.close()
+
+        q = LocalQueue('test', path=self.path)
+        self.assertEqual(q.count(), {'high': 0, 'normal': 6})
+        self.assertTrue(q.get_crawl_timestamp(URL))
+        self.assertFalse(q.push(Task(URL + '/0', document_type='plain')))
+        self.assertEqual(q.settings['www.example.com'], {'weight': 2})
+        for task in q.pop_many(10):
+            self.assertTrue(q.ack(task))
+        self.assertRaises(Empty, q.pop)
+        q.close()
+
+        q = LocalQueue('test', path=self.path)
+        self.assertEqual(q.count(), {'high': 0, 'normal': 1})
+        q.close()
+
+    def test_compaction(self):
+        q = LocalQueue('test', path=self.path)
+        q.compact_min = 10
+        for ii in range(20):
+            q.push(Task(URL, document_type='plain', min_age=0))
+            q.ack(q.pop())
+        self.assertLessEqual(q.log_records, 10)
+        q.close()
+
+    def test_leases_not_persisted(self):
+        q = LocalQueue('test', path=self.path)
+        q.retry_delay = 0
+        q.push_many([Task(URL + '/%d' % ii, document_type='plain')
+                     for ii in range(2)])
+        q.fail(q.pop())
+        q.pop()
+        q.close()
+
+        q = LocalQueue('test', path=self.path)
+        self.assertEqual(q.count(), {'high': 0, 'normal': 2})
+        self.assertEqual(list(q.attempts.values()), [1])
+        q.close()
+
+    def test_truncated_log(self):
+        q = LocalQueue('test', path=self.path)
+        q.push_many([Task(URL + '/%d' % ii, document_type='plain')
+                     for ii in range(3)])
+        q.close()
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 5)
+
+        q = LocalQueue('test', path=self.path)
+        self.assertEqual(q.count(), {'high': 0, 'normal': 2})
+        q.push(Task(URL + '/x', document_type='plain'))
+        q.close()
+        q = LocalQueue('test', path=self.path)
+        self.assertEqual(q.count(), {'high': 0, 'normal': 3})
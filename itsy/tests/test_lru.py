@@ -0,0 +1,55 @@
+import time
+from threading import Thread
+from unittest import TestCase
+
+from itsy.lru import KeyedLocks, LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.lookup('a', str.upper), 'A')
+        self.assertEqual(cache.lookup('a', len), 'A')
+        cache.lookup('b', str.upper)
+        cache.lookup('c', str.upper)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'size': 0})
+
+    def test_expiry(self):
+        cache = LRUCache(10, expires=lambda value: time.time() + value)
+        self.assertEqual(cache.lookup('a', lambda key: -1), -1)
+        self.assertEqual(cache.lookup('b', lambda key: 60), 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 60)
+
+    def test_coalesce(self):
+        cache = LRUCache(10, coalesce=True)
+        calls = []
+
+        def create(key):
+            calls.append(key)
+            time.sleep(0.05)
+            return key
+
+        threads = [Thread(target=cache.lookup, args=('a', create))
+                   for ii in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 1})
+        self.assertEqual(len(cache.locks), 0)
+
+
+class TestKeyedLocks(TestCase):
+
+    def test_dropped_when_idle(self):
+        locks = KeyedLocks()
+        with locks.hold('a'):
+            with locks.hold('b'):
+                self.assertEqual(len(locks), 2)
+        self.assertEqual(len(locks), 0)
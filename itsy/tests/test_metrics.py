@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from itsy import metrics
+
+
+class TestMetrics(TestCase):
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics.registry.enabled)
+        metrics.registry.inc('itsy_tasks_total')
+        metrics.registry.observe('itsy_parse_seconds', 0.1)
+
+    def test_render(self):
+        registry = metrics.enable(buckets=(0.1, 1))
+        registry.inc('itsy_tasks_total', document_type='page')
+        registry.inc('itsy_tasks_total', 2, document_type='page')
+        registry.set('itsy_queue_depth', 5, priority='high')
+        registry.observe('itsy_parse_seconds', 0.05)
+        registry.observe('itsy_parse_seconds', 0.5)
+        registry.observe('itsy_parse_seconds', 5)
+
+        self.assertEqual(registry.total('itsy_tasks_total'), 3)
+        text = registry.render()
+        self.assertIn('# TYPE itsy_tasks_total counter', text)
+        self.assertIn('itsy_tasks_total{document_type="page"} 3.0', text)
+        self.assertIn('itsy_queue_depth{priority="high"} 5.0', text)
+        self.assertIn('itsy_parse_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('itsy_parse_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('itsy_parse_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('itsy_parse_seconds_count 3', text)
+
+    def test_quantile(self):
+        hist = metrics.Histogram((0.1, 1))
+        for value in (0.05, 0.05, 0.5, 5):
+            hist.observe(value)
+        self.assertEqual(hist.quantile(0.5), 0.1)
+        self.assertEqual(hist.quantile(0.75), 1)
+        self.assertEqual(hist.quantile(1), float('inf'))
@@ -0,0 +1,25 @@
+from decimal import Decimal
+from unittest import TestCase
+
+from itsy import parsers
+
+
+class TestParsers(TestCase):
+
+    def test_integer(self):
+        self.assertEqual(parsers.integer('only 1,024 left'), 1024)
+        self.assertEqual(parsers.integer('-5 degrees'), -5)
+        self.assertEqual(parsers.integer(u'\uff15 left'), 5)
+        self.assertRaises(ValueError, parsers.integer, 'none left')
+
+    def test_currency(self):
+        for s, amount in (('$1,000.50', '1000.50'),
+                          ('now $.99', '.99'),
+                          ('$12.', '12'),
+                          ('$-5 off', '-5'),
+                          ('$+5', '5'),
+                          ('$1e3', '1000')):
+            self.assertEqual(parsers.currency(s), ('usd', Decimal(amount)))
+        self.assertEqual(parsers.currency(u'\xa3.5'), ('gbp', Decimal('.5')))
+        self.assertRaises(ValueError, parsers.currency, '$. or $..5')
+        self.assertRaises(ValueError, parsers.currency, '12 USD')
@@ -0,0 +1,114 @@
+import time
+from unittest import TestCase
+
+from itsy.localqueue import LocalQueue
+from itsy.queue import Task
+from itsy.robots import Robots, RobotsRules
+
+
+ROBOTS = u"""
+# Comments are ignored.
+User-agent: *
+Disallow: /private
+Allow: /private/public
+Disallow: /*.pdf$
+
+User-agent: itsy
+User-agent: other
+Disallow: /search
+Allow: /search/about
+Disallow: /tmp*/cache
+Crawl-delay: 5
+
+User-agent: itsy
+Allow: /
+
+Sitemap: http://www.example.com/sitemap.xml
+"""
+
+
+class FakeRobots(Robots):
+
+    def __init__(self, queue, files, **kwargs):
+        Robots.__init__(self, queue, **kwargs)
+        self.files = files
+        self.fetched = []
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return self.files.get(url, u''), self.ttl
+
+
+class TestRobotsRules(TestCase):
+
+    def test_default_group(self):
+        rules = RobotsRules.parse(ROBOTS, 'somebot')
+        self.assertIsNone(rules.crawl_delay)
+        self.assertTrue(rules.allowed('http://www.example.com/'))
+        self.assertFalse(rules.allowed('/private/x'))
+        self.assertTrue(rules.allowed('/private/public/x'))
+        self.assertFalse(rules.allowed('/docs/a.pdf'))
+        self.assertTrue(rules.allowed('/docs/a.pdf?download=1'))
+        self.assertTrue(rules.allowed('/search'))
+
+    def test_agent_groups(self):
+        rules = RobotsRules.parse(ROBOTS, 'Itsy/1.0')
+        self.assertEqual(rules.crawl_delay, 5)
+        self.assertFalse(rules.allowed('http://www.example.com/search?q=a'))
+        self.assertTrue(rules.allowed('/search/about'))
+        self.assertFalse(rules.allowed('/tmp2/cache/x'))
+        self.assertTrue(rules.allowed('/private/x'))
+
+    def test_delay_only_group(self):
+        text = (u'User-agent: slowbot\nCrawl-delay: 10\n\n'
+                u'User-agent: itsy\nDisallow: /private\n')
+        rules = RobotsRules.parse(text, 'itsy')
+        self.assertIsNone(rules.crawl_delay)
+        self.assertFalse(rules.allowed('/private'))
+        rules = RobotsRules.parse(text, 'slowbot')
+        self.assertEqual(rules.crawl_delay, 10)
+        self.assertTrue(rules.allowed('/private'))
+
+    def test_longest_match(self):
+        rules = RobotsRules([(False, '/a'), (True, '/a/b'),
+                             (False, '/a/b/'), (True, '/a/b/')])
+        self.assertFalse(rules.allowed('/a/c'))
+        self.assertTrue(rules.allowed('/a/b'))
+        self.assertTrue(rules.allowed('/a/b/c'))
+        self.assertTrue(RobotsRules([(False, '')]).allowed('/a'))
+
+
+class TestRobots(TestCase):
+
+    def setUp(self):
+        self.q = LocalQueue('test')
+        self.robots = FakeRobots(self.q, {
+            'http://www.example.com/robots.txt': ROBOTS,
+        })
+        self.q.robots = self.robots
+
+    def test_push_filter(self):
+        self.assertTrue(self.q.push(Task('http://www.example.com/a')))
+        self.assertFalse(self.q.push(Task('http://www.example.com/search')))
+        self.assertEqual(self.q.push_many([
+            Task('http://www.example.com/search/about'),
+            Task('http://www.example.com/tmp/cache'),
+            Task('http://other.example.com/search'),
+        ]), [True, False, True])
+        self.assertEqual(self.robots.fetched,
+                         ['http://www.example.com/robots.txt',
+                          'http://other.example.com/robots.txt'])
+        self.assertEqual(self.q.settings['www.example.com'], {'delay': 5})
+
+    def test_shared_through_queue(self):
+        self.robots.allowed('http://www.example.com/a')
+        other = FakeRobots(self.q, {})
+        self.assertFalse(other.allowed('http://www.example.com/search'))
+        self.assertEqual(other.fetched, [])
+
+    def test_expiry(self):
+        self.robots.ttl = -1
+        self.assertTrue(self.robots.allowed('http://www.example.com/a'))
+        self.assertTrue(self.robots.allowed('http://www.example.com/b'))
+        self.assertEqual(len(self.robots.fetched), 2)
+        self.assertLess(self.q.get_robots('www.example.com')[0], time.time())
@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from itsy.queue import Task
+from itsy.scheduler import DomainScheduler, parse_retry_after
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TestDomainScheduler(TestCase):
+
+    def test_reserve(self):
+        s = DomainScheduler(default_delay=2, delays={'b.com': 10})
+        self.assertEqual(s.reserve('http://a.com/1', now=100), 0)
+        self.assertEqual(s.reserve('http://a.com/2', now=101), 1)
+        self.assertEqual(s.reserve('http://b.com/1', now=101), 0)
+        self.assertEqual(s.reserve('http://a.com/2', now=102), 0)
+        self.assertEqual(s.reserve('http://b.com/2', now=102), 9)
+
+    def test_backoff_and_recovery(self):
+        s = DomainScheduler(default_delay=2)
+        self.assertTrue(s.feedback('http://a.com/',
+                                   FakeResponse(429, {'Retry-After': '30'}),
+                                   now=100))
+        self.assertEqual(s.delay('a.com'), 30)
+        self.assertEqual(s.reserve('http://a.com/', now=110), 20)
+
+        self.assertFalse(s.feedback('http://a.com/', FakeResponse(200),
+                                    now=130))
+        self.assertEqual(s.delay('a.com'), 27)
+
+    def test_parking(self):
+        s = DomainScheduler()
+        later = Task('http://a.com/later')
+        sooner = Task('http://b.com/sooner')
+        s.park(later, 20)
+        s.park(sooner, 10)
+        self.assertIsNone(s.pop_parked(now=5))
+        self.assertEqual(s.next_ready_time(), 10)
+        self.assertTrue(s.has_parked('http://b.com/'))
+        self.assertEqual(s.pop_parked(now=15), sooner)
+        self.assertFalse(s.has_parked('http://b.com/'))
+        self.assertEqual(s.pop_parked(now=25), later)
+
+        s.park(later, 20)
+        self.assertEqual(s.drain(), [later])
+        self.assertFalse(s.has_parked('http://a.com/'))
+        self.assertIsNone(s.next_ready_time())
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120', 0), 120)
+        self.assertEqual(
+            parse_retry_after('Thu, 01 Jan 1970 00:01:00 GMT', 30), 30)
+        self.assertIsNone(parse_retry_after(None, 0))
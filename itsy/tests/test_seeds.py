@@ -0,0 +1,60 @@
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from itsy import Itsy
+from itsy.seeds import read_urls
+
+
+LIST = b'http://www.example.com/a\n\n# comment\n  http://www.example.com/b \n'
+
+
+class TestSeeds(TestCase):
+
+    def test_read_urls(self):
+        self.assertEqual(list(read_urls(BytesIO(LIST))),
+                         ['http://www.example.com/a',
+                          'http://www.example.com/b'])
+
+    def test_read_gzipped_urls(self):
+        f = BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(LIST)
+        f.seek(0)
+        self.assertEqual(len(list(read_urls(f))), 2)
+
+    def test_read_urls_from_path(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'urls.gz')
+            with gzip.open(path, 'wb') as gz:
+                gz.write(LIST)
+            self.assertEqual(len(list(read_urls(path))), 2)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_read_gzipped_stdin(self):
+        f = BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(LIST)
+        proc = subprocess.Popen([sys.executable, '-c', (
+            "from itsy.seeds import read_urls; "
+            "print(len(list(read_urls('-'))))")],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate(f.getvalue())
+        self.assertEqual(out.strip(), b'2')
+
+    def test_add_seeds(self):
+        itsy = Itsy('test')
+        keys = itsy.queue.redis.keys('test:*')
+        if keys:
+            itsy.queue.redis.delete(*keys)
+        urls = ['http://www.example.com/%d' % ii for ii in range(25)]
+        self.assertEqual(itsy.add_seeds(urls + urls[:5], 'plain',
+                                        batch_size=10), 25)
+        self.assertEqual(itsy.queue.count(), {'high': 0, 'normal': 25})
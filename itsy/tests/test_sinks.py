@@ -0,0 +1,113 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import simplejson
+from requests import Response
+
+from itsy import Itsy, Task
+from itsy.sinks import CallableSink, CSVSink, JSONLinesSink, SQLiteSink
+
+
+ITEMS = [{'name': u'caf\xe9', 'price': 3, 'tags': ['a']},
+         {'name': u'tea', 'price': None}]
+
+
+class TestSinks(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_callable_batches(self):
+        batches = []
+        sink = CallableSink(batches.append, batch_size=2)
+        for ii in range(5):
+            sink.put({'n': ii})
+        sink.close()
+        self.assertEqual([len(batch) for batch in batches][-1:], [1])
+        self.assertEqual(sum(len(batch) for batch in batches), 5)
+
+    def test_retry_failed_writes(self):
+        batches = []
+
+        def write(items):
+            if len(batches) < 2:
+                batches.append(None)
+                raise IOError('database is locked')
+            batches.append(items)
+
+        sink = CallableSink(write, batch_size=2)
+        sink.retry_delay = 0.01
+        for ii in range(3):
+            sink.put({'n': ii})
+        sink.close()
+        self.assertEqual(batches, [None, None, [{'n': 0}, {'n': 1}],
+                                   [{'n': 2}]])
+
+    def test_drop_after_retries(self):
+        sink = CallableSink(lambda items: 1 / 0)
+        sink.max_retries = 1
+        sink.retry_delay = 0.01
+        sink.max_pending = 2
+        for ii in range(3):
+            sink.put({'n': ii})
+        self.assertEqual(len(sink.pending), 2)
+        sink.close()
+        self.assertFalse(sink.pending)
+
+    def test_json_lines(self):
+        path = os.path.join(self.dir, 'out.jsonl')
+        sink = JSONLinesSink(path)
+        for item in ITEMS:
+            sink.put(item)
+        sink.close()
+        with open(path, 'rb') as f:
+            lines = [simplejson.loads(line) for line in f]
+        self.assertEqual(lines, ITEMS)
+
+    def test_csv(self):
+        path = os.path.join(self.dir, 'out.csv')
+        for ii in range(2):
+            sink = CSVSink(path, ['name', 'price'])
+            sink.put(ITEMS[1])
+            sink.close()
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(),
+                             ['name,price', 'tea,', 'tea,'])
+
+    def test_sqlite(self):
+        path = os.path.join(self.dir, 'out.db')
+        sink = SQLiteSink(path, 'items', ['name', 'price', 'tags'])
+        for item in ITEMS:
+            sink.put(item)
+        sink.close()
+        conn = sqlite3.connect(path)
+        rows = conn.execute('SELECT name, price, tags FROM items').fetchall()
+        conn.close()
+        self.assertEqual(rows, [(u'caf\xe9', 3, u'["a"]'),
+                                (u'tea', None, None)])
+
+    def test_handler_items(self):
+        itsy = Itsy('test')
+        batches = []
+        itsy.add_sink(CallableSink(batches.append), document_types=['page'])
+
+        def handler(task, doc):
+            yield {'url': task.url}
+            yield Task('http://www.example.com/b', document_type='page')
+
+        itsy.add_handler('page', handler)
+        resp = Response()
+        resp.status_code = 200
+        resp._content = b'<html></html>'
+        new_tasks = itsy.handle(Task('http://www.example.com/a',
+                                     document_type='page'), resp)
+        itsy.close_sinks()
+        self.assertEqual([task.url for task in new_tasks],
+                         ['http://www.example.com/b'])
+        self.assertEqual(batches, [[{'url': 'http://www.example.com/a'}]])
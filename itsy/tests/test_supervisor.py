@@ -0,0 +1,55 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+from threading import Thread
+from unittest import TestCase
+
+from itsy.supervisor import Supervisor
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'starts')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def starts(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [int(line) for line in f]
+
+    def target(self):
+        with open(self.path, 'a') as f:
+            f.write('%d\n' % os.getpid())
+        if len(self.starts()) == 1:
+            os._exit(1)
+        time.sleep(60)
+
+    def terminate_after_restart(self):
+        deadline = time.time() + 10
+        while len(self.starts()) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def test_restart_and_shutdown(self):
+        supervisor = Supervisor(self.target, 1, restart_delay=0.1,
+                                shutdown_timeout=5)
+        thread = Thread(target=self.terminate_after_restart)
+        thread.daemon = True
+        thread.start()
+        start = time.time()
+        supervisor.run()
+        self.assertLess(time.time() - start, 10)
+
+        starts = self.starts()
+        self.assertEqual(len(starts), 2)
+        self.assertNotEqual(starts[0], starts[1])
+        child = supervisor.children[0]
+        self.assertFalse(child.is_alive())
+        self.assertEqual(child.exitcode, -signal.SIGTERM)
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from itsy.urls import Canonicalizer, strip_query_params
+from itsy.utils import strip_param
+
+
+class TestCanonicalizer(TestCase):
+
+    def test_canonicalize(self):
+        canon = Canonicalizer()
+        cases = [
+            ('HTTP://WWW.Example.COM', 'http://www.example.com/'),
+            ('http://www.example.com:80/a#top', 'http://www.example.com/a'),
+            ('https://www.example.com:443/a', 'https://www.example.com/a'),
+            ('https://www.example.com:8443/a',
+             'https://www.example.com:8443/a'),
+            ('http://www.example.com/A?b=2&a=1&utm_source=x&gclid=y',
+             'http://www.example.com/A?a=1&b=2'),
+            ('http://user@[::1]:80/', 'http://user@[::1]/'),
+        ]
+        for url, expected in cases:
+            self.assertEqual(canon(url), expected)
+
+    def test_options(self):
+        canon = Canonicalizer(strip_params=('sid', 'ref*'), sort_query=False)
+        self.assertEqual(canon('http://a.com/?z=1&sid=2&referrer=3&a=4'),
+                         'http://a.com/?z=1&a=4')
+
+    def test_cache(self):
+        canon = Canonicalizer(maxsize=2)
+        for url in ('http://a.com/', 'http://a.com/', 'http://b.com/',
+                    'http://c.com/', 'http://a.com/'):
+            canon(url)
+        self.assertEqual(canon.stats(), {'hits': 1, 'misses': 4, 'size': 2})
+
+
+class TestStripParam(TestCase):
+
+    def test_strip_param(self):
+        self.assertEqual(strip_param('http://a.com/p?x=1&sid=2&x=3#f', 'sid'),
+                         'http://a.com/p?x=1&x=3#f')
+        self.assertEqual(strip_param('http://a.com/p', 'sid'),
+                         'http://a.com/p')
+        self.assertEqual(strip_query_params('http://a.com/?a=1&b=2&c=3',
+                                            ['a', 'c']),
+                         'http://a.com/?b=2')
@@ -0,0 +1,143 @@
+import os
+import subprocess
+import sys
+from unittest import SkipTest, TestCase
+
+import gevent
+
+from itsy import Itsy
+from itsy.bench import MockSite
+from itsy.client import ContentTypeRejected
+from itsy.compat import PY2
+from itsy.localqueue import LocalQueue, SCORE
+from itsy.queue import Task
+from itsy.scheduler import DomainScheduler
+from itsy.tests.test_scheduler import FakeResponse
+from itsy.worker import Worker
+
+CERTFILE = os.path.join(os.path.dirname(__file__), 'localhost.pem')
+
+
+class FakeClient(object):
+
+    def __init__(self, resp):
+        self.resp = resp
+
+    def get(self, url, referer):
+        if isinstance(self.resp, Exception):
+            raise self.resp
+        return self.resp
+
+
+class Crash(BaseException):
+    pass
+
+
+def crawl_with_crash():
+    """
+    Crawl with one worker which dies on its first task. Run in a subprocess
+    by ``test_restart``, since ``crawl()`` patches the process for gevent.
+    """
+    itsy = Itsy('test', queue=LocalQueue('test'))
+    workers = []
+
+    def one(worker):
+        workers.append(worker)
+        if len(workers) == 1:
+            raise Crash()
+        itsy.stop()
+
+    Worker.one = one
+    itsy.crawl(num_workers=1)
+    print('%d %d' % (len(workers), len(set(workers))))
+
+
+def crawl_https(url):
+    """
+    Crawl ``url`` until one page is handled, or give up after ten seconds,
+    and print how many pages were handled. Run in a subprocess by
+    ``test_https``, since ``crawl()`` patches the process for gevent.
+    """
+    itsy = Itsy('test', queue=LocalQueue('test'))
+    handled = []
+
+    def handler(task, doc):
+        handled.append(doc.x('title'))
+        itsy.stop()
+
+    itsy.add_handler('page', handler)
+    itsy.add_seed(url, 'page')
+    gevent.spawn_later(10, itsy.stop)
+    itsy.crawl(num_workers=1)
+    print(len(handled))
+
+
+class TestWorker(TestCase):
+
+    def setUp(self):
+        self.q = LocalQueue('test')
+        self.scheduler = DomainScheduler(default_delay=0.2)
+        self.itsy = Itsy('test', queue=self.q, scheduler=self.scheduler)
+        self.worker = Worker(0, self.itsy)
+
+    def test_parks_one_task_per_host(self):
+        self.q.push_many([Task('http://a.com/%d' % ii) for ii in range(50)])
+        self.worker.next_task()
+        self.worker.next_task()
+        self.assertLessEqual(len(self.scheduler.parked), 2)
+        self.assertGreaterEqual(self.q.count()['normal'], 46)
+
+    def test_rejected_not_retried(self):
+        self.q.push(Task('http://a.com/'))
+        self.worker.client = FakeClient(ContentTypeRejected('image/png'))
+        self.worker.one()
+        self.assertTrue(self.q.get_crawl_timestamp('http://a.com/'))
+        self.assertEqual(self.q.count()['normal'], 0)
+
+    def test_throttled_released(self):
+        self.q.push(Task('http://a.com/'))
+        self.worker.client = FakeClient(
+            FakeResponse(429, {'Retry-After': '30'}))
+        self.worker.one()
+        self.assertEqual(self.q.count()['normal'], 1)
+        self.assertFalse(self.q.attempts)
+        record = self.q.tasks[Task('http://a.com/').task_id]
+        self.assertGreater(record[SCORE],
+                           self.scheduler.next_allowed['a.com'] - 1)
+
+    def test_long_wait_released(self):
+        self.scheduler.default_delay = 600
+        self.q.push_many([Task('http://a.com/1'), Task('http://a.com/2')])
+        self.worker.next_task()
+        gevent.spawn_later(0.2, self.itsy.stop)
+        self.assertIsNone(self.worker.next_task())
+        self.assertFalse(self.scheduler.parked)
+        self.assertEqual(self.q.count()['normal'], 1)
+
+    def test_stop_releases_buffer(self):
+        self.itsy.prefetch = 5
+        self.q.push_many([Task('http://%d.com/' % ii) for ii in range(5)])
+        self.worker.next_task()
+        self.assertEqual(len(self.worker.buffer), 4)
+        self.itsy.stop()
+        self.worker._run()
+        self.assertFalse(self.worker.buffer)
+        self.assertEqual(self.q.count()['normal'], 4)
+
+    def test_restart(self):
+        out = subprocess.check_output([sys.executable, '-c', (
+            'from itsy.tests.test_worker import crawl_with_crash; '
+            'crawl_with_crash()')], stderr=subprocess.STDOUT)
+        self.assertEqual(out.decode('ascii').split()[-2:], ['2', '2'])
+
+    def test_https(self):
+        if PY2:
+            # urllib3 can't match IP addresses without the ipaddress backport.
+            raise SkipTest('HTTPS to 127.0.0.1 is only tested on Python 3')
+        env = dict(os.environ, REQUESTS_CA_BUNDLE=CERTFILE)
+        with MockSite(pages=1, certfile=CERTFILE) as site:
+            out = subprocess.check_output([sys.executable, '-c', (
+                'from itsy.tests.test_worker import crawl_https; '
+                'crawl_https(%r)' % site.url(0))],
+                stderr=subprocess.STDOUT, env=env)
+        self.assertEqual(out.decode('ascii').split()[-1], '1')
@@ -0,0 +1,95 @@
+"""
+URL canonicalization, so that trivially different variants of a URL are
+deduplicated by the queue.
+"""
+from .compat import urlsplit, urlunsplit
+from .lru import LRUCache
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+# Query parameters which only track where a visitor came from. Names ending
+# in '*' match any parameter with that prefix.
+TRACKING_PARAMS = ('utm_*', 'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid',
+                   'mc_cid', 'mc_eid', '_ga', '_hsenc', '_hsmi')
+
+
+def param_matcher(names):
+    """
+    Return a function which tests whether a query parameter name is one of
+    ``names``, where names ending in '*' are prefixes.
+    """
+    exact = frozenset(name for name in names if not name.endswith('*'))
+    prefixes = tuple(name[:-1] for name in names if name.endswith('*'))
+
+    def matches(name):
+        return name in exact or (prefixes and name.startswith(prefixes))
+    return matches
+
+
+def filter_query(query, matches, sort=False):
+    """
+    Remove parameters whose names are matched by ``matches`` from a query
+    string, leaving the rest exactly as they were encoded.
+    """
+    if not query:
+        return query
+    pairs = [pair for pair in query.split('&')
+             if pair and not matches(pair.split('=', 1)[0])]
+    if sort:
+        pairs.sort()
+    return '&'.join(pairs)
+
+
+def strip_query_params(url, names):
+    """
+    Remove the query parameters in ``names`` from ``url``.
+    """
+    if '?' not in url:
+        return url
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    return urlunsplit((scheme, netloc, path,
+                       filter_query(query, param_matcher(names)), fragment))
+
+
+class Canonicalizer(object):
+    """
+    Callable which maps URLs to a canonical form: the scheme and host are
+    lowercased, default ports and the fragment are removed, an empty path
+    becomes '/', query parameters named in ``strip_params`` are dropped and,
+    if ``sort_query`` is set, the rest are sorted.
+
+    Results are kept in an LRU cache of ``maxsize`` URLs, since the same
+    URLs are seen over and over again as links from different pages.
+    """
+    def __init__(self, strip_params=TRACKING_PARAMS, sort_query=True,
+                 maxsize=100000):
+        self.strip_matches = param_matcher(strip_params)
+        self.sort_query = sort_query
+        self.urls = LRUCache(maxsize)
+
+    def __call__(self, url):
+        return self.urls.lookup(url, self.canonicalize)
+
+    def canonicalize(self, url):
+        scheme, netloc, path, query, fragment = urlsplit(url.strip())
+        scheme = scheme.lower()
+        userinfo, at, host = netloc.rpartition('@')
+        host = host.lower()
+        if not host.endswith(']'):
+            name, colon, port = host.rpartition(':')
+            if colon and port == DEFAULT_PORTS.get(scheme):
+                host = name
+        netloc = userinfo + at + host
+        if netloc and not path:
+            path = '/'
+        query = filter_query(query, self.strip_matches, self.sort_query)
+        return urlunsplit((scheme, netloc, path, query, ''))
+
+    def stats(self):
+        return self.urls.stats()
+
+    def clear(self):
+        self.urls.clear()
+
+
+canonicalize_url = Canonicalizer()
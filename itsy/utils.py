@@ -1,11 +1,9 @@
 import logging
 
-import urlparse
-import urllib
-
 from . import Task
 from .client import Client
 from .document import Document
+from .urls import strip_query_params
 
 log = logging.getLogger(__name__)
 
@@ -31,14 +29,4 @@ def strip_param(url, key):
     """
     Strip a GET parameter from a URL.
     """
-    o = urlparse.urlparse(url)
-    params = urlparse.parse_qs(o[4])
-    if key in params:
-        del params[key]
-    new_url = urlparse.urlunparse((o.scheme,
-                                   o.netloc,
-                                   o.path,
-                                   o.params,
-                                   urllib.urlencode(params),
-                                   o.fragment))
-    return new_url
+    return strip_query_params(url, [key])
@@ -0,0 +1,145 @@
+"""
+The gevent crawl engine. Importing this module doesn't patch anything, or
+import requests, but ``Itsy.crawl`` calls ``patch()`` before starting
+workers. That is too late if requests has been imported already, e.g. by
+fetching robots.txt while adding seeds, so call ``patch()`` first thing in
+a script which crawls with gevent.
+"""
+import logging
+
+import sys
+import time
+from collections import deque
+
+import gevent
+from gevent import Greenlet, monkey
+
+from .client import Client, FetchError
+from .compat import PY2
+
+log = logging.getLogger(__name__)
+
+
+def patch():
+    """
+    Monkey-patch the process for cooperative gevent I/O. On Python 3 this
+    must happen before requests is imported: urllib3 keeps references to the
+    unpatched ``ssl`` module, which make every HTTPS request fail.
+    """
+    if monkey.is_module_patched('socket'):
+        return
+    if not PY2 and 'urllib3' in sys.modules:
+        raise RuntimeError('requests was imported before patching for '
+                           'gevent, call itsy.worker.patch() before anything '
+                           'else which may import it')
+    monkey.patch_all(thread=False)
+
+
+class Worker(Greenlet):
+    """
+    An itsy worker. You should never have to use this directly.
+    """
+    def __init__(self, id, itsy):
+        Greenlet.__init__(self)
+        self.id = id
+        self.itsy = itsy
+        self.client = Client(proxies=itsy.proxies, cache=itsy.cache,
+                             **itsy.client_options)
+        self.buffer = deque()
+
+    def next_task(self):
+        """
+        Return the next task which is allowed to be fetched now. Tasks for
+        domains which are still rate limited are parked with the scheduler,
+        so the worker can move on to other hosts. It sleeps when it pops a
+        second task for a host which is still rate limited, or there is
+        nothing left to do. Returns None if the crawl is stopping.
+        """
+        scheduler = self.itsy.scheduler
+        idle_delay = self.itsy.min_idle_delay
+        while not self.itsy.stopping:
+            now = time.time()
+            task = scheduler.pop_parked(now)
+            if task is None and not scheduler.is_full():
+                if not self.buffer:
+                    self.buffer.extend(
+                        self.itsy.queue.pop_many(self.itsy.prefetch))
+                if self.buffer:
+                    task = self.buffer.popleft()
+
+            if task is not None:
+                wait = scheduler.reserve(task.url, now)
+                if not wait:
+                    return task
+                if wait > scheduler.max_park_time:
+                    # Hand the task back rather than hold its lease so long.
+                    self.itsy.queue.release(task, wait)
+                else:
+                    # Keep pulling from the queue past a rate limited host,
+                    # but stop once it already has a task parked rather than
+                    # hoard its backlog in this process.
+                    crowded = scheduler.has_parked(task.url)
+                    scheduler.park(task, now + wait)
+                    if not crowded:
+                        continue
+
+            # Nothing we can fetch right now: sleep until the next parked
+            # task is ready, backing off while the queue stays empty.
+            ready_at = scheduler.next_ready_time()
+            if ready_at:
+                gevent.sleep(min(max(ready_at - now, 0), idle_delay))
+            else:
+                gevent.sleep(idle_delay)
+            idle_delay = min(idle_delay * 2, self.itsy.max_idle_delay)
+
+    def one(self):
+        """
+        Fetch and handle the next task. The task is acknowledged once its new
+        tasks have been pushed, or marked as failed to be retried later. If
+        the host asks us to back off, the task is handed back to the queue
+        until the host allows us again, which doesn't count as a failure.
+        """
+        task = self.next_task()
+        if task is None:
+            return
+        log.info("%d: Handling task: [%s] %s",
+                 self.id, task.document_type, task.url)
+        from requests import RequestException
+        queue = self.itsy.queue
+        try:
+            r = self.client.get(url=task.url, referer=task.referer)
+        except FetchError as e:
+            # Rejected for its type or size, which a retry won't change.
+            log.warn("%d: Skipping %s: %r", self.id, task.url, e)
+            queue.ack(task)
+            return
+        except RequestException as e:
+            log.warn("%d: Failed fetching %s: %r", self.id, task.url, e)
+            queue.fail(task)
+            return
+        try:
+            new_tasks = self.itsy.handle(task, r, self.id)
+        except Exception:
+            log.exception("%d: Failed handling %s", self.id, task.url)
+            queue.fail(task)
+            return
+        if new_tasks is None:
+            queue.release(task, self.itsy.scheduler.wait_time(task.url))
+            return
+        if new_tasks:
+            self.itsy.push_many(new_tasks)
+        queue.ack(task)
+
+    def _run(self):
+        try:
+            while not self.itsy.stopping:
+                try:
+                    self.one()
+                except Exception:
+                    # Most likely the queue is unreachable. Any task in
+                    # progress is retried once its lease expires.
+                    log.exception("%d: Worker error", self.id)
+                    gevent.sleep(self.itsy.max_idle_delay)
+        finally:
+            self.itsy.release_tasks(self.buffer)
+            self.buffer.clear()
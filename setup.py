@@ -16,6 +16,7 @@ setup(name="itsy",
       install_requires=[
           'gevent',
           'redis',
+          'msgpack',
           'simplejson',
           'lxml',
           'cssselect',
@@ -26,6 +27,9 @@ setup(name="itsy",
           'nose>=1.1',
           'nose-cover3',
       ],
+      extras_require={
+          'async': ['aiohttp', 'redis>=4.2'],
+      },
       license='MIT',
       packages=['itsy'],
       test_suite='nose.collector',